@@ -0,0 +1,17 @@
+#!/usr/bin/python
+'''
+Benchmark the chamberconnectlibrary controller classes against simulated controllers.
+
+Fails (exit status 1) when a case makes more bus transactions per call than allowed by the
+budget file::
+
+    chamberconnectlibrary-benchmark.py --interface TCP --budget benchmark-budget.json
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+import sys
+from chamberconnectlibrary.benchmark import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+﻿'''
+End to end throughput benchmark of the controller classes against the simulators (see simulator).
+
+Each case calls a controller method a number of times and reports calls per second, latency
+percentiles and the bus transactions and bytes per call (counted by the simulator). Transaction
+counts do not depend on the speed of the machine running the benchmark so they can be checked
+against a committed budget::
+
+    python -m chamberconnectlibrary.benchmark --budget bin/benchmark-budget.json
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+import copy
+import itertools
+import json
+import math
+import re
+import time
+from chamberconnectlibrary.espec import Espec
+from chamberconnectlibrary.watlowf4t import WatlowF4T
+from chamberconnectlibrary.watlowf4 import WatlowF4
+from chamberconnectlibrary.simulator import ModbusSimulator, EspecSimulator, EspecChamber
+from chamberconnectlibrary.simulator import WatlowF4TDevice, WatlowF4Device
+
+CONTROLLERS = ['Espec', 'EspecSCP220', 'WatlowF4T', 'WatlowF4']
+
+#the optional sample() flags, every combination of them is benchmarked
+SAMPLE_FLAGS = [('get_alarms', True), ('get_program_status', True), ('get_events', [1, 2]),
+                ('get_program_list', True), ('get_refrig', True)]
+
+JSON_FORMAT = {'indent':2, 'sort_keys':True, 'separators':(',', ': ')}
+
+LOOP_ITEMS = ['setpoint', 'processvalue', 'enable', 'mode', 'power', 'units', 'range']
+
+def percentile(values, pct):
+    '''The pct percentile of values (nearest rank)'''
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)]
+
+class Benchmark(object):
+    '''
+    Benchmark one controller class against its simulator.
+
+    Args:
+        controller (str): "Espec", "EspecSCP220", "WatlowF4T" or "WatlowF4"
+        interface (str): "TCP" or "Serial" (modbus RTU for the Watlow controllers, on a pty)
+    Kwargs:
+        iterations (int): calls made by each case (default=20)
+        latency (float): simulated processing time of each request in seconds (default=0)
+        baud (int): simulated serial baud rate, None for instant transmission (default=None)
+        loops (int): number of control loops (default=2 for Espec, 1 for Watlow)
+        cascades (int): number of cascade loops (default=0)
+        persistent (bool): keep the connection open between calls (default=True)
+        steps (int): number of steps in the benchmarked program (default=10)
+    '''
+
+    def __init__(self, controller='WatlowF4T', interface='TCP', **kwargs):
+        self.controller = controller
+        self.interface = interface
+        self.iterations = kwargs.get('iterations', 20)
+        self.steps = kwargs.get('steps', 10)
+        espec = controller.startswith('Espec')
+        loops = kwargs.get('loops', 2 if espec else 1)
+        cascades = kwargs.get('cascades', 0)
+        args = {'loops':loops, 'cascades':cascades, 'persistent':kwargs.get('persistent', True)}
+        if espec:
+            ctlr_type = 'SCP220' if controller == 'EspecSCP220' else 'P300'
+            chamber = EspecChamber(ctlr_type=ctlr_type, humidity=loops + cascades > 1,
+                                   ptc=cascades > 0, latency=kwargs.get('latency', 0))
+            self.sim = EspecSimulator(chamber, baud=kwargs.get('baud'))
+            args['ctlr_type'] = ctlr_type
+            cls = Espec
+        else:
+            device = (WatlowF4TDevice if controller == 'WatlowF4T' else WatlowF4Device)(
+                loops=loops, cascades=cascades
+            )
+            self.sim = ModbusSimulator(device, latency=kwargs.get('latency', 0),
+                                       baud=kwargs.get('baud'))
+            cls = WatlowF4T if controller == 'WatlowF4T' else WatlowF4
+            if controller == 'WatlowF4T':
+                args['profiles'] = True
+        if interface == 'TCP':
+            args['host'], args['port'] = self.sim.serve_tcp()
+            args['interface'] = 'TCP'
+        else:
+            args['serialport'] = self.sim.serve_pty()
+            args['baudrate'] = kwargs.get('baud') or 38400
+            args['interface'] = 'Serial' if espec else 'RTU'
+        self.ctlr = cls(**args)
+        self.ctlr.process_controller()
+        self.program = self._make_program()
+
+    def close(self):
+        '''Close the controller and stop the simulator'''
+        try:
+            self.ctlr.connection.drop()
+        finally:
+            self.sim.close()
+
+    def _make_program(self):
+        '''Store a program of self.steps steps as program 1, returns it'''
+        program = self.ctlr.get_prgm(0)
+        step = copy.deepcopy(program['steps'][0])
+        if 'type' in step:
+            step['type'] = 'soak'
+        if 'duration' in step:
+            step['duration'] = {'hours':1, 'minutes':0, 'seconds':0}
+        steps = [copy.deepcopy(step) for _ in range(self.steps - 1)]
+        if self.controller == 'WatlowF4T':
+            step['type'] = 'end'
+            for loop in step['loops']:
+                loop['mode'] = 'hold'
+        elif self.controller == 'WatlowF4':
+            step = program['steps'][0] #the template is a single end step
+        program['steps'] = steps + [step]
+        program['name'] = 'BENCHMARK'
+        self.ctlr.set_prgm(1, program)
+        return self.ctlr.get_prgm(1)
+
+    def state(self, state):
+        '''Put the chamber into a state: "standby", "constant" or "program" (program 1 running)'''
+        if state == 'program':
+            if not self.ctlr.get_status().startswith('Program'):
+                self.ctlr.prgm_start(1, 1)
+        elif state == 'constant':
+            self.ctlr.const_start()
+        else:
+            self.ctlr.stop()
+
+    def cases(self):
+        '''
+        The benchmark cases
+
+        Returns:
+            list. [(name, state, function, args, kwargs)]
+        '''
+        ctlr, ret = self.ctlr, []
+        for count in range(len(SAMPLE_FLAGS) + 1):
+            for flags in itertools.combinations(SAMPLE_FLAGS, count):
+                name = 'sample(%s)' % ','.join(flag[0][4:] for flag in flags)
+                ret.append((name, 'program', ctlr.sample, (), dict(flags)))
+        tmap = ctlr.loop_map[0]
+        ret += [
+            ('get_loop(%s)' % tmap['type'], 'constant', ctlr.get_loop,
+             (tmap['num'], tmap['type'], LOOP_ITEMS), {}),
+            ('get_operation(constant)', 'constant', ctlr.get_operation, (), {}),
+            ('get_operation(program)', 'program', ctlr.get_operation, (), {}),
+            ('set_prgm', 'standby', ctlr.set_prgm, (1, self.program), {}),
+            ('get_prgm', 'standby', ctlr.get_prgm, (1,), {}),
+            ('get_prgms', 'standby', ctlr.get_prgms, (), {})
+        ]
+        return ret
+
+    def measure(self, name, func, *args, **kwargs):
+        '''
+        Call func(*args, **kwargs) self.iterations times
+
+        Returns:
+            dict. name, calls, rate (calls/s), p50/p90/p99/max (ms), transactions and bytes
+                  (per call)
+        '''
+        before = dict(self.sim.stats)
+        times = []
+        for _ in range(self.iterations):
+            start = time.time()
+            func(*args, **copy.deepcopy(kwargs))
+            times.append(time.time() - start)
+        after = dict(self.sim.stats)
+        calls = float(len(times))
+        traffic = lambda stats: stats['bytes_in'] + stats['bytes_out']
+        return {
+            'name':name,
+            'calls':len(times),
+            'rate':calls / sum(times) if sum(times) else float('inf'),
+            'p50':percentile(times, 50) * 1000,
+            'p90':percentile(times, 90) * 1000,
+            'p99':percentile(times, 99) * 1000,
+            'max':max(times) * 1000,
+            'transactions':(after['requests'] - before['requests']) / calls,
+            'bytes':(traffic(after) - traffic(before)) / calls
+        }
+
+    def run(self, pattern=None):
+        '''
+        Run the benchmark cases
+
+        Args:
+            pattern (str): only run the cases whose name matches this regular expression
+        Returns:
+            list. the results of each case (see measure)
+        '''
+        results = []
+        for name, state, func, args, kwargs in self.cases():
+            if pattern and not re.search(pattern, name):
+                continue
+            self.state(state)
+            results.append(self.measure(name, func, *args, **kwargs))
+        return results
+
+def format_results(title, results):
+    '''Format benchmark results as a table'''
+    head = '%-58s %9s %8s %8s %8s %8s %7s %8s' % (title, 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                 'max ms', 'txn', 'bytes')
+    lines = [head, '-' * len(head)]
+    for res in results:
+        lines.append('%-58s %9.1f %8.2f %8.2f %8.2f %8.2f %7.1f %8.0f' % (
+            res['name'], res['rate'], res['p50'], res['p90'], res['p99'], res['max'],
+            res['transactions'], res['bytes']
+        ))
+    return '\n'.join(lines)
+
+def check_budget(key, results, budget):
+    '''
+    Compare the transactions per call of each case against a budget
+
+    Args:
+        key (str): the budget section ("controller/interface")
+        results (list): results from Benchmark.run
+        budget (dict): {"controller/interface":{"case name":max transactions per call}}
+    Returns:
+        list. a message for each case over its budget
+    '''
+    limits = budget.get(key, {})
+    return ['%s %s: %.1f transactions per call, budget %s' % (key, res['name'],
+                                                              res['transactions'],
+                                                              limits[res['name']])
+            for res in results
+            if res['name'] in limits and res['transactions'] > limits[res['name']]]
+
+def main(argv=None):
+    '''
+    Run the benchmark from the command line
+
+    Returns:
+        int. 0 on success, 1 if a case went over its transaction budget
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the chamberconnectlibrary controller '
+                                     'classes against simulated controllers')
+    parser.add_argument('--controller', action='append', choices=CONTROLLERS,
+                        help='controller to benchmark (repeatable, default=all)')
+    parser.add_argument('--interface', choices=['TCP', 'Serial'], action='append',
+                        help='interface to benchmark (repeatable, default=TCP)')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0, help='simulated processing time')
+    parser.add_argument('--baud', type=int, help='simulated serial baud rate')
+    parser.add_argument('--loops', type=int)
+    parser.add_argument('--cascades', type=int, default=0)
+    parser.add_argument('--cases', help='only run cases matching this regular expression')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    parser.add_argument('--budget', help='json file of transactions allowed per call')
+    parser.add_argument('--write-budget', help='save the transactions per call to this file')
+    args = parser.parse_args(argv)
+    kwargs = {'iterations':args.iterations, 'latency':args.latency, 'baud':args.baud,
+              'cascades':args.cascades}
+    if args.loops is not None:
+        kwargs['loops'] = args.loops
+    budget = json.load(open(args.budget)) if args.budget else {}
+    output, failures = {}, []
+    for controller in args.controller or CONTROLLERS:
+        for interface in args.interface or ['TCP']:
+            key = '%s/%s' % (controller, interface)
+            bench = Benchmark(controller, interface, **kwargs)
+            try:
+                results = bench.run(args.cases)
+            finally:
+                bench.close()
+            output[key] = results
+            failures += check_budget(key, results, budget)
+            if not args.json:
+                print format_results(key, results) + '\n'
+    if args.json:
+        print json.dumps(output, **JSON_FORMAT)
+    if args.write_budget:
+        budget = dict((key, dict((res['name'], int(math.ceil(res['transactions'])))
+                                 for res in results))
+                      for key, results in output.items())
+        with open(args.write_budget, 'w') as bfile:
+            json.dump(budget, bfile, **JSON_FORMAT)
+            bfile.write('\n')
+    for failure in failures:
+        print 'OVER BUDGET: ' + failure
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,312 @@
+﻿'''
+Record the traffic of a transport to a capture file and serve it back (see modbus.ModbusReplay and
+especinteract.EspecReplay) so that a session seen in the field can be profiled and benchmarked
+offline::
+
+    ctlr = WatlowF4T(interface='TCP', host='10.0.0.5', record='site.capture.gz')
+    ...
+    ctlr = WatlowF4T(interface='Replay', capture='site.capture.gz', replay_speed=10)
+
+A capture is a header line followed by one line for each request and response, as json. Each
+line holds the start of the exchange (seconds since the first), its duration and the request and
+response (hex for modbus, text for espec) or the kind and message of the error it raised. The file
+is gzipped when its name ends in ".gz".
+
+Exchanges are timed from the request being sent to its response being read. Transports that
+hand a whole batch of requests to another object (ie. a unit on a shared bus) can only be timed
+by batch, the lines of such a batch all hold the start and duration of the batch and the number
+of requests in it ("b").
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import binascii
+import collections
+import datetime
+import gzip
+import itertools
+import json
+import threading
+import time
+from chamberconnectlibrary.modbus import Modbus, ModbusTCP
+from chamberconnectlibrary.especinteract import EspecTransport
+
+FORMAT = 'chamberconnectlibrary-capture'
+VERSION = 1
+
+def _open(path, mode):
+    '''Open a capture file (gzipped if the name ends in .gz)'''
+    return gzip.open(path, mode) if path.endswith('.gz') else open(path, mode)
+
+def _encode(transport, data):
+    '''Encode a request/response for the capture file'''
+    return binascii.hexlify(bytes(data)) if transport == 'modbus' else data
+
+def _decode(transport, data):
+    '''Decode a request/response from the capture file'''
+    return binascii.unhexlify(data) if transport == 'modbus' else str(data)
+
+class CaptureWriter(object):
+    '''
+    Write exchanges to a capture file, one writer may be shared by the transports made for one
+    device (ie. one per connection) so that the whole session is kept in one file.
+
+    Args:
+        path (str): the capture file (gzipped if it ends in .gz)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.transport = None
+        self.start = None
+
+    @classmethod
+    def make(cls, record):
+        '''
+        Make a writer from a controller's record kwarg.
+
+        Args:
+            record: a CaptureWriter, a file name or None (do not record)
+        '''
+        if record is None or isinstance(record, CaptureWriter):
+            return record
+        return cls(record)
+
+    def write(self, transport, request, start, duration, response=None, error=None, batch=None):
+        '''
+        Write one exchange.
+
+        Args:
+            transport (str): "modbus" or "espec"
+            request (str): the request
+            start (float): the time the request was sent
+            duration (float): seconds until the response was received (or the error raised)
+            response (str): the response
+            error (Exception): the error raised instead of a response
+            batch (int): the size of the batch the exchange was timed with (see write_batch)
+        '''
+        with self.lock:
+            if self.file is None:
+                self.file = _open(self.path, 'wb')
+                self.transport, self.start = transport, start
+                header = {'format':FORMAT, 'version':VERSION, 'transport':transport,
+                          'created':datetime.datetime.now().isoformat()}
+                self.file.write(json.dumps(header, sort_keys=True) + '\n')
+            elif transport != self.transport:
+                raise ValueError('A capture can only hold the traffic of one transport type')
+            line = {'t':round(start - self.start, 6), 'd':round(duration, 6),
+                    'q':_encode(transport, request)}
+            if error is None:
+                line['r'] = _encode(transport, response)
+            else:
+                line['e'] = getattr(error, 'kind', 'error')
+                line['m'] = str(error)
+            if batch is not None:
+                line['b'] = batch
+            self.file.write(json.dumps(line, sort_keys=True, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def write_batch(self, transport, requests, start, duration, responses=None, error=None):
+        '''
+        Write the exchanges of a batch of requests that was only timed as a whole.
+
+        Args:
+            transport (str): "modbus" or "espec"
+            requests (list): the requests
+            start (float): the time the batch was started
+            duration (float): seconds until the last response was received (or the error raised)
+            responses (list): the responses
+            error (Exception): the error raised instead of the responses
+        '''
+        for i, request in enumerate(requests):
+            self.write(transport, request, start, duration,
+                       None if error is not None else responses[i], error, len(requests))
+
+    def close(self):
+        '''Close the capture file'''
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def record(transport, writer):
+    '''
+    Record every exchange made by a transport (including retries).
+
+    Requests are timed where they are sent and their responses read (ModbusTCP.submit/collect and
+    the _send/_read_line of the espec transports) so each pipelined request has its own timing,
+    when a response fails every request still waiting for one is recorded with the error.
+
+    Args:
+        transport: the transport (Modbus client or EspecSerial/EspecTCP)
+        writer (CaptureWriter): where to write the exchanges
+    Returns:
+        The transport
+    '''
+    sent, sequence = collections.OrderedDict(), itertools.count()
+
+    def sending(kind, func, request, key=None):
+        '''Call func(request) noting when request was sent (under key, default what func returns)'''
+        start = time.time()
+        try:
+            rval = func(request)
+        except Exception as exc:
+            abandon(kind, exc)
+            writer.write(kind, request, start, time.time() - start, error=exc)
+            raise
+        sent[rval if key is None else key] = (request, start)
+        return rval
+
+    def receiving(kind, func, arg, key=None):
+        '''Call func(arg) writing the exchange of the request sent under key (default the first)'''
+        try:
+            response = func(arg)
+        except Exception as exc:
+            abandon(kind, exc)
+            raise
+        request, start = sent.pop(next(iter(sent)) if key is None else key)
+        writer.write(kind, request, start, time.time() - start, response)
+        return response
+
+    def abandon(kind, exc):
+        '''Write the requests still waiting for a response with the error'''
+        now = time.time()
+        for request, start in sent.values():
+            writer.write(kind, request, start, now - start, error=exc)
+        sent.clear()
+
+    def recorded(kind, func, request):
+        '''Call func(request) writing the exchange'''
+        start = time.time()
+        try:
+            response = func(request)
+        except Exception as exc:
+            writer.write(kind, request, start, time.time() - start, error=exc)
+            raise
+        writer.write(kind, request, start, time.time() - start, response)
+        return response
+
+    def recorded_many(kind, func, requests):
+        '''Call func(requests) writing the exchanges as one batch'''
+        start = time.time()
+        try:
+            responses = func(requests)
+        except Exception as exc:
+            writer.write_batch(kind, requests, start, time.time() - start, error=exc)
+            raise
+        writer.write_batch(kind, requests, start, time.time() - start, responses)
+        return responses
+
+    #pylint: disable=W0212
+    if isinstance(transport, ModbusTCP):
+        submit, collect = transport.submit, transport.collect
+        transport.submit = lambda packet: sending('modbus', submit, packet)
+        transport.collect = lambda tid: receiving('modbus', collect, tid, tid)
+    elif isinstance(transport, Modbus):
+        interact, interact_many = transport.interact, transport.interact_many
+        transport.interact = lambda packet: recorded('modbus', interact, packet)
+        # the default interact_many calls interact, which is already recorded
+        if type(transport).interact_many.__func__ is not Modbus.interact_many.__func__:
+            transport.interact_many = lambda packets: recorded_many('modbus', interact_many,
+                                                                    packets)
+    elif type(transport)._exchange_many.__func__ is EspecTransport._exchange_many.__func__:
+        send, read_line = transport._send, transport._read_line
+        transport._send = lambda msg: sending('espec', send, msg, next(sequence))
+        transport._read_line = lambda end: receiving('espec', read_line, end)
+    else:
+        exchange = transport._exchange_many
+        transport._exchange_many = lambda messages: recorded_many('espec', exchange, messages)
+    return transport
+
+class Capture(object):
+    '''
+    A capture file loaded for replay.
+
+    By default responses are looked up by request: the recorded responses to a request are
+    served in turn, the last one is repeated once they run out. With strict=True the requests
+    must be made in exactly the recorded order.
+
+    Args:
+        path (str): the capture file
+    Kwargs:
+        speed (float): how fast to replay, 1 takes the recorded time for each response, 10 is ten
+                       times faster, 0 responds immediately (default=1)
+        strict (bool): the requests must match the recording in order (default=False)
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.speed = kwargs.get('speed', 1)
+        self.strict = kwargs.get('strict', False)
+        self.lock = threading.Lock()
+        with _open(path, 'rb') as cfile:
+            header = json.loads(cfile.readline())
+            if header.get('format') != FORMAT:
+                raise ValueError('"%s" is not a capture file' % path)
+            self.transport = header['transport']
+            self.records = []
+            for line in cfile:
+                if line.strip():
+                    rec = json.loads(line)
+                    rec['q'] = _decode(self.transport, rec['q'])
+                    if 'r' in rec:
+                        rec['r'] = _decode(self.transport, rec['r'])
+                    self.records.append(rec)
+        self.rewind()
+
+    @classmethod
+    def make(cls, capture, **kwargs):
+        '''
+        Make a capture from a controller's capture kwarg.
+
+        Args:
+            capture: a Capture, a file name or None
+        '''
+        if capture is None or isinstance(capture, Capture):
+            return capture
+        return cls(capture, **kwargs)
+
+    def rewind(self):
+        '''Start serving the recorded responses from the beginning'''
+        with self.lock:
+            self.position = 0
+            self.replies = collections.defaultdict(collections.deque)
+            self.last = {}
+            for rec in self.records:
+                self.replies[rec['q']].append(rec)
+
+    def lookup(self, request):
+        '''
+        The record of the response to a request (without waiting)
+
+        Returns:
+            dict. the record (see module docstring), None if the request was not captured
+        '''
+        with self.lock:
+            if self.strict:
+                if self.position >= len(self.records):
+                    return None
+                rec = self.records[self.position]
+                if rec['q'] != request:
+                    return None
+                self.position += 1
+                return rec
+            queue = self.replies.get(request)
+            if queue:
+                self.last[request] = queue.popleft()
+            return self.last.get(request)
+
+    def exchange(self, request):
+        '''
+        Replay the response to a request, taking the recorded time (scaled by speed).
+
+        Returns:
+            dict. the record (see module docstring), None if the request was not captured
+        '''
+        rec = self.lookup(request)
+        if rec is not None and self.speed:
+            time.sleep(rec['d'] / rec.get('b', 1) / self.speed)
+        return rec
@@ -6,38 +6,250 @@ Common interface for all All ChamberConnectLibrary upper level interfaces
 '''
 #pylint: disable=W0703,W0201,R0902,W0232,R0904,C0103
 from abc import ABCMeta, abstractmethod
-from threading import RLock
+from threading import RLock, Timer, current_thread
+from contextlib import contextmanager
+import atexit
 import traceback
 import time
 import inspect
+import weakref
+from chamberconnectlibrary.retrypolicy import CircuitBreaker
+from chamberconnectlibrary.capture import Capture, CaptureWriter, record
+from chamberconnectlibrary.tracer import Tracer
+from chamberconnectlibrary.instrumentation import Instrumentation
+from chamberconnectlibrary import deadline
 
 class ControllerInterfaceError(Exception):
     '''Exception that is thrown when a there is a problem communicating with a controller'''
     pass
 
-def exclusive(func):
-    '''Lock the physical interface for the function call'''
-    def wrapper(self, *args, **kwargs):
-        '''Lock the physical interface for the function call'''
-        if kwargs.pop('exclusive', True):
-            with self.lock:
-                auto_connect = self.client is None
-                try:
-                    if auto_connect:
-                        self.connect()
-                    return func(self, *args, **kwargs)
-                finally:
-                    try:
-                        if auto_connect:
-                            self.close()
-                    except Exception:
-                        pass
+def connection_error(exc):
+    '''
+    Check if an exception raised during a call means the connection may no longer be usable.
+
+    Args:
+        exc (Exception): the exception
+    Returns:
+        bool. False for usage errors and errors reported by the controller itself (exceptions with
+        a code such as a modbus exception response, or of kind exception/busy see retrypolicy)
+    '''
+    usage = (ControllerInterfaceError, ValueError, TypeError, KeyError, IndexError,
+             NotImplementedError)
+    if isinstance(exc, usage) or getattr(exc, 'kind', None) in ['exception', 'busy']:
+        return False
+    return getattr(exc, 'code', None) is None
+
+#every ConnectionManager, their timers are stopped and connections closed at exit
+_MANAGERS = weakref.WeakSet()
+
+@atexit.register
+def _close_managers():
+    '''Close every connection manager (see ConnectionManager.close)'''
+    for manager in list(_MANAGERS):
+        manager.close()
+
+class ConnectionManager(object):
+    '''
+    Manage the connection to a controller for the exclusive decorator.
+
+    By default the controller is connected before and closed after each call (unless it was
+    connected by the user). With persistent=True the connection is left open between calls, it is
+    closed after idle_timeout seconds without use and exercised every keepalive seconds while idle.
+    A connection that fails is dropped and reopened by the next call, repeated failures to open a
+    persistent connection are spaced out with an exponential backoff (a call made before the next
+    attempt is due fails without connecting). The timer is stopped and the connection closed by
+    close(), which is called for every manager at exit.
+
+    Args:
+        ctlr (ControllerInterface): the controller to manage
+    Kwargs:
+        persistent (bool): keep the connection open between calls (default=False)
+        idle_timeout (float): close a persistent connection after this many seconds without use,
+                              None = never (default=60)
+        keepalive (float): seconds between keepalive() calls while idle, None = off (default=None)
+        backoff (float): delay before the first reconnect attempt after a failure, persistent
+                         only (default=0.5)
+        max_backoff (float): the maximum delay between reconnect attempts (default=30)
+    '''
+
+    def __init__(self, ctlr, **kwargs):
+        self.ctlr = ctlr
+        self.persistent = kwargs.get('persistent', False)
+        self.idle_timeout = kwargs.get('idle_timeout', 60)
+        self.keepalive = kwargs.get('keepalive')
+        self.backoff = kwargs.get('backoff', 0.5)
+        self.max_backoff = kwargs.get('max_backoff', 30)
+        self.owned = False
+        self.sessions = 0
+        self.failures = 0
+        self.retry_at = 0
+        self.last_used = 0
+        self.last_keepalive = 0
+        self.timer = None
+        self.connects, self.connect_errors, self.drops = 0, 0, 0
+        _MANAGERS.add(self)
+
+    def acquire(self):
+        '''
+        Connect the controller if it is not connected (call with the controller's lock held).
+
+        Raises:
+            ControllerInterfaceError if still waiting out the backoff from a failed persistent
+            connection
+        '''
+        if self.ctlr.client is not None:
+            return
+        now = time.time()
+        if self.persistent and now < self.retry_at:
+            ttp = (self.failures, self.retry_at - now)
+            raise ControllerInterfaceError('Connecting failed %d time(s), retry in %.1fs' % ttp)
+        try:
+            self.ctlr.connect()
+        except Exception:
+            self.ctlr.client = None
+            self.failures += 1
+            self.connect_errors += 1
+            self.retry_at = now + min(self.max_backoff, self.backoff * 2**(self.failures - 1))
+            raise
+        self.failures, self.retry_at, self.owned = 0, 0, True
+        self.connects += 1
+
+    def release(self, error=None):
+        '''
+        Finish using the connection (call with the controller's lock held).
+
+        Args:
+            error (Exception): the exception raised while using the connection (if any)
+        '''
+        self.last_used = time.time()
+        if not self.owned:
+            return
+        if error is not None and connection_error(error):
+            self.drop()
+        elif not (self.persistent or self.sessions):
+            self.drop()
         else:
+            self._arm()
+
+    def drop(self):
+        '''
+        Close the connection (if it was opened by the manager)
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.owned:
+            self.owned = False
+            self.drops += 1
             try:
-                del kwargs['exclusive']
+                self.ctlr.close()
             except Exception:
                 pass
-            return func(self, *args, **kwargs)
+            self.ctlr.client = None
+
+    def close(self):
+        '''
+        Stop the idle timeout/keepalive timer and close the connection (if it was opened by the
+        manager), the controller connects again on its next call.
+        '''
+        with self.ctlr.lock:
+            timer = self.timer
+            self.drop()
+        if timer is not None and timer is not current_thread():
+            timer.join()
+
+    @contextmanager
+    def session(self):
+        '''
+        Hold the controller's lock and keep it connected for the duration of a with block.
+        '''
+        with self.ctlr.lock:
+            self.sessions += 1
+            error = None
+            try:
+                self.acquire()
+                yield self.ctlr
+            except Exception as exc:
+                error = exc
+                raise
+            finally:
+                self.sessions -= 1
+                self.release(error)
+
+    def _arm(self):
+        '''Start the timer for the next idle timeout or keepalive check'''
+        if self.timer is not None:
+            return
+        now, waits = time.time(), []
+        if self.idle_timeout and not self.sessions:
+            waits.append(self.last_used + self.idle_timeout - now)
+        if self.keepalive:
+            waits.append(max(self.last_used, self.last_keepalive) + self.keepalive - now)
+        if waits:
+            self.timer = Timer(max(0.01, min(waits)), self._on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _on_timer(self):
+        '''Close an idle connection or keep it alive'''
+        with self.ctlr.lock:
+            if self.timer is not current_thread():
+                return #cancelled (or replaced) while waiting for the lock
+            self.timer = None
+            if not self.owned:
+                return
+            now = time.time()
+            if self.idle_timeout and not self.sessions and \
+               now - self.last_used >= self.idle_timeout:
+                self.drop()
+                return
+            if self.keepalive and now - max(self.last_used, self.last_keepalive) >= self.keepalive:
+                try:
+                    self.ctlr.keepalive()
+                except Exception as exc:
+                    if connection_error(exc):
+                        self.drop()
+                        return
+                self.last_keepalive = time.time()
+            self._arm()
+
+def locked_call(ctlr, func, args, kwargs, record=None):
+    '''
+    Call func with the controller locked and connected (see exclusive), the time spent waiting
+    for the lock is added to the record of an instrumented call.
+    '''
+    waited = time.time()
+    with ctlr.lock:
+        if record is not None:
+            record['lock_wait'] += time.time() - waited
+        deadline.check(ControllerInterfaceError)
+        error = None
+        try:
+            ctlr.connection.acquire()
+            return func(ctlr, *args, **kwargs)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            ctlr.connection.release(error)
+
+def exclusive(func):
+    '''
+    Lock the physical interface for the function call.
+
+    The call may be given a time budget in seconds with the budget kwarg (default the controller's
+    budget), every transaction made by the call shares it (see deadline). Calls to an instrumented
+    controller are timed and their bus transactions counted (see instrumentation).
+    '''
+    def wrapper(self, *args, **kwargs):
+        '''Lock the physical interface for the function call'''
+        with deadline.budget(kwargs.pop('budget', self.budget)):
+            if not kwargs.pop('exclusive', True):
+                return func(self, *args, **kwargs)
+            if self.instrumentation is None:
+                return locked_call(self, func, args, kwargs)
+            with self.instrumentation.call(func.__name__, self) as record:
+                return locked_call(self, func, args, kwargs, record)
     return wrapper
 
 class ControllerInterface:
@@ -51,13 +263,69 @@ class ControllerInterface:
         '''Setup properties of all controllers of the chamberconnectlibrary'''
         self.client = None
         self.host = kwargs.get('host')
+        self.port = kwargs.get('port')
         self.interface = kwargs.get('interface')
         self.adr = kwargs.get('adr', 1)
         self.serialport = kwargs.get('serialport')
         self.baudrate = kwargs.get('baudrate')
+        self.bus = kwargs.get('bus')
+        self.retry = kwargs.get('retry', False)
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+        self.budget = kwargs.get('budget')
+        self.record = CaptureWriter.make(kwargs.get('record'))
+        self.capture = Capture.make(kwargs.get('capture'), speed=kwargs.get('replay_speed', 1))
+        self.tracer = Tracer.make(kwargs.get('trace'))
+        self.instrumentation = Instrumentation.make(kwargs.get('instrument'), self.tracer)
         self.loops = kwargs.get('loops', 1)
         self.cascades = kwargs.get('cascades', 0)
         self.lock = kwargs.get('lock', RLock())
+        self.connection = ConnectionManager(self, **kwargs)
+
+    def session(self):
+        '''
+        Keep the controller locked and connected for the duration of a with block::
+
+            with controller.session():
+                controller.set_loop_sp(1, 50.0)
+                controller.get_loop_pv(1)
+
+        Returns:
+            context manager (yields the controller)
+        '''
+        return self.connection.session()
+
+    def observe(self, transport):
+        '''
+        Record and trace the traffic of a newly connected transport per the record and trace
+        kwargs (see capture and tracer), called by connect().
+
+        Args:
+            transport: the Modbus client or EspecSerial/EspecTCP
+        '''
+        if self.record is not None:
+            record(transport, self.record)
+        if self.tracer is not None:
+            record(transport, self.tracer.writer(transport))
+
+    def stats(self, reset=False):
+        '''
+        The statistics of the calls made to each method of an instrumented controller (see
+        instrumentation), empty if the controller was not made with instrument=True.
+
+        Kwargs:
+            reset (bool): start counting again from zero (default=False)
+        Returns:
+            dict. {method:{calls, errors, wall, lock_wait, transactions, sent, received, retries}}
+        '''
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.stats(reset)
+
+    def keepalive(self):
+        '''
+        Exercise an idle persistent connection (see ConnectionManager), reads the controller time.
+        '''
+        self.get_datetime(exclusive=False)
 
     @abstractmethod
     def get_datetime(self):
@@ -327,7 +595,7 @@ class ControllerInterface:
             pnum = self.get_prgm_cur(exclusive=False)
             ret['program'] = {
                 'number':pnum,
-                'step':self.get_prgm_cstep(),
+                'step':self.get_prgm_cstep(exclusive=False),
                 'time_remaining':self.get_prgm_time(pgm, exclusive=False),
                 'step_time_remaining':self.get_prgm_cstime(exclusive=False),
                 'name':self.get_prgm_name(pnum, exclusive=False),
@@ -1043,8 +1311,10 @@ class ControllerInterface:
                 items = ['setpoint', 'processvalue', 'enable', 'mode', 'power', 'units', 'range']
                 if tmap['type'] == 'cascade':
                     items += ['enable_cascade', 'deviation']
-                lkps = [lkp for lkp in lookup[tmap['type']] if lkp['number'] == tmap['num']]
-                lpdata = lkps[0].copy() if lookup else {}
+                lpdata = {}
+                if lookup:
+                    lkps = [lkp for lkp in lookup[tmap['type']] if lkp['number'] == tmap['num']]
+                    lpdata = lkps[0].copy()
                 lpdata.update(self.get_loop(tmap['num'], tmap['type'], items, exclusive=False))
                 ret['loops'].append(lpdata)
         if kwargs.get('get_status', True) or kwargs.get('get_program_status', False):
@@ -0,0 +1,102 @@
+﻿'''
+Time budgets for a sequence of transactions.
+
+A budget is set for the calling thread with a with block (the exclusive decorator does this for
+the budget kwarg of every controller method)::
+
+    with deadline.budget(2.0):
+        client.read_holding(2782)
+        client.read_holding(2810)
+
+Transports limit the time they wait for each response to what is left of the budget and
+refuse to start a transaction once it has run out, the error raised has kind='deadline' (see
+retrypolicy) so it is neither retried nor counted against the device by a circuit breaker.
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+import threading
+import time
+from contextlib import contextmanager
+
+LOCAL = threading.local()
+
+def current():
+    '''The deadline (a time.time() value) of the calling thread, None if it has no budget'''
+    return getattr(LOCAL, 'deadline', None)
+
+@contextmanager
+def until(when):
+    '''
+    Set the deadline of the calling thread for the duration of a with block, a nested deadline
+    can only shorten the enclosing one.
+
+    Args:
+        when (float): the time.time() by which to finish, None = no (additional) deadline
+    '''
+    previous = current()
+    if when is not None and previous is not None:
+        when = min(when, previous)
+    LOCAL.deadline = previous if when is None else when
+    try:
+        yield
+    finally:
+        LOCAL.deadline = previous
+
+def budget(seconds):
+    '''
+    Set a time budget for the duration of a with block (see until)
+
+    Args:
+        seconds (float): the budget, None = no budget
+    '''
+    return until(None if seconds is None else time.time() + seconds)
+
+def remaining():
+    '''Seconds left before the deadline, None if there is no deadline'''
+    when = current()
+    return None if when is None else max(0.0, when - time.time())
+
+def expired():
+    '''True if the calling thread has a deadline and it has passed'''
+    when = current()
+    return when is not None and time.time() >= when
+
+def timeout(default):
+    '''
+    The time to wait for a response: default limited to what is left of the budget
+
+    Args:
+        default (float): the transport's timeout (None = wait forever)
+    '''
+    left = remaining()
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
+
+def timed_out(error, message):
+    '''
+    Make the exception for a wait that ran out of time, it has kind='deadline' if the budget ran
+    out rather than the transport's timeout.
+
+    Args:
+        error (class): the transport's timeout exception
+        message (str): description of the wait
+    '''
+    if expired():
+        exc = error('%s (the time budget ran out)' % message)
+        exc.kind = 'deadline'
+        return exc
+    return error(message)
+
+def check(error):
+    '''
+    Raise error (with kind='deadline') if the budget has run out
+
+    Args:
+        error (class): the transport's timeout exception
+    '''
+    if expired():
+        exc = error('The time budget ran out before the request was sent')
+        exc.kind = 'deadline'
+        raise exc
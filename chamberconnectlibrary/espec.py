@@ -21,13 +21,30 @@ class Espec(ControllerInterface):
         interface (str): The connection method::
             "TCP" -- Use a Ethernet to serial adapter with raw TCP
             "Serial" -- Use a hardware serial port
+            "Replay" -- Replay a capture file (see capture kwarg)
         adr (int): The address of the controller (default=1)
         host (str): The hostname (IP address) of the controller when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=10001)
         serialport (str): The serial port to use when interface="Serial" (default=3(COM4))
         baudrate (int): The serial port's baud rate to use when interface="Serial" (default=9600)
+        bus (EspecBus): A shared RS-485 line (on a serial port or a TCP forwarder) to use instead
+                        of serialport/host, requests are prefixed with adr
         loops (int): The number of control loops the controller has (default=1, max=2)
         cascades (int): The number of cascade control loops the controller has (default=0, max=1)
         lock (RLock): The locking method to use when accessing the controller (default=RLock())
+        persistent (bool): Keep the connection open between calls (default=False)
+        idle_timeout (float): Close a persistent connection after seconds unused (default=60)
+        keepalive (float): Seconds between keepalives when persistent and idle (default=None)
+        retry (RetryPolicy/bool): Retries by kind of error, see retrypolicy (default=False)
+        breaker (CircuitBreaker/bool): Fail fast while the controller is offline (default=None)
+        budget (float): Default time budget in seconds for each call, None=unlimited (default=None)
+        record (str/CaptureWriter): Record the traffic to this capture file, see capture
+        capture (str/Capture): The capture file to replay when interface="Replay"
+        replay_speed (float): Replay speed, 1=as recorded, 0=no delays (default=1)
+        instrument (bool/callable): Per method call statistics, see stats() (default=None)
+        trace (str/Tracer): Trace the calls and transactions to this file, see tracer
+        pipeline (int): Requests sent ahead of their responses, 1 to wait for each response before
+                        sending the next request (default=1)
         freshness (int): The length of time (in seconds) a command is cached (default = 0)
         ctlr_type (str): "SCP220" or "P300" (default = "P300")
     '''
@@ -36,7 +53,10 @@ class Espec(ControllerInterface):
         self.client, self.loops, self.cascades = None, None, None
         self.init_common(**kwargs)
         self.freshness = kwargs.get('freshness', 0)
+        self.pipeline = kwargs.get('pipeline')
+        self.sample_queries = {}
         self.cache = {}
+        self.cache_hits, self.cache_misses = 0, 0
         self.temp, self.humi = 1, 2
         self.lpd = {
             'temp':self.temp,
@@ -79,13 +99,17 @@ class Espec(ControllerInterface):
         connect to the controller using the paramters provided on class initialization
         '''
         args = {'serialport':self.serialport, 'baudrate':self.baudrate, 'host':self.host,
-                'address':self.adr}
+                'port':self.port, 'address':self.adr, 'retry':self.retry,
+                'breaker':self.breaker, 'capture':self.capture, 'depth':self.pipeline}
+        if self.bus is not None and self.interface != 'Replay':
+            args['transport'] = self.bus.client(self.adr, retry=self.retry, breaker=self.breaker)
         if self.ctlr_type == 'P300':
             self.client = P300(self.interface, **args)
         elif self.ctlr_type == 'SCP220':
             self.client = SCP220(self.interface, **args)
         else:
             raise ValueError('"%s" is not a supported controller type' % self.ctlr_type)
+        self.observe(self.client.ctlr)
 
     def close(self):
         '''
@@ -105,7 +129,10 @@ class Espec(ControllerInterface):
         now = time.time()
         incache = func.__name__ not in self.cache
         if incache or (now - self.cache[func.__name__]['timestamp'] > self.freshness):
+            self.cache_misses += 1
             self.cache[func.__name__] = {'timestamp':now, 'values':func(*args, **kwargs)}
+        else:
+            self.cache_hits += 1
         return self.cache[func.__name__]['values']
 
     @exclusive
@@ -658,6 +685,21 @@ class Espec(ControllerInterface):
         self.client.write_prgm_erase(N)
 
 
+    @exclusive
+    def sample(self, lookup=None, **kwargs):
+        '''
+        Take a sample for data logging (see ControllerInterface.sample).
+
+        The queries made by the last sample taken with the same kwargs are sent ahead pipelined
+        and each query is only sent once per sample.
+        '''
+        key = repr(sorted(kwargs.items()))
+        try:
+            self.client.ctlr.prefetch(self.sample_queries.get(key, []))
+            return super(Espec, self).sample(lookup, exclusive=False, **kwargs)
+        finally:
+            self.sample_queries[key] = self.client.ctlr.end_prefetch()
+
     @exclusive
     def process_controller(self, update=True):
         if update:
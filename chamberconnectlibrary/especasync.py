@@ -0,0 +1,349 @@
+﻿'''
+Non-blocking versions of the espec serial and TCP transports and of the P300/SCP-220 protocol for
+the eventloop module.
+
+Every method returns a Future (from a coroutine) instead of blocking, so a single thread may talk
+to many chambers at once::
+
+    loop = get_event_loop()
+    chambers = [AsyncP300('TCP', host=host) for host in hosts]
+    temps = loop.run_until_complete(gather(*[chamber.read_temp() for chamber in chambers]))
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import collections
+import copy
+import errno
+import functools
+import socket
+from chamberconnectlibrary.especinteract import EspecSerial, EspecTCP, EspecError
+from chamberconnectlibrary.especinteract import EspecTimeoutError, na_error
+from chamberconnectlibrary.eventloop import Future, Return, coroutine, gather, get_event_loop
+from chamberconnectlibrary.eventloop import sleep
+from chamberconnectlibrary.p300 import P300
+from chamberconnectlibrary.scp220 import SCP220
+
+class AsyncEspec(object):
+    '''
+    Coroutine version of interact, mixed in ahead of an espec transport.
+
+    Messages from any number of coroutines are queued and sent in order, up to depth of them
+    ahead of the response being read (the protocol has no request ids, responses arrive in the
+    order the requests were sent). When a response does not arrive within timeout every request
+    sent is failed and what arrives late is discarded.
+    '''
+
+    def _start(self, fdesc):
+        '''Start reading the transport's file descriptor on the loop'''
+        self.loop = get_event_loop()
+        self.queue = collections.deque()
+        self.outstanding = collections.deque()
+        self.timer = None
+        self.fdesc = fdesc
+        self.loop.add_reader(self.fdesc, self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.fdesc)
+        self._fail_all(EspecError('The connection was closed.'))
+        super(AsyncEspec, self).close()
+
+    @coroutine
+    def interact(self, message):
+        '''
+        Send a message (or a list of messages) to the chamber, returns a Future for the response
+        (a list of responses for a list of messages).
+        '''
+        if not isinstance(message, (list, tuple)):
+            message = [message]
+        message = [msg.encode('ascii', 'ignore') for msg in message]
+        recvs = yield self._guarded(lambda: gather(*[self._submit(msg) for msg in message]))
+        for msg, recv in zip(message, recvs):
+            if recv.startswith('NA:'):
+                raise na_error(msg, recv, self.delimeter)
+        recvs = [recv[:-1*len(self.delimeter)] for recv in recvs]
+        raise Return(recvs if len(recvs) > 1 else recvs[0])
+
+    @coroutine
+    def _guarded(self, func):
+        '''
+        Wait for func() (which returns a Future) through the circuit breaker and the retry
+        policy, the waits between retries do not block the loop.
+        '''
+        if self.breaker is not None and not self.breaker.allow():
+            exc = EspecError('The chamber is offline, not retrying for %.1f seconds' %
+                             self.breaker.retry_after())
+            exc.kind = 'offline'
+            raise exc
+        attempt = 0
+        while True:
+            try:
+                rval = yield func()
+            except EspecError as exc:
+                wait = self.retry.delay(exc, attempt)
+                if wait is None:
+                    if self.breaker is not None:
+                        self.breaker.failure(exc)
+                    raise
+                attempt += 1
+                yield sleep(wait)
+            else:
+                if self.breaker is not None:
+                    self.breaker.success()
+                raise Return(rval)
+
+    def _submit(self, msg):
+        '''
+        Queue one message, returns a Future for its response (including the delimeter).
+
+        Cancelling the future abandons the request, if it was already sent its response is
+        still read (and discarded).
+        '''
+        future = Future(self.loop)
+        self.queue.append((msg, future))
+        self._pump()
+        return future
+
+    def _pump(self):
+        '''Send queued requests while fewer than depth are waiting for a response'''
+        if self.flush_input and not self.outstanding:
+            self._flush()
+        while self.queue and len(self.outstanding) < self.depth:
+            msg, future = self.queue.popleft()
+            if future.done():
+                continue
+            try:
+                self._write(self._request(msg))
+            except Exception as exc:
+                future.set_exception(EspecError('Error sending the request: %s' % exc))
+                continue
+            self.outstanding.append(future)
+            if self.timer is None:
+                self.timer = self.loop.call_later(self.timeout, self._on_timeout)
+
+    def _on_timeout(self):
+        self.timer = None
+        outstanding, self.outstanding = self.outstanding, collections.deque()
+        self.flush_input = True
+        for future in outstanding:
+            if not future.done():
+                future.set_exception(EspecTimeoutError('The chamber did not respond in time'))
+        self._pump()
+
+    def _on_readable(self):
+        try:
+            self._fill()
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.loop.remove_reader(self.fdesc)
+            self._fail_all(EspecError('Connection error: %s' % exc))
+            return
+        except Exception as exc:
+            self.loop.remove_reader(self.fdesc)
+            self._fail_all(exc if isinstance(exc, EspecError) else EspecError(str(exc)))
+            return
+        recv = self._take_line()
+        while recv is not None:
+            if self.outstanding:
+                self.timer.cancel()
+                self.timer = None
+                future = self.outstanding.popleft()
+                if not future.done():
+                    future.set_result(recv)
+                if self.outstanding:
+                    self.timer = self.loop.call_later(self.timeout, self._on_timeout)
+            recv = self._take_line()
+        self._pump()
+
+    def _fail_all(self, exc):
+        '''Fail every outstanding and queued request'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        futures = list(self.outstanding) + [future for msg, future in self.queue]
+        self.outstanding.clear()
+        self.queue.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+class AsyncEspecSerial(AsyncEspec, EspecSerial):
+    '''
+    EspecSerial for the event loop, the serial port is read without blocking.
+
+    kwargs:
+        (the EspecSerial kwargs)
+    '''
+
+    def __init__(self, **kwargs):
+        super(AsyncEspecSerial, self).__init__(**kwargs)
+        self.serial.timeout = 0
+        self._start(self.serial.fileno())
+
+    def _write(self, request):
+        self.serial.write(request)
+
+    def _fill(self):
+        '''Read what is waiting on the port into the receive buffer'''
+        self.rxbuf.extend(self.serial.read(self.serial.in_waiting or 1))
+
+    def _take_line(self):
+        '''Take a complete response from the receive buffer, None if there is none yet'''
+        idx = self.rxbuf.find(self.delimeter)
+        if idx < 0:
+            return None
+        idx += len(self.delimeter)
+        recv = str(self.rxbuf[:idx])
+        del self.rxbuf[:idx]
+        return recv
+
+class AsyncEspecTCP(AsyncEspec, EspecTCP):
+    '''
+    EspecTCP for the event loop, the connection itself is made (blocking) when the transport is
+    created.
+
+    kwargs:
+        (the EspecTCP kwargs)
+    '''
+
+    def __init__(self, **kwargs):
+        super(AsyncEspecTCP, self).__init__(**kwargs)
+        self.socket.setblocking(False)
+        self._start(self.socket.fileno())
+
+    def _write(self, request):
+        self.socket.sendall(request)
+
+    def _fill(self):
+        '''Receive what is available on the socket into the receive buffer'''
+        self._recv()
+
+    def _take_line(self):
+        '''Take a complete response from the receive buffer, None if there is none yet'''
+        idx = self.rxbuf.find(self.delimeter, self.rxstart, self.rxend)
+        if idx < 0:
+            return None
+        idx += len(self.delimeter)
+        recv = str(self.rxbuf[self.rxstart:idx])
+        self.rxstart = idx
+        return recv
+
+class _Pending(BaseException):
+    '''A P300 method needs the response to a message that has not been received yet'''
+    def __init__(self, message):
+        super(_Pending, self).__init__(message)
+        self.message = message
+
+class _Script(object):
+    '''Stands in for the transport of a P300, serving the responses received so far'''
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.position = 0
+        self.pending = None
+
+    def interact(self, message):
+        '''The next received response, raises _Pending once they run out'''
+        if self.pending is None and self.position < len(self.responses):
+            error, value = self.responses[self.position]
+            self.position += 1
+            if error:
+                raise value
+            return value
+        if self.pending is None:
+            self.pending = _Pending(message)
+        raise self.pending
+
+class AsyncP300(object):
+    '''
+    Coroutine facade over P300: every read_* and write_* method of P300 (and interact) returns a
+    Future for its result.
+
+    A method is run against the responses received so far, when it needs one more the message is
+    sent and the method is run again from the start once the response arrives. The parsing is the
+    one P300 does, each message is only sent once. Calls on one chamber are made one at a time in
+    the order they were made, as the blocking controllers do.
+
+    Args:
+        interface (str): "Serial" or "TCP"
+    Kwargs:
+        serialport (str/int): The serial port to connect to when interface="Serial"
+        baudrate (int): The baud rate to connect at when interface="Serial"
+        address (int): The RS485 address of the chamber to connect to.
+        host (str): The IP address or hostname of the chamber when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=10001)
+        timeout (float): seconds allowed for each response (default=3)
+        depth (int): requests pipelined ahead of their responses (default=1)
+        retry (RetryPolicy/bool): retry policy of the transport (default=False)
+        breaker (CircuitBreaker): fail fast while the chamber is offline (default=None)
+    '''
+    client_class = P300
+
+    def __init__(self, interface, **kwargs):
+        args = {'address':kwargs.get('address'), 'depth':kwargs.get('depth'),
+                'timeout':kwargs.get('timeout', 3), 'retry':kwargs.get('retry', False),
+                'breaker':kwargs.get('breaker')}
+        if interface == 'Serial':
+            self.ctlr = AsyncEspecSerial(port=kwargs.get('serialport'),
+                                         baud=kwargs.get('baudrate') or 9600, **args)
+        else:
+            self.ctlr = AsyncEspecTCP(host=kwargs.get('host'), port=kwargs.get('port') or 10001,
+                                      **args)
+        self.client = self.client_class(interface, transport=self.ctlr)
+        self.tail = None
+
+    def __getattr__(self, name):
+        if not name.startswith(('read_', 'write_')) or not hasattr(self.client_class, name):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def close(self):
+        '''
+        Close the physical interface
+        '''
+        self.ctlr.close()
+
+    def interact(self, message):
+        '''
+        Send a message (or list of messages), returns a Future for the response
+        '''
+        return self.call('interact', message)
+
+    @coroutine
+    def call(self, name, *args, **kwargs):
+        '''
+        Call a P300 method, returns a Future for its result.
+
+        Args:
+            name (str): the method's name
+        '''
+        previous, done = self.tail, Future(self.ctlr.loop)
+        self.tail = done
+        try:
+            if previous is not None and not previous.done():
+                turn = Future(self.ctlr.loop)
+                previous.add_done_callback(lambda fut: turn.done() or turn.set_result(None))
+                yield turn
+            responses = []
+            while True:
+                client = copy.copy(self.client)
+                client.ctlr = _Script(responses)
+                try:
+                    rval = getattr(client, name)(*copy.deepcopy(args), **copy.deepcopy(kwargs))
+                except _Pending as pending:
+                    try:
+                        responses.append((False, (yield self.ctlr.interact(pending.message))))
+                    except EspecError as exc:
+                        responses.append((True, exc))
+                else:
+                    raise Return(rval)
+        finally:
+            done.set_result(None)
+
+class AsyncSCP220(AsyncP300):
+    '''
+    Coroutine facade over SCP220 (see AsyncP300)
+    '''
+    client_class = SCP220
@@ -8,6 +8,9 @@ Handle the actual communication with Espec Corp. Controllers
 import socket
 import serial
 import time
+from chamberconnectlibrary.retrypolicy import RetryPolicy, CircuitBreaker, guarded
+from chamberconnectlibrary.scheduler import BusScheduler
+from chamberconnectlibrary import deadline, instrumentation
 
 ERROR_DESCIPTIONS = {
     'CMD ERR':'Unrocognized command',
@@ -44,22 +47,169 @@ class EspecError(Exception):
     '''
     Generic Espec Corp controller error
     '''
-    pass
+    kind = 'error'
 
-class EspecSerial(object):
+class EspecTimeoutError(EspecError):
+    '''
+    The chamber did not respond in time
+    '''
+    kind = 'timeout'
+
+#requests sent ahead of the responses to a list of messages by default (see EspecTransport),
+#pipelining is opt-in: not every link can take a request while a response is on its way (ie. a
+#half duplex RS-485 line)
+DEPTH = 1
+
+#how far a serial port's read timeout may be from the time left for a response before the port
+#is reconfigured (setting the timeout is a system call), a read may end this much past the wait
+TIMEOUT_SLACK = 0.05
+
+def na_error(message, recv, delimeter):
+    '''Make the EspecError for an "NA:" response'''
+    errmsg = recv[3:0-len(delimeter)]
+    msg = 'EspecError: command:"%s" genarated Error:"%s"(%s)' % (
+        message, errmsg, ERROR_DESCIPTIONS.get(errmsg, 'missing description')
+    )
+    exc = EspecError(msg)
+    exc.kind = 'exception'
+    return exc
+
+class EspecTransport(object):
+    '''
+    Message handling shared by the espec transports, the subclasses send the requests and read the
+    responses.
+
+    The messages of a list passed to interact are pipelined: up to depth requests are sent before
+    the first response is read, the responses are read in order and an "NA:" response raises the
+    EspecError of its own message once the whole list has been read.
+    '''
+    depth = 1
+    prefetched = None
+    used = None
+    flush_input = False
+
+    def interact(self, message):
+        '''
+        Send a message to the chamber and get its response
+
+        params:
+            message: the message to send (str) or a list of messages
+        returns:
+            string: response from the chamber (a list of responses for a list of messages)
+        raises:
+            EspecError
+        '''
+        if not isinstance(message, (list, tuple)):
+            message = [message]
+        message = [msg.encode('ascii', 'ignore') for msg in message]
+        prefetched = self.prefetched if self.prefetched is not None else {}
+        wire = [msg for msg in message if msg not in prefetched]
+        fetched = iter(self._guarded(wire) if wire else [])
+        recvs = [prefetched[msg] if msg in prefetched else next(fetched) for msg in message]
+        if self.prefetched is not None:
+            if all('?' in msg for msg in wire):
+                self.prefetched.update(zip(message, recvs))
+                self.used += [msg for msg in message if msg not in self.used]
+            else:
+                self.prefetched.clear()
+        for msg, recv in zip(message, recvs):
+            if recv.startswith('NA:'):
+                raise na_error(msg, recv, self.delimeter)
+        recvs = [recv[:-1*len(self.delimeter)] for recv in recvs]
+        return recvs if len(recvs) > 1 else recvs[0]
+
+    def prefetch(self, messages):
+        '''
+        Send queries ahead of their use (pipelined), until end_prefetch is called interact serves
+        their responses, and those of any other query, from memory so each query is sent once.
+        Sending a message that is not a query (has no "?") empties the memory.
+
+        params:
+            messages: the queries to send (list of str)
+        '''
+        if self.prefetched is None:
+            self.prefetched, self.used = {}, []
+        wire = []
+        for msg in messages:
+            msg = msg.encode('ascii', 'ignore')
+            if msg not in self.prefetched and msg not in wire:
+                wire.append(msg)
+        if wire:
+            self.prefetched.update(zip(wire, self._guarded(wire)))
+
+    def end_prefetch(self):
+        '''
+        Forget the prefetched responses
+
+        returns:
+            list: the queries interact was asked for since prefetch, in order
+        '''
+        used = self.used or []
+        self.prefetched, self.used = None, None
+        return used
+
+    def _request(self, msg):
+        '''The request for one message'''
+        return '%s%s' % (msg, self.delimeter)
+
+    def _guarded(self, messages):
+        '''Exchange messages under the retry policy and circuit breaker'''
+        return guarded(self.retry, self.breaker, EspecError, self._exchange_many, messages)
+
+    def _exchange_many(self, messages):
+        '''
+        Send messages and read their responses (including the delimeter), keeping up to depth
+        requests ahead of the response being read.
+        '''
+        if self.flush_input:
+            self._flush()
+        recvs, requests = [], []
+        try:
+            while len(recvs) < len(messages):
+                while len(requests) < len(messages) and len(requests) - len(recvs) < self.depth:
+                    requests.append(self._send(messages[len(requests)]))
+                recv = ''
+                try:
+                    recv = self._read_line(time.time() + deadline.timeout(self.timeout))
+                finally:
+                    instrumentation.count(len(requests[len(recvs)]), len(recv))
+                recvs.append(recv)
+        except socket.timeout:
+            self.flush_input = True
+            raise deadline.timed_out(EspecTimeoutError, 'The chamber did not respond in time')
+        except EspecTimeoutError:
+            self.flush_input = True
+            raise
+        return recvs
+
+class EspecSerial(EspecTransport):
     '''
     Handles low level communication to espec corp controllers via serial (RS232/485)
+
+    kwargs:
+        timeout: float (seconds allowed for each response, limited by the caller's time budget
+                 see deadline, default=3)
+        depth: int (requests sent ahead of the responses to a list of messages, 1 waits for each
+               response before sending the next request, keep 1 on a half duplex RS-485
+               line, default=DEPTH=1)
+        retry: RetryPolicy or bool (see retrypolicy.RetryPolicy.make, default=False)
+        breaker: CircuitBreaker or True (fail fast while the chamber is offline, default=None)
     '''
     def __init__(self, **kwargs):
         self.address = kwargs.get('address', None)
         self.delimeter = kwargs.get('delimeter', '\r\n')
+        self.retry = RetryPolicy.make(kwargs.get('retry', False))
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+        self.timeout = kwargs.get('timeout', 3)
+        self.depth = max(1, kwargs.get('depth') or DEPTH)
+        self.rxbuf = bytearray()
         self.serial = serial.Serial(
             port=kwargs.get('port'),
             baudrate=kwargs.get('baud', 9600),
             bytesize=kwargs.get('databits', 8),
             parity=kwargs.get('parity', 'N'),
             stopbits=kwargs.get('stopbits', 1),
-            timeout=kwargs.get('timeout', 3)
+            timeout=self.timeout
         )
 
     def __del__(self):
@@ -74,51 +224,86 @@ class EspecSerial(object):
         '''
         self.serial.close()
 
-    def interact(self, message):
+    def _request(self, msg):
+        if self.address:
+            return '%d,%s%s'%(self.address, msg, self.delimeter)
+        return '%s%s' % (msg, self.delimeter)
+
+    def _send(self, msg):
+        '''Send the request for one message, returns the request'''
+        request = self._request(msg)
+        self.serial.write(request)
+        return request
+
+    def _flush(self):
+        '''Discard what has been received (ie. the late response to a request that timed out)'''
+        self.serial.reset_input_buffer()
+        del self.rxbuf[:]
+        self.flush_input = False
+
+    def _read_line(self, end):
         '''
-        Send a message to the chamber and get its response
+        Read a response up to and including the delimeter, by end (a time.time() value).
 
-        params:
-            message: the message to send (str)
-        returns:
-            string: response from the chamber
-        raises:
-            EspecError
+        Whatever is waiting on the port is read in one call (at least one byte, blocking no later
+        than end give or take TIMEOUT_SLACK), any bytes after the delimeter are kept for the next
+        response.
         '''
-        if not isinstance(message, (list, tuple)):
-            message = [message]
-        recvs = []
-        for msg in message:
-            msg = msg.encode('ascii', 'ignore')
-            if self.address:
-                self.serial.write('%d,%s%s'%(self.address, msg, self.delimeter))
-            else:
-                self.serial.write('%s%s' % (msg, self.delimeter))
-            recv = ''
-            while recv[0-len(self.delimeter):] != self.delimeter:
-                rbuff = self.serial.read(1)
-                if len(rbuff) == 0:
-                    raise EspecError('The chamber did not respond in time')
-                recv += rbuff
-            if recv.startswith('NA:'):
-                errmsg = recv[3:0-len(self.delimeter)]
-                msg = 'EspecError: command:"%s" genarated Error:"%s"(%s)' % (
-                    message, errmsg, ERROR_DESCIPTIONS.get(errmsg, 'missing description')
-                )
-                raise EspecError(msg)
-            recvs.append(recv[:-1*len(self.delimeter)])
-        return recvs if len(recvs) > 1 else recvs[0]
+        scanned = 0
+        while True:
+            idx = self.rxbuf.find(self.delimeter, scanned)
+            if idx >= 0:
+                idx += len(self.delimeter)
+                recv = str(self.rxbuf[:idx])
+                del self.rxbuf[:idx]
+                return recv
+            scanned = max(0, len(self.rxbuf) - len(self.delimeter) + 1)
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise deadline.timed_out(EspecTimeoutError, 'The chamber did not respond in time')
+            waiting = self.serial.in_waiting
+            if not waiting:
+                #the read blocks, for about what is left of the wait
+                self._set_timeout(remaining)
+            rbuff = self.serial.read(max(1, waiting))
+            self.rxbuf.extend(rbuff)
+
+    def _set_timeout(self, wait):
+        '''Set the serial port's read timeout, unless it is already within TIMEOUT_SLACK of wait'''
+        if self.serial.timeout is None or abs(self.serial.timeout - wait) > TIMEOUT_SLACK:
+            self.serial.timeout = wait
 
-class EspecTCP(object):
+class EspecTCP(EspecTransport):
     '''
     Handles low level communication to espec corp controllers via serial TCP
+
+    Responses are received into a persistent buffer and split at the delimeter, so a response
+    split across several tcp segments is reassembled and one that arrives with the next is kept.
+
+    kwargs:
+        timeout: float (seconds allowed for each response, limited by the caller's time budget
+                 see deadline, default=3)
+        depth: int (requests sent ahead of the responses to a list of messages, 1 waits for each
+               response before sending the next request, default=DEPTH=1)
+        addressed: bool (prefix requests with the address, for a forwarder to an RS-485 line,
+                   default=False)
+        retry: RetryPolicy or bool (see retrypolicy.RetryPolicy.make, default=False)
+        breaker: CircuitBreaker or True (fail fast while the chamber is offline, default=None)
     '''
     def __init__(self, **kwargs):
+        self.retry = RetryPolicy.make(kwargs.get('retry', False))
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+        self.timeout = kwargs.get('timeout', 3)
+        self.depth = max(1, kwargs.get('depth') or DEPTH)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setblocking(True)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(deadline.timeout(self.timeout))
         self.socket.connect((kwargs.get('host'), kwargs.get('port', 10001)))
         self.address = kwargs.get('address', None)
+        self.addressed = kwargs.get('addressed', False)
         self.delimeter = kwargs.get('delimeter', '\r\n')
+        self.rxbuf = bytearray(4096)
+        self.rxstart, self.rxend = 0, 0
 
     def __del__(self):
         try:
@@ -131,33 +316,213 @@ class EspecTCP(object):
         Close the connection the the chamber
         '''
         self.socket.close()
-        time.sleep(0.1)
 
-    def interact(self, message):
+    def _request(self, msg):
+        # TCP forwarder doesnt handle address properly so we are ignoring it, unless the
+        # forwarder is known to pass it on to an RS-485 line (addressed=True).
+        if self.addressed and self.address:
+            return '%d,%s%s'%(self.address, msg, self.delimeter)
+        return '%s%s' % (msg, self.delimeter)
+
+    def _send(self, msg):
+        '''Send the request for one message, returns the request'''
+        request = self._request(msg)
+        self.socket.settimeout(deadline.timeout(self.timeout))
+        self.socket.sendall(request)
+        return request
+
+    def _read_line(self, end):
         '''
-        Send a message to the chamber and get its response
+        Take a response up to and including the delimeter from the receive buffer, receiving
+        into it until one is complete or end (a time.time() value) passes.
+        '''
+        scanned = self.rxstart
+        while True:
+            idx = self.rxbuf.find(self.delimeter, scanned, self.rxend)
+            if idx >= 0:
+                idx += len(self.delimeter)
+                recv = str(self.rxbuf[self.rxstart:idx])
+                self.rxstart = idx
+                return recv
+            scanned = max(self.rxstart, self.rxend - len(self.delimeter) + 1)
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise deadline.timed_out(EspecTimeoutError, 'The chamber did not respond in time')
+            self.socket.settimeout(remaining)
+            scanned -= self._recv()
 
-        params:
-            message: the message to send (str)
-        returns:
-            string: response from the chamber
-        raises:
-            EspecError
+    def _recv(self):
+        '''
+        Receive what is available on the socket into the buffer (compacting or growing it first if
+        needed), returns how far the unread data moved towards the start of the buffer.
+        '''
+        moved = self.rxstart
+        if self.rxstart == self.rxend:
+            self.rxstart, self.rxend = 0, 0
+        elif self.rxstart > 0:
+            unread = self.rxend - self.rxstart
+            self.rxbuf[:unread] = self.rxbuf[self.rxstart:self.rxend]
+            self.rxstart, self.rxend = 0, unread
+        if self.rxend == len(self.rxbuf):
+            self.rxbuf.extend(bytearray(len(self.rxbuf)))
+        rlen = self.socket.recv_into(memoryview(self.rxbuf)[self.rxend:])
+        if rlen == 0:
+            self.rxstart, self.rxend = 0, 0
+            raise EspecError('The chamber closed the connection')
+        self.rxend += rlen
+        return moved
+
+    def _flush(self):
+        '''Discard what has been received (ie. the late response to a request that timed out)'''
+        self.rxstart, self.rxend = 0, 0
+        self.socket.settimeout(0)
+        try:
+            while self.socket.recv_into(self.rxbuf):
+                pass
+        except socket.error:
+            pass
+        self.flush_input = False
+
+class EspecBus(object):
+    '''
+    An RS-485 line shared by several addressed espec controllers, on a serial port or behind a
+    TCP forwarder that passes the address on.
+
+    The bus owns the port or connection and schedules the messages of every controller on it (see
+    scheduler.BusScheduler), the controllers take turns round robin. The messages of one call to
+    interact (ie. the queries prefetched by a sample) are sent as one batch so the controller is
+    not made to wait for the bus between them. A client for each controller is made with
+    client()::
+
+        bus = EspecBus('Serial', serialport='/dev/ttyUSB0', baudrate=9600)
+        chambers = [Espec(interface='Serial', adr=adr, bus=bus) for adr in range(1, 5)]
+
+    Args:
+        interface (str): "Serial" or "TCP"
+    Kwargs:
+        serialport (str/int): The serial port when interface="Serial"
+        baudrate (int): The baud rate when interface="Serial" (default=9600)
+        host (str): The IP address or hostname of the forwarder when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=10001)
+        timeout (float): seconds allowed for each response (default=3)
+        depth (int): requests sent ahead of the responses to a batch, RS-485 is half duplex so
+                     only raise this if the line is full duplex (RS-422) (default=1)
+    '''
+
+    def __init__(self, interface='Serial', **kwargs):
+        args = {'timeout':kwargs.get('timeout', 3), 'depth':kwargs.get('depth', 1)}
+        if interface == 'Serial':
+            self.transport = EspecSerial(port=kwargs.get('serialport'),
+                                         baud=kwargs.get('baudrate') or 9600, **args)
+        else:
+            self.transport = EspecTCP(host=kwargs.get('host'), port=kwargs.get('port') or 10001,
+                                      **args)
+        self.delimeter = self.transport.delimeter
+        self.scheduler = BusScheduler(self._transact_unit)
+
+    def close(self):
+        '''
+        Close the port or connection
+        '''
+        self.transport.close()
+
+    def client(self, address, **kwargs):
+        '''
+        Make a client for a controller on the bus.
+
+        Args:
+            address (int): The address of the controller
+        Kwargs:
+            retry (RetryPolicy/bool): retry policy of the client (default=False)
+            breaker (CircuitBreaker): fail fast while the controller is offline (default=None)
+        Returns:
+            EspecUnit
         '''
-        message = message.encode('ascii', 'ignore')
-        # TCP forwarder doesnt handle address properly so we are ignoring it.
-        # if self.address:
-        #     self.socket.send('%d,%s%s'%(self.address, message, self.delimeter))
-        # else:
-        #     self.socket.send('%s%s'%(message, self.delimeter))
-        self.socket.send('%s%s'%(message, self.delimeter))
-        recv = ''
-        while recv[0-len(self.delimeter):] != self.delimeter:
-            recv += self.socket.recv(1)
-        if recv.startswith('NA:'):
-            errmsg = recv[3:0-len(self.delimeter)]
-            msg = 'EspecError: command:"%s" genarated Error:"%s"(%s)' % (
-                message, errmsg, ERROR_DESCIPTIONS.get(errmsg, 'missing description')
-            )
-            raise EspecError(msg)
-        return recv[:-2]
+        return EspecUnit(self, address, **kwargs)
+
+    def exchange(self, address, messages):
+        '''
+        Send a batch of messages to a controller once the bus is free, returns the responses
+        (including the delimeter).
+
+        Args:
+            address (int): the address of the controller (the bus is scheduled by address)
+            messages (list): the messages, already addressed to the controller (see EspecUnit)
+        '''
+        call = instrumentation.current()
+        return self.scheduler.run(address, [(messages, deadline.current(), call)])[0]
+
+    def _transact_unit(self, unit, payload):
+        '''
+        Exchange one batch (called by the scheduler, possibly from another caller's thread so the
+        deadline and instrumented call of the caller that queued it are carried in the payload)
+        '''
+        messages, when, call = payload
+        with deadline.until(when), instrumentation.attributed(call):
+            deadline.check(EspecTimeoutError)
+            return self.transport._exchange_many(messages) #pylint: disable=W0212
+
+class EspecUnit(EspecTransport):
+    '''
+    A client for one controller on an EspecBus (see EspecBus.client)
+    '''
+    def __init__(self, bus, address, **kwargs):
+        self.bus = bus
+        self.address = address
+        self.delimeter = bus.delimeter
+        self.retry = RetryPolicy.make(kwargs.get('retry', False))
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+
+    def close(self):
+        '''
+        Nothing to close, the bus stays open for its other controllers.
+        '''
+        pass
+
+    def _message(self, msg):
+        '''A message addressed to the controller, the bus' transport sends it as is'''
+        return '%d,%s'%(self.address, msg)
+
+    def _request(self, msg):
+        return '%s%s' % (self._message(msg), self.delimeter)
+
+    def _exchange_many(self, messages):
+        return self.bus.exchange(self.address, [self._message(msg) for msg in messages])
+
+class EspecReplay(EspecSerial):
+    '''
+    Serve the responses of a capture (see capture) in place of a chamber, messages that were not
+    captured raise an EspecError.
+
+    kwargs:
+        capture: capture.Capture (the recorded traffic)
+        retry: RetryPolicy or bool (see retrypolicy.RetryPolicy.make, default=False)
+        breaker: CircuitBreaker or True (fail fast while the chamber is offline, default=None)
+    '''
+    def __init__(self, **kwargs): #pylint: disable=W0231
+        self.capture = kwargs.get('capture')
+        if self.capture.transport != 'espec':
+            raise ValueError('"%s" is not a capture of espec traffic' % self.capture.path)
+        self.address = kwargs.get('address', None)
+        self.delimeter = kwargs.get('delimeter', '\r\n')
+        self.retry = RetryPolicy.make(kwargs.get('retry', False))
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+
+    def close(self):
+        '''
+        Nothing to close
+        '''
+        pass
+
+    def _exchange_many(self, messages):
+        '''Replay the responses to messages (including the delimeter)'''
+        recvs = []
+        for msg in messages:
+            rec = self.capture.exchange(msg)
+            if rec is None:
+                raise EspecError('Replay error; "%s" was not captured' % msg)
+            if 'e' in rec:
+                raise (EspecTimeoutError if rec['e'] == 'timeout' else EspecError)(rec['m'])
+            instrumentation.count(len(msg) + len(self.delimeter), len(rec['r']))
+            recvs.append(rec['r'])
+        return recvs
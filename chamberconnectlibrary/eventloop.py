@@ -0,0 +1,360 @@
+﻿'''
+A minimal single threaded event loop with futures and generator based coroutines.
+
+Coroutines are generator functions decorated with @coroutine, they wait on a Future by yielding
+it and produce their result by raising Return(value)::
+
+    @coroutine
+    def poll(client):
+        temp = yield client.read_holding_float(2782)
+        raise Return(temp[0])
+
+    loop = get_event_loop()
+    print loop.run_until_complete(gather(*[poll(client) for client in clients]))
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import collections
+import functools
+import heapq
+import select
+import time
+import types
+
+class CancelledError(Exception):
+    '''The future or coroutine was cancelled'''
+    pass
+
+class TimeoutError(Exception): #pylint: disable=W0622
+    '''wait_for ran out of time'''
+    pass
+
+class Return(Exception):
+    '''Raised by a coroutine to produce its result'''
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+class Future(object):
+    '''
+    The eventual result of an operation.
+
+    Args:
+        loop (EventLoop): the loop that runs the done callbacks (default=get_event_loop())
+    '''
+
+    def __init__(self, loop=None):
+        self.loop = loop or get_event_loop()
+        self._state = 'pending'
+        self._result, self._exception = None, None
+        self._callbacks = []
+
+    def done(self):
+        '''True when the future has a result, an exception or was cancelled'''
+        return self._state != 'pending'
+
+    def cancelled(self):
+        '''True if the future was cancelled'''
+        return self._state == 'cancelled'
+
+    def result(self):
+        '''The result of the future, raises its exception if it has one'''
+        if self._state == 'cancelled':
+            raise CancelledError()
+        if self._state == 'pending':
+            raise RuntimeError('Result is not ready.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        '''The exception of the future (None if it completed normally)'''
+        if self._state == 'cancelled':
+            raise CancelledError()
+        if self._state == 'pending':
+            raise RuntimeError('Exception is not set.')
+        return self._exception
+
+    def add_done_callback(self, func):
+        '''Call func(future) when the future is done (on the next loop iteration if already done)'''
+        if self.done():
+            self.loop.call_soon(func, self)
+        else:
+            self._callbacks.append(func)
+
+    def remove_done_callback(self, func):
+        '''Remove a callback added with add_done_callback'''
+        self._callbacks = [cbk for cbk in self._callbacks if cbk != func]
+
+    def cancel(self):
+        '''Cancel the future, returns False if it was already done'''
+        if self.done():
+            return False
+        self._state = 'cancelled'
+        self._schedule_callbacks()
+        return True
+
+    def set_result(self, result):
+        '''Mark the future done with a result'''
+        if self.done():
+            raise RuntimeError('Future is already done.')
+        self._result, self._state = result, 'finished'
+        self._schedule_callbacks()
+
+    def set_exception(self, exception):
+        '''Mark the future done with an exception'''
+        if self.done():
+            raise RuntimeError('Future is already done.')
+        self._exception, self._state = exception, 'finished'
+        self._schedule_callbacks()
+
+    def _schedule_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            self.loop.call_soon(func, self)
+
+class Task(Future):
+    '''
+    Run a generator based coroutine, the task completes with the coroutine's result.
+
+    Cancelling a task cancels the future it is waiting on, the CancelledError is raised inside the
+    coroutine at its yield.
+    '''
+
+    def __init__(self, gen, loop=None):
+        super(Task, self).__init__(loop)
+        self.gen = gen
+        self.waiting = None
+        self.loop.call_soon(self._step)
+
+    def cancel(self):
+        if self.done():
+            return False
+        if self.waiting is not None:
+            return self.waiting.cancel()
+        self.loop.call_soon(self._step, None, CancelledError())
+        return True
+
+    def _step(self, value=None, exc=None):
+        if self.done():
+            return
+        self.waiting = None
+        try:
+            if exc is not None:
+                future = self.gen.throw(exc)
+            else:
+                future = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as ret:
+            self.set_result(ret.value)
+        except CancelledError:
+            super(Task, self).cancel()
+        except Exception as exc:
+            self.set_exception(exc)
+        else:
+            if not isinstance(future, Future):
+                err = RuntimeError('coroutine yielded %r, not a Future' % (future,))
+                self.loop.call_soon(self._step, None, err)
+            else:
+                self.waiting = future
+                future.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        if future.cancelled():
+            self._step(None, CancelledError())
+        elif future.exception() is not None:
+            self._step(None, future.exception())
+        else:
+            self._step(future.result())
+
+def coroutine(func):
+    '''
+    Decorate a generator function, calling it starts a Task on the default loop.
+
+    The decorated function may also be a plain function, its return value (or exception) is
+    wrapped in a completed Future.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        '''run func as a task'''
+        try:
+            rval = func(*args, **kwargs)
+        except Exception as exc:
+            future = Future()
+            future.set_exception(exc)
+            return future
+        if isinstance(rval, types.GeneratorType):
+            return Task(rval)
+        if isinstance(rval, Future):
+            return rval
+        future = Future()
+        future.set_result(rval)
+        return future
+    return wrapper
+
+def gather(*futures, **kwargs):
+    '''
+    A future for the list of results of futures (in order), fails with the first exception.
+
+    kwargs:
+        loop (EventLoop): (default=get_event_loop())
+    '''
+    outer = Future(kwargs.get('loop'))
+    if not futures:
+        outer.set_result([])
+        return outer
+    remaining = [len(futures)]
+    def _done(inner):
+        if outer.done():
+            return
+        if inner.cancelled():
+            outer.cancel()
+        elif inner.exception() is not None:
+            outer.set_exception(inner.exception())
+        else:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                outer.set_result([fut.result() for fut in futures])
+    for fut in futures:
+        fut.add_done_callback(_done)
+    return outer
+
+def wait_for(future, timeout, loop=None):
+    '''
+    A future for the result of future, if it does not complete within timeout seconds it is
+    cancelled and the returned future fails with TimeoutError.
+    '''
+    loop = loop or future.loop
+    outer = Future(loop)
+    def _timeout():
+        if not outer.done():
+            outer.set_exception(TimeoutError())
+            future.cancel()
+    handle = loop.call_later(timeout, _timeout)
+    def _done(inner):
+        handle.cancel()
+        if outer.done():
+            return
+        if inner.cancelled():
+            outer.cancel()
+        elif inner.exception() is not None:
+            outer.set_exception(inner.exception())
+        else:
+            outer.set_result(inner.result())
+    future.add_done_callback(_done)
+    return outer
+
+def sleep(delay, result=None, loop=None):
+    '''A future that completes with result after delay seconds'''
+    loop = loop or get_event_loop()
+    future = Future(loop)
+    handle = loop.call_later(delay, lambda: future.done() or future.set_result(result))
+    future.add_done_callback(lambda fut: handle.cancel())
+    return future
+
+class Handle(object):
+    '''A scheduled callback (see EventLoop.call_later)'''
+
+    def __init__(self, when, func, args):
+        self.when, self.func, self.args = when, func, args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        '''Do not run the callback'''
+        self.cancelled = True
+
+class EventLoop(object):
+    '''
+    A select() based event loop.
+
+    File readers and timers may only be added from the thread running the loop.
+    '''
+
+    def __init__(self):
+        self.ready = collections.deque()
+        self.timers = []
+        self.readers = {}
+        self.running = False
+
+    def call_soon(self, func, *args):
+        '''Run func(*args) on the next iteration of the loop'''
+        handle = Handle(None, func, args)
+        self.ready.append(handle)
+        return handle
+
+    def call_later(self, delay, func, *args):
+        '''Run func(*args) after delay seconds, returns a Handle that can be cancelled'''
+        handle = Handle(time.time() + delay, func, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+    def add_reader(self, fileobj, func, *args):
+        '''Run func(*args) whenever fileobj (a socket, file descriptor etc.) is readable'''
+        fdesc = fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+        self.readers[fdesc] = Handle(None, func, args)
+
+    def remove_reader(self, fileobj):
+        '''Stop watching fileobj'''
+        fdesc = fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+        return self.readers.pop(fdesc, None) is not None
+
+    def run_once(self, timeout=None):
+        '''
+        Run ready callbacks, then wait up to timeout seconds for io or the next timer.
+        '''
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            wait = max(0, self.timers[0].when - time.time())
+            timeout = wait if timeout is None else min(wait, timeout)
+        if self.readers:
+            readable = select.select(list(self.readers), [], [], timeout)[0]
+            for fdesc in readable:
+                handle = self.readers.get(fdesc)
+                if handle is not None:
+                    self.ready.append(handle)
+        elif timeout:
+            time.sleep(timeout)
+        now = time.time()
+        while self.timers and self.timers[0].when <= now:
+            self.ready.append(heapq.heappop(self.timers))
+        for _ in range(len(self.ready)):
+            handle = self.ready.popleft()
+            if not handle.cancelled:
+                handle.func(*handle.args)
+
+    def run_until_complete(self, future):
+        '''Run the loop until future is done, returns its result'''
+        self.running = True
+        try:
+            while not future.done():
+                if not (self.ready or self.timers or self.readers):
+                    raise RuntimeError('The future can never complete, nothing is scheduled.')
+                self.run_once()
+        finally:
+            self.running = False
+        return future.result()
+
+    def run_forever(self):
+        '''Run the loop until stop() is called'''
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        '''Stop run_forever after the current iteration'''
+        self.running = False
+
+DEFAULT_LOOP = []
+
+def get_event_loop():
+    '''The default EventLoop (created on first use)'''
+    if not DEFAULT_LOOP:
+        DEFAULT_LOOP.append(EventLoop())
+    return DEFAULT_LOOP[0]
@@ -0,0 +1,154 @@
+﻿'''
+Per method call statistics of a controller (see ControllerInterface.stats).
+
+The exclusive decorator times each call to a controller method made with instrument=True (the
+wall time and the time spent waiting for the controller's lock) while the transports count the
+bus transactions, bytes and retries made on behalf of the call::
+
+    ctlr = WatlowF4T(interface='TCP', host='10.0.0.5', instrument=True)
+    ctlr.sample()
+    ctlr.stats()['sample']['transactions']
+
+instrument may also be a callback, it is called with a record of each call (method, controller,
+start, thread, wall, lock_wait, transactions, sent, received, retries, error) as it finishes. Calls
+made within an instrumented call (ie. with exclusive=False) count towards that call.
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import threading
+import time
+from contextlib import contextmanager
+
+LOCAL = threading.local()
+
+#the per method totals
+FIELDS = ['calls', 'errors', 'wall', 'lock_wait', 'transactions', 'sent', 'received', 'retries']
+
+def current():
+    '''The record of the instrumented call being made by the calling thread (or None)'''
+    return getattr(LOCAL, 'call', None)
+
+@contextmanager
+def attributed(call):
+    '''
+    Count the transactions made in a with block towards a call (for work done on behalf of
+    another thread's call, see modbus.ModbusRTUBus)
+    '''
+    previous = current()
+    LOCAL.call = call
+    try:
+        yield
+    finally:
+        LOCAL.call = previous
+
+def count(sent=0, received=0, transactions=1):
+    '''Count bus transactions/bytes towards the calling thread's instrumented call (if any)'''
+    call = current()
+    if call is not None:
+        call['transactions'] += transactions
+        call['sent'] += sent
+        call['received'] += received
+
+def retried():
+    '''Count a retry towards the calling thread's instrumented call (if any)'''
+    call = current()
+    if call is not None:
+        call['retries'] += 1
+
+class Instrumentation(object):
+    '''
+    Collects the statistics of the calls made to one or more controllers.
+
+    Kwargs:
+        callback (callable): called with the record of each call as it finishes (default=None),
+                             more may be added to the observers list (see metrics)
+        tracer (Tracer): write a span for each call (see tracer, default=None)
+    '''
+
+    def __init__(self, callback=None, tracer=None):
+        self.callback = callback
+        self.tracer = tracer
+        self.observers = []
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    @classmethod
+    def make(cls, instrument, tracer=None):
+        '''
+        Make the instrumentation from a controller's instrument kwarg.
+
+        Args:
+            instrument: an Instrumentation, True, a callback or None/False (not instrumented)
+            tracer (Tracer): the controller's tracer, a controller with a tracer is instrumented
+        '''
+        if isinstance(instrument, Instrumentation):
+            if tracer is not None:
+                instrument.tracer = tracer
+            return instrument
+        if not (instrument or tracer):
+            return None
+        return cls(None if instrument in [None, False, True] else instrument, tracer)
+
+    @contextmanager
+    def call(self, method, controller=None):
+        '''
+        Instrument a call for the duration of a with block, yields the call's record (the caller
+        adds its lock_wait)
+
+        Args:
+            method (str): the name of the method called
+            controller (ControllerInterface): the controller called, so the calls of controllers
+                                              that share the instrumentation can be told apart
+        '''
+        if current() is not None:
+            yield current()
+            return
+        start = time.time()
+        record = {'method':method, 'controller':controller, 'start':start,
+                  'thread':threading.current_thread().ident,
+                  'wall':0.0, 'lock_wait':0.0, 'transactions':0, 'sent':0, 'received':0,
+                  'retries':0, 'error':None}
+        LOCAL.call = record
+        try:
+            yield record
+        except Exception as exc:
+            record['error'] = exc
+            raise
+        finally:
+            LOCAL.call = None
+            record['wall'] = time.time() - start
+            self.add(record)
+
+    def add(self, record):
+        '''Add the record of a finished call to the totals and pass it to the callback'''
+        with self.lock:
+            totals = self.methods.setdefault(record['method'], dict.fromkeys(FIELDS, 0))
+            totals['calls'] += 1
+            totals['errors'] += record['error'] is not None
+            for field in FIELDS[2:]:
+                totals[field] += record[field]
+        if self.tracer is not None:
+            self.tracer.call(record)
+        for callback in [self.callback] + self.observers:
+            if callback is not None:
+                try:
+                    callback(record)
+                except Exception:
+                    pass
+
+    def stats(self, reset=False):
+        '''
+        The totals of each method
+
+        Kwargs:
+            reset (bool): start counting again from zero (default=False)
+        Returns:
+            dict. {method:{calls, errors, wall, lock_wait, transactions, sent, received, retries}}
+        '''
+        with self.lock:
+            ret = dict((method, dict(totals)) for method, totals in self.methods.items())
+            if reset:
+                self.methods = {}
+        return ret
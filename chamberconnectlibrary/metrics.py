@@ -0,0 +1,222 @@
+﻿'''
+Expose the statistics of long running controllers over http in the Prometheus text format (only
+the standard library is used)::
+
+    metrics = Metrics()
+    metrics.add(WatlowF4T(interface='TCP', host='10.0.0.5', persistent=True), 'chamber1')
+    metrics.serve(9464) #http://localhost:9464/metrics
+
+Per controller and method: calls, errors by kind (see retrypolicy), a call latency histogram,
+lock wait, bus transactions, bytes and retries (see instrumentation). Per controller: connects,
+connect errors, dropped connections, the circuit breaker state and cache hits/misses (Espec).
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+import threading
+import BaseHTTPServer
+from chamberconnectlibrary.instrumentation import Instrumentation
+
+PREFIX = 'chamberconnect_'
+
+#upper bounds (seconds) of the call latency histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+#the per method counters: (metric name, record field, help)
+COUNTERS = [
+    ('calls_total', None, 'Calls made to the controller'),
+    ('lock_wait_seconds_total', 'lock_wait', 'Time spent waiting for the controller lock'),
+    ('transactions_total', 'transactions', 'Bus transactions made'),
+    ('bytes_sent_total', 'sent', 'Bytes sent to the controller'),
+    ('bytes_received_total', 'received', 'Bytes received from the controller'),
+    ('retries_total', 'retries', 'Transactions retried')
+]
+
+#the per controller values: (metric name, type, attribute of the controller, help)
+CONTROLLER_VALUES = [
+    ('connects_total', 'counter', 'connection.connects', 'Connections opened'),
+    ('connect_errors_total', 'counter', 'connection.connect_errors', 'Failed connection attempts'),
+    ('disconnects_total', 'counter', 'connection.drops', 'Connections closed or dropped'),
+    ('cache_hits_total', 'counter', 'cache_hits', 'Responses served from the cache'),
+    ('cache_misses_total', 'counter', 'cache_misses', 'Responses not in the cache (or stale)')
+]
+
+def escape(value):
+    '''Escape a label value'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kwargs):
+    '''Format a label set'''
+    return '{%s}' % ','.join('%s="%s"' % (key, escape(kwargs[key])) for key in sorted(kwargs))
+
+def number(value):
+    '''Format a sample value'''
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics(object):
+    '''
+    Collect the statistics of one or more controllers for Prometheus.
+
+    Kwargs:
+        buckets (list): upper bounds of the latency histogram buckets (default=BUCKETS)
+    '''
+
+    def __init__(self, **kwargs):
+        self.buckets = sorted(kwargs.get('buckets', BUCKETS))
+        self.lock = threading.Lock()
+        self.controllers = {}
+        self.names = {}
+        self.observed = []
+        self.methods = {}
+        self.errors = {}
+        self.server = None
+
+    def add(self, ctlr, name=None):
+        '''
+        Collect the statistics of a controller, it is instrumented if it was not already.
+        Controllers may share an Instrumentation, each call is counted for the controller that
+        was called (calls to controllers that were not added are not counted).
+
+        Args:
+            ctlr (ControllerInterface): the controller
+            name (str): the controller label (default=host or serial port/address)
+        Returns:
+            str. the controller label
+        '''
+        if name is None:
+            name = '%s/%s' % (ctlr.host or ctlr.serialport or ctlr.interface, ctlr.adr)
+        if ctlr.instrumentation is None:
+            ctlr.instrumentation = Instrumentation()
+        with self.lock:
+            self.controllers[name] = ctlr
+            self.names[id(ctlr)] = name
+            if not any(inst is ctlr.instrumentation for inst in self.observed):
+                self.observed.append(ctlr.instrumentation)
+                ctlr.instrumentation.observers.append(self.observe)
+        return name
+
+    def observe(self, record):
+        '''Add the record of a finished call (see instrumentation)'''
+        with self.lock:
+            name = self.names.get(id(record.get('controller')))
+            if name is None:
+                return
+            key = (name, record['method'])
+            method = self.methods.get(key)
+            if method is None:
+                method = dict((field, 0) for _, field, _ in COUNTERS if field)
+                method.update(calls=0, sum=0.0, buckets=[0] * len(self.buckets))
+                self.methods[key] = method
+            method['calls'] += 1
+            method['sum'] += record['wall']
+            for _, field, _ in COUNTERS:
+                if field:
+                    method[field] += record[field]
+            for i, bound in enumerate(self.buckets):
+                if record['wall'] <= bound:
+                    method['buckets'][i] += 1
+            if record['error'] is not None:
+                ekey = key + (getattr(record['error'], 'kind', 'error'),)
+                self.errors[ekey] = self.errors.get(ekey, 0) + 1
+
+    def render(self):
+        '''
+        The metrics in the Prometheus text format
+
+        Returns:
+            str
+        '''
+        lines = []
+        def family(metric, mtype, text):
+            '''Start a metric family'''
+            lines.append('# HELP %s%s %s' % (PREFIX, metric, text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, metric, mtype))
+        with self.lock:
+            methods = sorted(self.methods.items())
+            for metric, field, text in COUNTERS:
+                family(metric, 'counter', text)
+                for (name, method), values in methods:
+                    lines.append('%s%s%s %s' % (PREFIX, metric, labels(controller=name,
+                                                                       method=method),
+                                                number(values[field or 'calls'])))
+            family('call_errors_total', 'counter', 'Calls that raised an error, by kind')
+            for (name, method, kind), count in sorted(self.errors.items()):
+                lines.append('%scall_errors_total%s %d' % (
+                    PREFIX, labels(controller=name, method=method, kind=kind), count
+                ))
+            family('call_duration_seconds', 'histogram', 'Call latency')
+            for (name, method), values in methods:
+                for bound, count in zip(self.buckets, values['buckets']):
+                    lines.append('%scall_duration_seconds_bucket%s %d' % (
+                        PREFIX, labels(controller=name, method=method, le=number(float(bound))),
+                        count
+                    ))
+                lines.append('%scall_duration_seconds_bucket%s %d' % (
+                    PREFIX, labels(controller=name, method=method, le='+Inf'), values['calls']
+                ))
+                lbl = labels(controller=name, method=method)
+                lines.append('%scall_duration_seconds_sum%s %r' % (PREFIX, lbl, values['sum']))
+                lines.append('%scall_duration_seconds_count%s %d' % (PREFIX, lbl, values['calls']))
+            controllers = sorted(self.controllers.items())
+        for metric, mtype, attr, text in CONTROLLER_VALUES:
+            values = [(name, self._attribute(ctlr, attr)) for name, ctlr in controllers]
+            values = [(name, value) for name, value in values if value is not None]
+            if values:
+                family(metric, mtype, text)
+                lines += ['%s%s%s %s' % (PREFIX, metric, labels(controller=name), number(value))
+                          for name, value in values]
+        family('breaker_open', 'gauge', 'The circuit breaker is refusing requests (1) or not (0)')
+        for name, ctlr in controllers:
+            if ctlr.breaker is not None:
+                lines.append('%sbreaker_open%s %d' % (PREFIX, labels(controller=name),
+                                                      ctlr.breaker.state != 'closed'))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _attribute(obj, attr):
+        '''Get a dotted attribute, None if it is missing'''
+        for part in attr.split('.'):
+            obj = getattr(obj, part, None)
+        return obj
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        '''
+        Serve the metrics at http://host:port/metrics from a background thread
+
+        Args:
+            port (int): the port to listen on, 0 picks a free port (default=9464)
+            host (str): the address to listen on (default="127.0.0.1", local only)
+        Returns:
+            tuple. (host, port) of the server
+        '''
+        metrics = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            '''Respond to GET /metrics'''
+            def do_GET(self): #pylint: disable=C0103
+                '''Send the metrics'''
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): #pylint: disable=W0221
+                '''Do not log each request'''
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server.server_address
+
+    def close(self):
+        '''Stop serving the metrics'''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -7,13 +7,377 @@ Partial modbus implimantation for communicating with watlow controllers (input/h
 #pylint: disable=W0703
 import socket
 import struct
+import sys
 import time
+import array
 import collections
+from contextlib import contextmanager
+from itertools import islice
 import serial
+from chamberconnectlibrary.scheduler import BusScheduler
+from chamberconnectlibrary.retrypolicy import RetryPolicy, CircuitBreaker, guarded
+from chamberconnectlibrary import deadline, instrumentation
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#the maximum number of registers that may be read with a single function 3/4 request
+MAX_READ_COUNT = 125
+
+#the maximum number of registers that may be written with a single function 16 request
+MAX_WRITE_COUNT = 123
+
+#the largest modbus tcp frame (7 byte MBAP + 253 byte PDU)
+MAX_TCP_ADU = 260
+
+#exception codes for which a merged read is split into one read per item (illegal data address,
+#ie. an unused register in a gap, and illegal data value), other exceptions are raised
+SPLIT_CODES = [2, 3]
+
+#minimum inter-frame times by device, the Watlow F4/F4T do not respond reliably to requests sent
+#within the standard 3.5 character silent interval. The 30ms for the Watlow controllers is the
+#delay Watlow recommends, the pause the library has always used (3.5 * 12ms did not work on the
+#F4T), a shorter one has not been measured on the hardware.
+RTU_PROFILES = {
+    'modbus': {'turnaround':0.0},
+    'watlow_f4t': {'turnaround':0.03},
+    'watlow_f4': {'turnaround':0.03}
+}
+
+def _make_crc_table():
+    '''Build the lookup table for the modbus CRC16 (polynomial 0xA001)'''
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = _make_crc_table()
+
+def crc16(data, length=None):
+    '''
+    Calculate the modbus CRC16 using the precomputed table
+
+    Args:
+        data (bytearray): The frame (a str will be converted to a bytearray)
+        length (int): Only use the first length bytes of data (default=None(all))
+    Returns:
+        int. The crc, byte swapped so it can be packed (">H") in transmission order
+    '''
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    crc = 0xFFFF
+    for byte in islice(data, length):
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return ((crc & 0xFF) << 8) | (crc >> 8)
+
+def hexlify(data):
+    '''Format a frame as colon separated hex bytes for error messages'''
+    return ":".join("{:02x}".format(byte) for byte in bytearray(data))
 
 class ModbusError(Exception):
-    '''Generic Modbus exception.'''
-    pass
+    '''
+    Generic Modbus exception.
+
+    Args:
+        message (str): description of the error
+        code (int): the modbus exception code when the slave responded with one (default=None)
+    '''
+    kind = 'error'
+
+    def __init__(self, message, code=None):
+        super(ModbusError, self).__init__(message)
+        self.code = code
+        if code is not None:
+            self.kind = 'busy' if code in [5, 6] else 'exception'
+
+class ModbusTimeoutError(ModbusError):
+    '''The slave did not respond (or only part of the response arrived) in time'''
+    kind = 'timeout'
+
+class ModbusCRCError(ModbusError):
+    '''The response failed its crc check'''
+    kind = 'crc'
+
+class RegisterDecoder(object):
+    '''
+    Decode typed values from a block of raw register data (the big endian register bytes as sent
+    on the wire), each field is converted with a single array/numpy call.
+
+    Field descriptors (dicts) may contain:
+        start (int): register offset of the field in the block (default=0)
+        dtype (str): uint16/int16/uint32/int32/float32/string (default=uint16)
+        count (int): number of values (characters for strings) (default=1)
+        low_word_first (bool): word order of 32bit values (default=True)
+        scalar (float): values are divided by scalar (default=1)
+        scale (float): values are multiplied by scale (default=1)
+        offset (float): added to values after scaling (default=0)
+        precision (int): decimal places to round to, None for no rounding (default=1 for float32
+                         otherwise None)
+
+    Args:
+        fields (list(dict)): the field descriptors
+        use_numpy (bool): decode to numpy arrays instead of array.array (default=False)
+    '''
+    #dtype: (registers per value, array typecode, numpy type)
+    dtypes = {
+        'uint16': (1, 'H', 'u2'),
+        'int16': (1, 'h', 'i2'),
+        'uint32': (2, 'I', 'u4'),
+        'int32': (2, 'i', 'i4'),
+        'float32': (2, 'f', 'f4'),
+        'string': (1, None, None)
+    }
+
+    def __init__(self, fields, use_numpy=False):
+        if use_numpy and numpy is None:
+            raise ImportError('numpy is required for use_numpy=True')
+        self.use_numpy = use_numpy
+        self.fields = []
+        for fld in fields:
+            dtype = fld.get('dtype', 'uint16')
+            if dtype not in self.dtypes:
+                raise ValueError('Unsupported dtype "%s"' % dtype)
+            words = self.dtypes[dtype][0]
+            start, count = fld.get('start', 0), fld.get('count', 1)
+            self.fields.append({
+                'dtype':dtype,
+                'begin':start*2,
+                'end':(start + count*words)*2,
+                'swap':words == 2 and fld.get('low_word_first', True),
+                'scalar':float(fld.get('scalar', 1)),
+                'scale':fld.get('scale', 1),
+                'offset':fld.get('offset', 0),
+                'precision':fld.get('precision', 1 if dtype == 'float32' else None)
+            })
+
+    @staticmethod
+    def words(dtype):
+        '''The number of registers used by each value of dtype'''
+        return RegisterDecoder.dtypes[dtype][0]
+
+    def decode(self, raw):
+        '''
+        Decode the fields from raw register data
+
+        Args:
+            raw (str/bytearray): the register data
+        Returns:
+            list. one array (or string) per field
+        '''
+        raw = bytes(raw)
+        return [self._decode_field(fld, raw[fld['begin']:fld['end']]) for fld in self.fields]
+
+    def _decode_field(self, fld, data):
+        '''Decode a single field'''
+        if fld['dtype'] == 'string':
+            return data[1::2].replace('\x00', '')
+        little = False
+        if fld['swap']:
+            # swapping the bytes of each word turns low word first values into little endian
+            swapped = array.array('H', data)
+            swapped.byteswap()
+            data, little = swapped.tostring(), True
+        if self.use_numpy:
+            vals = numpy.frombuffer(data, ('<' if little else '>') + self.dtypes[fld['dtype']][2])
+            if fld['scalar'] != 1:
+                vals = vals / fld['scalar']
+            if fld['scale'] != 1 or fld['offset'] != 0:
+                vals = vals * fld['scale'] + fld['offset']
+            if fld['precision'] is not None:
+                vals = numpy.round(vals, fld['precision'])
+            return vals
+        vals = array.array(self.dtypes[fld['dtype']][1], data)
+        if little != (sys.byteorder == 'little'):
+            vals.byteswap()
+        scale, offset, precision = fld['scale'], fld['offset'], fld['precision']
+        if fld['scalar'] != 1:
+            vals = array.array('d', [val / fld['scalar'] for val in vals])
+        if scale != 1 or offset != 0:
+            vals = array.array('d', [val*scale + offset for val in vals])
+        if precision is not None:
+            vals = array.array('d', [round(val, precision) for val in vals])
+        return vals
+
+class ModbusReadPlan(object):
+    '''
+    A prepared set of coalesced register reads, see Modbus.read_items
+
+    Items are grouped by modbus address and function code then sorted by register. Items that are
+    adjacent, overlapping or within max_gap registers of each other are merged into a single
+    request of at most 125 registers. The request packets are built once so the plan may be
+    reused for every poll.
+
+    Args:
+        items (list(dict)): The items to read (same format as Modbus.read_items)
+        address (int): The modbus address for items that do not specify one
+        low_word_first (bool): The word order for items that do not specify one (default=True)
+        max_gap (int): The number of unused registers allowed between merged items (default=10)
+        use_numpy (bool): Decode values to numpy arrays rather than array.array (default=False)
+    '''
+    types = {
+        'holding':'uint16', 'holding_signed':'int16',
+        'holding_float':'float32', 'holding_string':'string',
+        'input':'uint16', 'input_signed':'int16',
+        'input_float':'float32', 'input_string':'string'
+    }
+
+    def __init__(self, items, address, low_word_first=True, max_gap=10, use_numpy=False):
+        self.max_gap = max_gap
+        self.use_numpy = use_numpy
+        self.blocks = []
+        fields = []
+        for idx, itm in enumerate(items):
+            rtype = itm.get('type', 'holding')
+            if rtype not in self.types:
+                raise ValueError('Unsupported read type "%s"' % rtype)
+            dtype = itm.get('dtype', self.types[rtype])
+            count = itm.get('count', 1)
+            fields.append({
+                'index':idx,
+                'address':itm.get('address', address),
+                'function':4 if rtype.startswith('input') else 3,
+                'dtype':dtype,
+                'register':itm['register'],
+                'count':count,
+                'span':count*RegisterDecoder.words(dtype),
+                'low_word_first':itm.get('low_word_first', low_word_first),
+                'scalar':itm.get('scalar', 1),
+                'offset':itm.get('offset', 0),
+                'precision':itm.get('precision', 1 if dtype == 'float32' else None),
+                'array':itm.get('array', False)
+            })
+        fields.sort(key=lambda fld: (fld['address'], fld['function'], fld['register']))
+        block = None
+        for fld in fields:
+            end = fld['register'] + fld['span']
+            if block is not None and \
+               (block['address'], block['function']) == (fld['address'], fld['function']) and \
+               fld['register'] - block['end'] <= max_gap and \
+               max(end, block['end']) - block['start'] <= MAX_READ_COUNT:
+                block['fields'].append(fld)
+                block['end'] = max(end, block['end'])
+            else:
+                block = {
+                    'address':fld['address'],
+                    'function':fld['function'],
+                    'start':fld['register'],
+                    'end':end,
+                    'fields':[fld]
+                }
+                self.blocks.append(block)
+        for block in self.blocks:
+            self._build(block)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _build(self, block):
+        '''Make the request packet for a block'''
+        ttp = (block['address'], block['function'], block['start'], block['end'] - block['start'])
+        block['packet'] = struct.pack(">BBHH", *ttp)
+        block['decoder'] = RegisterDecoder(
+            [dict(fld, start=fld['register'] - block['start']) for fld in block['fields']],
+            self.use_numpy
+        )
+        return block
+
+    def split(self, block):
+        '''
+        Make one block per item of a merged block. Used when a merged read is rejected by the
+        controller (ie an unused register in a gap is not readable), see replace.
+
+        Args:
+            block (dict): The block to split
+        Returns:
+            list(dict). The new blocks
+        '''
+        return [
+            self._build({
+                'address':fld['address'],
+                'function':fld['function'],
+                'start':fld['register'],
+                'end':fld['register'] + fld['span'],
+                'fields':[fld]
+            })
+            for fld in block['fields']
+        ]
+
+    def replace(self, block, blocks):
+        '''
+        Replace a merged block with the blocks it was split into, once they have been read.
+
+        Args:
+            block (dict): The block that was split
+            blocks (list(dict)): The blocks made by split
+        '''
+        if block in self.blocks:
+            idx = self.blocks.index(block)
+            self.blocks[idx:idx+1] = blocks
+
+class RTUTiming(object):
+    '''
+    Inter-frame timing for a modbus RTU bus
+
+    The silent interval between frames is 3.5 character times (fixed at 1.75ms above 19200 baud as
+    per the modbus serial line spec). Some devices need more time after responding before they
+    will accept the next request, the device profile (or the turnaround kwarg) sets that minimum.
+    The interval is measured from the end of the previous frame so time spent processing a
+    response counts towards it.
+
+    Kwargs:
+        baud (int): The serial port's baud rate (default=9600)
+        databits (int): The number of data bits (default=8)
+        stopbits (int): The number of stop bits (default=1)
+        parity (str): The parity ('N', 'E', 'O') (default='N')
+        profile (str): The device profile (see RTU_PROFILES) (default='modbus')
+        turnaround (float): The minimum time between frames in seconds, overrides the profile
+    '''
+
+    def __init__(self, **kwargs):
+        baud = kwargs.get('baud') or 9600
+        bits = 1 + kwargs.get('databits', 8) + kwargs.get('stopbits', 1)
+        bits += 0 if kwargs.get('parity', 'N') == 'N' else 1
+        self.char_time = float(bits) / baud
+        self.silent = 3.5 * self.char_time if baud <= 19200 else 0.00175
+        profile = RTU_PROFILES[kwargs.get('profile', 'modbus')]
+        self.turnaround = kwargs.get('turnaround', profile['turnaround'])
+        self.interval = max(self.silent, self.turnaround)
+        self.last = 0
+
+    def frame_time(self, length):
+        '''
+        The time required to send a frame
+
+        Args:
+            length (int): The number of bytes in the frame (including crc)
+        Returns:
+            float. seconds
+        '''
+        return length * self.char_time
+
+    def wait(self):
+        '''
+        Wait until the bus has been silent long enough to send the next frame.
+        '''
+        remaining = self.last + self.interval - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def mark(self):
+        '''
+        Record the end of bus activity (the end of the last frame received).
+        '''
+        self.last = time.time()
+
+    def ready(self):
+        '''
+        The time at which the next frame may be sent.
+        '''
+        return self.last + self.interval
 
 class Modbus(object):
     '''
@@ -22,12 +386,19 @@ class Modbus(object):
     4: Read Input Register(s)
     6: Write Holding Register
     16: Write Multiple Holding Registers
+    23: Read/Write Multiple Registers
     '''
     
     def __init__(self, address, *args, **kwargs):
         self.low_word_first = kwargs.get('low_word_first', True)
-        self.retry = kwargs.get('retry', False)
+        self.retry = RetryPolicy.make(kwargs.get('retry', False))
+        self.breaker = CircuitBreaker.make(kwargs.get('breaker'))
+        self.read_write_supported = kwargs.get('read_write', True)
+        self.max_gap = kwargs.get('max_gap', 10)
+        self.use_numpy = kwargs.get('numpy', False)
         self.address = address
+        self.read_plans = {}
+        self.batch = None
         self.error_messages = {
             1: 'Illegal Function',
             2: 'Illegal Data Address',
@@ -53,15 +424,7 @@ class Modbus(object):
         Returns:
             list. unsigned 16bit integers
         '''
-        packet = self._make_packet(4, register, count)
-        try:
-            rval = self.interact(packet)
-        except ModbusError:
-            if self.retry:
-                rval = self.interact(packet)
-            else:
-                raise
-        return self._decode_packet(rval, packet)
+        return self._transact(self._make_packet(4, register, count))
 
 
     def read_input_signed(self, register, count=1):
@@ -75,8 +438,7 @@ class Modbus(object):
         Returns:
             list. signed 16bit integers
         '''
-        vals = self.read_input(register, count)
-        return [struct.unpack('h', struct.pack('H', val))[0] for val in vals]
+        return self._read_typed(4, register, count, 'int16')
 
 
     def read_input_float(self, register, count=1):
@@ -90,12 +452,7 @@ class Modbus(object):
         Returns:
             list. 32bit floats
         '''
-        val = self.read_input(register, count*2)
-        fidx, sidx = (0, 1) if self.low_word_first else (1, 0)
-        return [
-            round(struct.unpack('f', struct.pack('HH', val[i+fidx], val[i+sidx]))[0], 1)
-            for i in range(0, count*2, 2)
-        ]
+        return self._read_typed(4, register, count, 'float32')
 
 
     def read_input_string(self, register, count):
@@ -109,12 +466,7 @@ class Modbus(object):
         Returns:
             str
         '''
-        val = self.read_input(register, count)
-        rstring = ""
-        for char in val:
-            if char is not 0:
-                rstring = rstring + chr(char)
-        return rstring
+        return self._read_typed(4, register, count, 'string')
 
 
     def read_holding(self, register, count=1):
@@ -128,15 +480,7 @@ class Modbus(object):
         Returns:
             list. unsigned 16bit integers
         '''
-        packet = self._make_packet(3, register, count)
-        try:
-            rval = self.interact(packet)
-        except ModbusError:
-            if self.retry:
-                rval = self.interact(packet)
-            else:
-                raise
-        return self._decode_packet(rval, packet)
+        return self._transact(self._make_packet(3, register, count))
 
 
     def read_holding_signed(self, register, count=1):
@@ -150,8 +494,7 @@ class Modbus(object):
         Returns:
             list. signed 16bit integers
         '''
-        vals = self.read_holding(register, count)
-        return [struct.unpack('h', struct.pack('H', val))[0] for val in vals]
+        return self._read_typed(3, register, count, 'int16')
 
 
     def read_holding_float(self, register, count=1):
@@ -165,12 +508,7 @@ class Modbus(object):
         Returns:
             list. 32bit floats
         '''
-        val = self.read_holding(register, count*2)
-        fidx, sidx = (0, 1) if self.low_word_first else (1, 0)
-        return [
-            round(struct.unpack('f', struct.pack('HH', val[i+fidx], val[i+sidx]))[0], 1)
-            for i in range(0, count*2, 2)
-        ]
+        return self._read_typed(3, register, count, 'float32')
 
 
     def read_holding_string(self, register, count):
@@ -184,12 +522,33 @@ class Modbus(object):
         Returns:
             str
         '''
-        val = self.read_holding(register, count)
-        rstring = ""
-        for char in val:
-            if char is not 0:
-                rstring = rstring + chr(char)
-        return rstring
+        return self._read_typed(3, register, count, 'string')
+
+
+    def read_array(self, register, count=1, dtype='uint16', **kwargs):
+        '''
+        Read a block of typed values into an array (see RegisterDecoder)
+
+        Args:
+            register (int): The modbus register to start reading at
+            count (int): The number of values to read (default=1)
+            dtype (str): uint16/int16/uint32/int32/float32 (default=uint16)
+        Kwargs:
+            input (bool): read input registers instead of holding registers (default=False)
+            low_word_first (bool): word order for 32 bit values (default=self.low_word_first)
+            scale (float): values are multiplied by scale (default=1)
+            offset (float): added to values after scaling (default=0)
+            precision (int): decimal places to round to, None to not round (default=None)
+        Returns:
+            array.array (numpy.ndarray if the client was created with numpy=True)
+        '''
+        function = 4 if kwargs.get('input', False) else 3
+        fld = dict(kwargs, dtype=dtype, count=count)
+        fld.setdefault('low_word_first', self.low_word_first)
+        fld.setdefault('precision', None)
+        decoder = RegisterDecoder([fld], self.use_numpy)
+        packet = self._make_packet(function, register, count*decoder.words(dtype))
+        return self._decoded(self._transact(packet, raw=True), decoder)
 
 
     def write_holding(self, register, value):
@@ -200,16 +559,66 @@ class Modbus(object):
             register (int): register(s) to write to
             value (int or list(int)): value(s) to write,
         '''
+        if self.batch is not None:
+            vals = list(value) if isinstance(value, collections.Iterable) else [value]
+            if any(register + i in self.batch['writes'] for i in range(len(vals))):
+                self.barrier() #keep the order of repeated writes to a register
+            for i, val in enumerate(vals):
+                self.batch['writes'][register + i] = val
+            return
         packettype = 16 if isinstance(value, collections.Iterable) else 6
-        packet = self._make_packet(packettype, register, value)
+        self._transact(self._make_packet(packettype, register, value))
+
+
+    @contextmanager
+    def write_batch(self, max_gap=0, fill=None):
+        '''
+        Collect the holding register writes made in a with block and send them merged into as few
+        requests as possible (function 16, at most 123 registers each) in register order.
+
+        The pending writes are sent early when a read is made, when a register is written a second
+        time and when barrier() is called, so writes are never reordered across those points. If
+        the block raises an exception the writes that have not been sent are discarded. Nested
+        batches join the outermost batch.
+
+        Args:
+            max_gap (int): Merge writes separated by up to this many unwritten registers (default=0)
+            fill (int): The value written to the registers in a gap, gaps are only merged when a
+                        fill value is given (default=None)
+        '''
+        if self.batch is not None:
+            yield self
+            return
+        self.batch = {'writes':{}, 'max_gap':max_gap if fill is not None else 0, 'fill':fill}
         try:
-            rval = self.interact(packet)
-        except ModbusError:
-            if self.retry:
-                rval = self.interact(packet)
+            yield self
+            self.barrier()
+        finally:
+            self.batch = None
+
+
+    def barrier(self):
+        '''
+        Send the pending writes of a write_batch now, later writes are sent after these.
+        '''
+        if not self.batch or not self.batch['writes']:
+            return
+        writes, self.batch['writes'] = self.batch['writes'], {}
+        runs = []
+        for reg in sorted(writes):
+            if runs and reg - runs[-1][0] < MAX_WRITE_COUNT and \
+               reg - (runs[-1][0] + len(runs[-1][1])) <= self.batch['max_gap']:
+                run = runs[-1]
+                run[1].extend([self.batch['fill']]*(reg - run[0] - len(run[1])) + [writes[reg]])
             else:
-                raise
-        self._decode_packet(rval, packet)
+                runs.append([reg, [writes[reg]]])
+        packets = [
+            self._make_packet(16, start, vals) if len(vals) > 1 else
+            self._make_packet(6, start, vals[0])
+            for start, vals in runs
+        ]
+        for packet, rval in zip(packets, self._transact_many(packets)):
+            self._decode_packet(rval, packet)
 
 
     def write_holding_signed(self, register, value):
@@ -261,11 +670,55 @@ class Modbus(object):
         self.write_holding(register, mods[0:length])
 
 
+    def read_write_holding(self, write_register, value, read_register, count=1):
+        '''
+        Write holding register(s) then read holding register(s) in a single transaction.
+
+        Uses modbus function 23, if the device responds with an Illegal Function exception that is
+        remembered and the write and read are sent as separate requests from then on.
+
+        Args:
+            write_register (int): register(s) to write to
+            value (int or list(int)): value(s) to write
+            read_register (int): The modbus register to read (after the write)
+            count (int): The number of modbus registers to read (default=1)
+
+        Returns:
+            list. unsigned 16bit integers
+        '''
+        if self.read_write_supported:
+            wvals = list(value) if isinstance(value, collections.Iterable) else [value]
+            packet = self._make_packet(23, read_register, (count, write_register, wvals))
+            try:
+                return self._transact(packet)
+            except ModbusError as exc:
+                if exc.code != 1:
+                    raise
+                self.read_write_supported = False
+        self.write_holding(write_register, value)
+        return self.read_holding(read_register, count)
+
+
     def interact(self, packet):
         '''Interact with the physical interface'''
         raise NotImplementedError('ModbusTCP or ModbusRTU must be used not Modbus class')
 
 
+    def interact_many(self, packets):
+        '''
+            Interact with the physical interface using several request packets.
+
+            The default sends each request in turn, transports that can have more than one request
+            outstanding (ModbusTCP) override this.
+
+            params:
+                packets: list (the request packets)
+            returns:
+                list: the raw responses, in the same order as packets
+        '''
+        return [self.interact(packet) for packet in packets]
+
+
     def read_item(self, **kwargs):
         '''
             Read paramter from the controller.
@@ -274,9 +727,13 @@ class Modbus(object):
                 register: int (relative register value, required)
                 address: int
                 type: string (holding/holding_signed/holding_float/holding_string/input/input_signed/input_float/input_string)
-                count: int (only applies to string only)
+                count: int (number of values, or characters for strings)
                 low_word_first: bool (word order for 32 bit values)
                 scalar: int (factor that read value will be devided by)
+                dtype: string (overrides the value type: uint16/int16/uint32/int32/float32/string)
+                offset: float (added to the value after scaling)
+                precision: int (decimal places to round to, default=1 for floats, None=no rounding)
+                array: bool (return the value(s) as an array rather than a list or single value)
             returns:
                 dict: ex: {'register':2782, 'address':1, 'type':'holding_float', 'count':1, 'low_word_first':True, 'scalar':1, 'value':50.0}
         '''
@@ -287,36 +744,117 @@ class Modbus(object):
         '''
             Read parameters from the controller using a list of arguments for each parameter
 
+            Items are read using as few requests as possible (see ModbusReadPlan), the plan for a
+            given list of items is cached so repeated calls with the same items are not replanned.
+
             params:
                 list: ex: [{'register':2782, 'address':1, 'type':'holding_float', 'count':1, 'low_word_first':True, 'scalar':1}]
             returns:
                 list: ex: [{'register':2782, 'address':1, 'type':'holding_float', 'count':1, 'low_word_first':True, 'scalar':1, 'value':50.0}]
         '''
-        types = {
-            'holding': self.read_holding,
-            'holding_signed': self.read_holding_signed,
-            'holding_float': self.read_holding_float,
-            'holding_string': self.read_holding_string,
-            'input': self.read_input,
-            'input_signed': self.read_input_signed,
-            'input_float': self.read_input_float,
-            'input_string': self.read_input_string
-        }
-        for itm in items:
-            self.address = itm.get('address', self.address)
-            self.low_word_first = itm.get('low_word_first', self.low_word_first)
-            func = itm.get('type', 'holding')
-            vals = types[func](itm['register'], itm.get('count', 1))
-            if 'string' in func:
-                itm['value'] = vals
-            elif isinstance(vals, list):
-                for val in vals:
-                    if 'scalar' in itm and itm['scalar'] != 1:
-                        val = float(val) / itm['scalar']
-                itm['value'] = vals if len(vals) > 1 else vals[0]
+        key = tuple(
+            (
+                itm.get('address', self.address),
+                itm.get('type', 'holding'),
+                itm['register'],
+                itm.get('count', 1),
+                itm.get('low_word_first', self.low_word_first),
+                itm.get('dtype'),
+                itm.get('scalar', 1),
+                itm.get('offset', 0),
+                'precision' in itm,
+                itm.get('precision'),
+                itm.get('array', False)
+            )
+            for itm in items
+        )
+        plan = self.read_plans.get(key)
+        if plan is None:
+            if len(self.read_plans) >= 64:
+                self.read_plans.clear()
+            plan = ModbusReadPlan(
+                items, self.address, self.low_word_first, self.max_gap, self.use_numpy
+            )
+            self.read_plans[key] = plan
+        return self.read_plan(plan, items)
+
+
+    def read_plan(self, plan, items):
+        '''
+            Read parameters using a prepared ModbusReadPlan.
+
+            params:
+                plan: ModbusReadPlan (prepared from items or a list of the same shape)
+                items: list (the items to store the values in, see read_items)
+            returns:
+                list: the items with the 'value' key set
+        '''
+        blocks = list(plan.blocks)
+        responses = self._transact_many([block['packet'] for block in blocks])
+        for block, rval in zip(blocks, responses):
+            try:
+                raw = self._decode_raw(rval, block['packet'])
+            except ModbusError as exc:
+                if exc.kind == 'busy':
+                    self._read_block(block, self._transact(block['packet'], True), items)
+                elif exc.code not in SPLIT_CODES or len(block['fields']) == 1:
+                    raise
+                else:
+                    sblocks = plan.split(block)
+                    for sblock in sblocks:
+                        self._read_block(sblock, self._transact(sblock['packet'], True), items)
+                    plan.replace(block, sblocks)
+            else:
+                self._read_block(block, raw, items)
         return items
 
 
+    def _read_block(self, block, raw, items):
+        '''Decode the values for each item out of a block of raw register data'''
+        for fld, vals in zip(block['fields'], block['decoder'].decode(raw)):
+            if not (fld['array'] or fld['dtype'] == 'string'):
+                vals = vals.tolist()
+                vals = vals if len(vals) > 1 else vals[0]
+            items[fld['index']]['value'] = vals
+
+
+    def _read_typed(self, function, register, count, dtype):
+        '''Read registers and decode them as dtype, returns a list (or str for strings)'''
+        decoder = RegisterDecoder([{
+            'dtype':dtype,
+            'count':count,
+            'low_word_first':self.low_word_first
+        }])
+        packet = self._make_packet(function, register, count*decoder.words(dtype))
+        return self._decoded(self._transact(packet, raw=True), decoder, dtype != 'string')
+
+
+    @staticmethod
+    def _decoded(raw, decoder, aslist=False):
+        '''Decode a single field'''
+        vals = decoder.decode(raw)[0]
+        return vals.tolist() if aslist else vals
+
+
+    def _transact(self, packet, raw=False):
+        '''
+        Send a request packet and decode the response (retrying per the retry policy), raw=True
+        returns the register data bytes rather than a tuple of registers.
+        '''
+        if self.batch and self.batch['writes']:
+            self.barrier()
+        data = guarded(self.retry, self.breaker, ModbusError,
+                       lambda: self._decode_raw(self.interact(packet), packet))
+        return data if raw else self._unpack_registers(data)
+
+
+    def _transact_many(self, packets):
+        '''Send several request packets (retrying per the retry policy), returns the responses.'''
+        if self.batch and self.batch['writes']:
+            self.barrier()
+        return guarded(self.retry, self.breaker, ModbusError, self.interact_many, packets)
+
+
     def _pack32(self, format, value):
         pval = struct.unpack('HH', struct.pack(format, value))
         return list(pval) if self.low_word_first else [pval[1], pval[0]]
@@ -329,26 +867,40 @@ class Modbus(object):
         elif function == 16:
             margs = [self.address, function, register, len(args), len(args)*2] + list(args)
             return struct.pack(">BBHHB%dH" % len(args), *margs)
+        elif function == 23:
+            count, wregister, wargs = args
+            margs = [self.address, function, register, count, wregister, len(wargs), len(wargs)*2]
+            return struct.pack(">BBHHHHB%dH" % len(wargs), *(margs + list(wargs)))
         else:
             raise NotImplementedError("Supplied modbus function code is not supported.")
 
 
     def _decode_packet(self, packet, spacket):
         '''Decode the modbus request packet.'''
-        fcode = struct.unpack(">B", packet[1])[0]
-        addr = struct.unpack(">B", packet[0])[0]
-        if self.address != addr:
-            shex = ":".join("{:02x}".format(ord(c) for c in spacket))
-            rhex = ":".join("{:02x}".format(ord(c) for c in packet))
-            raise ModbusError("Address error; Sent=%s, Recieved=%s" % (shex, rhex))
+        return self._unpack_registers(self._decode_raw(packet, spacket))
+
+
+    @staticmethod
+    def _unpack_registers(data):
+        '''Unpack register data bytes to a tuple of registers (None stays None)'''
+        if data is not None:
+            return struct.unpack_from(">%dH" % (len(data)/2), data)
+
+
+    def _decode_raw(self, packet, spacket):
+        '''Check the response packet, returns the register data of a read (None for writes).'''
+        addr, fcode = struct.unpack_from(">BB", packet)
+        if struct.unpack_from(">B", spacket)[0] != addr:
+            ttp = (hexlify(spacket), hexlify(packet))
+            raise ModbusError("Address error; Sent=%s, Recieved=%s" % ttp)
         if fcode > 127:
-            ecode = struct.unpack(">B", packet[2])[0]
+            ecode = struct.unpack_from(">B", packet, 2)[0]
             ttp = (ecode, self.error_messages.get(ecode, 'Unknown error code'))
-            raise ModbusError('Modbus Error: Exception code = %d(%s)' % ttp)
+            raise ModbusError('Modbus Error: Exception code = %d(%s)' % ttp, ecode)
 
-        if fcode in [3, 4]: #Read input/holding register(s)
-            cnt = struct.unpack(">B", packet[2])[0]/2
-            return struct.unpack(">%dH" % cnt, packet[3:])
+        if fcode in [3, 4, 23]: #Read input/holding register(s)
+            cnt = struct.unpack_from(">B", packet, 2)[0]
+            return packet[3:3+cnt]
         elif fcode == 6:
             pass #nothing is required
         elif fcode == 16:
@@ -363,24 +915,28 @@ class ModbusRTU(Modbus):
     4: Read Input Register(s)
     6: Write Holding Register
     16: Write Multiple Holding Registers
+    23: Read/Write Multiple Registers
+
+    kwargs:
+        timeout: float (seconds allowed for the whole response to arrive, limited by the caller's
+                 time budget see deadline, default=3)
     '''
 
     def __init__(self, address, port, **kwargs):
         super(ModbusRTU, self).__init__(address, port, **kwargs)
-        #watlow suggests using 0.012 char send time for buads greater than 19200
         databits, stopbits = kwargs.get('databits', 8), kwargs.get('stopbits', 1)
         baud = kwargs.get('baud', 9600)
-        # calculated pause time does not work on the Watlow F4T, using watlow recomended delay...
-        #self.pause = 3.5 * (((databits + stopbits + 2)/ baud) if baud < 19200 else 0.012)
-        self.pause = 0.03
+        self.timeout = kwargs.get('timeout', 3)
+        self.timing = RTUTiming(**dict(kwargs, baud=baud, databits=databits, stopbits=stopbits))
         self.serial = serial.Serial(
             port=port,
             baudrate=baud,
             bytesize=databits,
             parity=kwargs.get('parity', 'N'),
             stopbits=stopbits,
-            timeout=kwargs.get('timeout', 3)
+            timeout=self.timeout
         )
+        self.flush_input = False
 
     def __del__(self):
         try:
@@ -398,45 +954,198 @@ class ModbusRTU(Modbus):
         '''
         calculate the CRC16
         '''
-        crc = 0xFFFF
-        for i in data:
-            crc = crc ^ ord(i)
-            for _ in xrange(8):
-                tmp = crc & 1
-                crc = crc >> 1
-                if tmp:
-                    crc = crc ^ 0xA001
-        return ((crc % 256) << 8) + (crc >> 8) #swap byte order
+        return crc16(data)
 
-    def interact(self, packet):
-        crc = struct.pack(">H", self._calc_crc(packet))
-        self.serial.write(packet + crc)
-        time.sleep(self.pause)
-        head = self.serial.read(2)
-        if len(head) == 0:
-            raise ModbusError("The slave device did not respond.")
-        raddress = struct.unpack('>B', head[0])[0]
-        fcode = struct.unpack('>B', head[1])[0]
-        if fcode == 16 or fcode == 6:
-            body = self.serial.read(4)
-        elif fcode == 3:
-            body = self.serial.read(1)
-            body += self.serial.read(struct.unpack('>B', body)[0])
-        elif fcode > 127:
-            body = self.serial.read(1)
+    def _response_length(self, packet):
+        '''
+        The exact length (including crc) of a successful response to a request packet.
+        '''
+        fcode = struct.unpack_from('>B', packet, 1)[0]
+        if fcode in [3, 4, 23]:
+            return 5 + 2*struct.unpack_from('>H', packet, 4)[0]
+        elif fcode in [6, 16]:
+            return 8
         else:
-            raise NotImplementedError("Only modbus function codes 3,6,16 are implimented.")
-        rcrc = struct.unpack('>H', self.serial.read(2))[0]
-        ccrc = self._calc_crc(head+body)
-        if self.address != raddress:
-            shex = ":".join(["{:02x}".format(ord(c)) for c in packet+crc])
-            rhex = ":".join(["{:02x}".format(ord(c)) for c in head+body+rcrc])
-            raise ModbusError("Address error; Sent=%s, Recieved=%s" % (shex, rhex))
-        if rcrc != ccrc:
-            shex = ":".join(["{:02x}".format(ord(c)) for c in packet+crc])
-            rhex = ":".join(["{:02x}".format(ord(c)) for c in head+body+rcrc])
-            raise ModbusError("CRC error; Sent=%s, Recieved=%s" % (shex, rhex))
-        return head + body
+            raise NotImplementedError("Only modbus function codes 3,4,6,16,23 are implimented.")
+
+    def _make_frame(self, packet):
+        '''
+        The request frame (packet + crc) to transmit.
+        '''
+        frame = bytearray(packet)
+        frame.extend(struct.pack(">H", crc16(frame)))
+        return frame
+
+    def interact(self, packet):
+        frame = self._make_frame(packet)
+        expected = self._response_length(packet)
+        self.timing.wait()
+        if self.flush_input:
+            self.serial.reset_input_buffer()
+            self.flush_input = False
+        self.serial.write(frame)
+        received = 0
+        try:
+            rframe = self._read_response(frame, expected)
+            received = len(rframe) + 2
+            return rframe
+        except ModbusError:
+            self.flush_input = True
+            raise
+        finally:
+            instrumentation.count(len(frame), received)
+            self.timing.mark()
+
+    def _read_response(self, frame, expected):
+        '''
+        Read the response to a request, blocks until the response arrives (or times out).
+
+        The first 5 bytes are read on their own as that is the length of an exception response,
+        the remainder of the predicted length is then read in a single call. The timeout (or what
+        is left of the time budget) applies to the response as a whole, the remainder is always
+        allowed the time needed to transmit it. The frame is validated in place and returned
+        without the crc.
+        '''
+        wait = deadline.timeout(self.timeout)
+        end = time.time() + wait
+        self._set_timeout(wait)
+        rframe = bytearray(self.serial.read(5))
+        if len(rframe) == 0:
+            raise deadline.timed_out(ModbusTimeoutError, "The slave device did not respond.")
+        exception = len(rframe) > 1 and rframe[1] & 0x80
+        if len(rframe) == 5 and not exception and expected > 5:
+            self._set_timeout(max(end - time.time(), self.timing.frame_time(expected - 5)))
+            rframe.extend(self.serial.read(expected - 5))
+        return self._check_response(frame, rframe, expected)
+
+    def _set_timeout(self, wait):
+        '''Set the serial port's read timeout (the port is only reconfigured if it changed)'''
+        if self.serial.timeout != wait:
+            self.serial.timeout = wait
+
+    def _check_response(self, frame, rframe, expected):
+        '''
+        Validate a received frame against the request, returns it without the crc.
+        '''
+        exception = len(rframe) > 1 and rframe[1] & 0x80
+        if len(rframe) != (5 if exception else expected):
+            ttp = (hexlify(frame), hexlify(rframe))
+            raise ModbusTimeoutError("Incomplete response; Sent=%s, Recieved=%s" % ttp)
+        if frame[0] != rframe[0]:
+            ttp = (hexlify(frame), hexlify(rframe))
+            raise ModbusError("Address error; Sent=%s, Recieved=%s" % ttp)
+        if crc16(rframe, len(rframe) - 2) != (rframe[-2] << 8) | rframe[-1]:
+            ttp = (hexlify(frame), hexlify(rframe))
+            raise ModbusCRCError("CRC error; Sent=%s, Recieved=%s" % ttp)
+        del rframe[-2:]
+        return rframe
+
+class ModbusRTUBus(ModbusRTU):
+    '''
+    A modbus RTU serial port (RS-485 bus) shared by several units.
+
+    The bus owns the serial port and schedules the transactions of every unit on it (see
+    scheduler.BusScheduler), a client for each unit is made with client(). The silent interval
+    between frames applies to the bus as a whole while each unit's turnaround time only applies
+    between consecutive requests to that unit, so other units may be addressed in the meantime::
+
+        bus = ModbusRTUBus('/dev/ttyUSB0', baud=38400)
+        chambers = [WatlowF4T(interface='RTU', adr=adr, bus=bus) for adr in range(1, 9)]
+
+    Args:
+        port (str): The serial port
+    Kwargs:
+        The ModbusRTU kwargs, profile and turnaround are the defaults for units on the bus
+    '''
+
+    def __init__(self, port, **kwargs):
+        bkwargs = dict(kwargs, profile='modbus')
+        bkwargs.pop('turnaround', None)
+        super(ModbusRTUBus, self).__init__(None, port, **bkwargs)
+        self.settings = kwargs
+        self.units = {}
+        self.scheduler = BusScheduler(self._transact_unit, self._ready)
+
+    def client(self, address, **kwargs):
+        '''
+        Make a client for a unit on the bus.
+
+        Args:
+            address (int): The modbus address of the unit
+        Kwargs:
+            profile (str): The unit's device profile (see RTU_PROFILES)
+            turnaround (float): The unit's turnaround time, overrides the profile
+            (and the Modbus kwargs: low_word_first, retry etc.)
+        Returns:
+            ModbusUnit
+        '''
+        timing = dict((key, kwargs[key]) for key in ['profile', 'turnaround'] if key in kwargs)
+        timing = RTUTiming(**dict(self.settings, **timing))
+        with self.scheduler.cond:
+            # keep the time of the unit's last transaction, a controller that is not persistent
+            # makes a new client for every call
+            if address in self.units:
+                self.units[address].turnaround = timing.turnaround
+                self.units[address].interval = timing.interval
+            else:
+                self.units[address] = timing
+        return ModbusUnit(self, address, **kwargs)
+
+    def interact(self, packet):
+        unit = struct.unpack_from('>B', packet)[0]
+        call = instrumentation.current()
+        return self.scheduler.run(unit, [(packet, deadline.current(), call)])[0]
+
+    def interact_many(self, packets):
+        units = set(struct.unpack_from('>B', packet)[0] for packet in packets)
+        if len(units) == 1:
+            when, call = deadline.current(), instrumentation.current()
+            return self.scheduler.run(units.pop(), [(packet, when, call) for packet in packets])
+        return [self.interact(packet) for packet in packets]
+
+    def _ready(self, unit):
+        '''The time at which a unit may next be sent a request'''
+        timing = self.units.get(unit)
+        return max(self.timing.ready(), timing.ready() if timing else 0)
+
+    def _transact_unit(self, unit, payload):
+        '''
+        Perform one transaction (called by the scheduler, possibly from another caller's thread
+        so the deadline and instrumented call of the caller that queued it are carried in the
+        payload)
+        '''
+        packet, when, call = payload
+        with deadline.until(when), instrumentation.attributed(call):
+            deadline.check(ModbusTimeoutError)
+            remaining = self._ready(unit) - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            try:
+                return super(ModbusRTUBus, self).interact(packet)
+            finally:
+                if unit in self.units:
+                    self.units[unit].mark()
+
+class ModbusUnit(Modbus):
+    '''
+    A client for one unit on a ModbusRTUBus (see ModbusRTUBus.client)
+    '''
+
+    def __init__(self, bus, address, **kwargs):
+        super(ModbusUnit, self).__init__(address, **kwargs)
+        self.bus = bus
+
+    def close(self):
+        '''
+        Nothing to close, the bus stays open for its other units.
+        '''
+        pass
+
+    def interact(self, packet):
+        return self.bus.interact(packet)
+
+    def interact_many(self, packets):
+        return self.bus.interact_many(packets)
 
 class ModbusTCP(Modbus):
     '''
@@ -445,16 +1154,34 @@ class ModbusTCP(Modbus):
     4: Read Input Register(s)
     6: Write Holding Register
     16: Write Multiple Holding Registers
+    23: Read/Write Multiple Registers
+
+    Each request is sent with its own MBAP transaction id, up to window requests may be
+    outstanding at once when using interact_many (window=1 is strictly one request, one response).
+
+    Responses are received into a persistent buffer and framed by the MBAP length so a response
+    split across several tcp segments is reassembled rather than short read.
+
+    kwargs:
+        window: int (maximum number of requests in flight on the socket, default=1)
+        timeout: float (seconds allowed for each response to arrive, limited by the caller's time
+                 budget see deadline, default=3)
     '''
 
     def __init__(self, address, host, port=502, **kwargs):
         super(ModbusTCP, self).__init__(address, host, **kwargs)
+        self.window = max(1, kwargs.get('window', 1))
+        self.timeout = kwargs.get('timeout', 3)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket.settimeout(timeout)
-        self.socket.setblocking(True)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(deadline.timeout(self.timeout))
         self.socket.connect((host, port))
-        self.packet_id = 1
-        time.sleep(0.1)
+        self.packet_id = 0
+        self.pending = {}
+        self.responses = {}
+        self.rxbuf = bytearray(max(4096, MAX_TCP_ADU*self.window*2))
+        self.rxview = memoryview(self.rxbuf)
+        self.rxstart, self.rxend = 0, 0
 
     def __del__(self):
         self.close()
@@ -464,7 +1191,6 @@ class ModbusTCP(Modbus):
         Close the tcp socket.
         '''
         self.socket.close()
-        time.sleep(0.1)
 
     def _make_mbap(self, length):
         '''
@@ -472,24 +1198,169 @@ class ModbusTCP(Modbus):
         '''
         return struct.pack(">3H", self.packet_id, 0, length)
 
+    def submit(self, packet):
+        '''
+        Send a request without waiting for its response.
+
+        Args:
+            packet (str): the request pdu (unit id + function + data)
+        Returns:
+            int: the transaction id to pass to collect()
+        '''
+        self.packet_id = self.packet_id + 1 if self.packet_id < 65535 else 0
+        tid = self.packet_id
+        wait = deadline.timeout(self.timeout)
+        try:
+            self.socket.sendall(self._make_mbap(len(packet)) + packet)
+        except socket.timeout:
+            msg = "Timed out sending the request to the controller"
+            raise deadline.timed_out(ModbusTimeoutError, msg)
+        instrumentation.count(6 + len(packet))
+        self.pending[tid] = time.time() + wait
+        return tid
+
+    def collect(self, tid):
+        '''
+        Wait for the response to a request sent with submit().
+
+        Responses for other outstanding requests that arrive first are held until collected,
+        responses for ids that are not outstanding (late replies to an abandoned request) are
+        discarded.
+
+        Args:
+            tid (int): the transaction id returned by submit()
+        Returns:
+            str: the response (unit id + function + data)
+        '''
+        if tid not in self.pending and tid not in self.responses:
+            raise ModbusError("MBAP id error; %r is not an outstanding request" % tid)
+        try:
+            while tid not in self.responses:
+                rtid, body = self._read_frame(self.pending[tid])
+                if rtid in self.pending:
+                    del self.pending[rtid]
+                    self.responses[rtid] = body
+        except Exception:
+            # abandon everything that is outstanding, any late replies are discarded by id
+            self.pending.clear()
+            self.responses.clear()
+            raise
+        return self.responses.pop(tid)
+
+    def _read_frame(self, until):
+        '''
+        Read one MBAP framed response from the socket, returns (transaction id, body)
+        '''
+        frame = self._next_frame()
+        while frame is None:
+            remaining = until - time.time()
+            msg = "The controller did not respond to the request."
+            if remaining <= 0:
+                raise deadline.timed_out(ModbusTimeoutError, msg)
+            self.socket.settimeout(remaining)
+            try:
+                self._recv()
+            except socket.timeout:
+                raise deadline.timed_out(ModbusTimeoutError, msg)
+            frame = self._next_frame()
+        return frame
+
+    def _next_frame(self):
+        '''
+        Take one complete MBAP frame from the receive buffer, returns (transaction id, body) or
+        None when a complete frame has not been received yet.
+        '''
+        avail = self.rxend - self.rxstart
+        if avail < 6:
+            return None
+        tid, proto, length = struct.unpack_from('>3H', self.rxbuf, self.rxstart)
+        if proto != 0 or not 2 <= length <= MAX_TCP_ADU - 6:
+            ttp = (hexlify(self.rxview[self.rxstart:self.rxstart+6].tobytes()), )
+            self.rxstart, self.rxend = 0, 0
+            raise ModbusError("MBAP error; invalid protocol id or length (%s)" % ttp)
+        if avail < 6 + length:
+            return None
+        start = self.rxstart + 6
+        self.rxstart = start + length
+        instrumentation.count(received=6 + length, transactions=0)
+        return tid, self.rxview[start:self.rxstart].tobytes()
+
+    def _recv(self):
+        '''
+        Receive what is available on the socket into the buffer (compacting it first if needed)
+        '''
+        if self.rxstart == self.rxend:
+            self.rxstart, self.rxend = 0, 0
+        elif len(self.rxbuf) - self.rxend < MAX_TCP_ADU:
+            unread = self.rxend - self.rxstart
+            self.rxbuf[:unread] = self.rxbuf[self.rxstart:self.rxend]
+            self.rxstart, self.rxend = 0, unread
+        rlen = self.socket.recv_into(self.rxview[self.rxend:])
+        if rlen == 0:
+            self.rxstart, self.rxend = 0, 0
+            raise ModbusError("The controller closed the connection.")
+        self.rxend += rlen
+
     def interact(self, packet):
         '''
         interact with the slave device
         '''
-        self.socket.send(self._make_mbap(len(packet)) + packet)
-        mbap_raw = self.socket.recv(6)
-        if len(mbap_raw) == 0:
-            raise ModbusError("The controller did not respond to the request (MBAP length = 0)")
-        if len(mbap_raw) != 6:
-            ttp = (len(mbap_raw), mbap_raw)
-            raise ModbusError("MBAP length error; expected:6, got:%s (%r)" % ttp)
-        mbap = struct.unpack('>3H', mbap_raw)
-        body = self.socket.recv(mbap[2])
-        if mbap[0] != self.packet_id:
-            ttp = (self.packet_id, mbap[0], mbap_raw)
-            raise ModbusError("MBAP id error; expected:%r, got:%r (%r)" % ttp)
-        #self.packet_id = self.packet_id + 1 if self.packet_id < 65535 else 0
-        return body
+        self.socket.settimeout(deadline.timeout(self.timeout))
+        return self.collect(self.submit(packet))
+
+    def interact_many(self, packets):
+        '''
+        Interact with the slave device keeping up to window requests in flight.
+
+        Args:
+            packets (list): the request pdus
+        Returns:
+            list: the responses, in the same order as packets
+        '''
+        self.socket.settimeout(deadline.timeout(self.timeout))
+        tids, rval = collections.deque(), []
+        for packet in packets:
+            if len(tids) >= self.window:
+                rval.append(self.collect(tids.popleft()))
+            tids.append(self.submit(packet))
+        while tids:
+            rval.append(self.collect(tids.popleft()))
+        return rval
+
+
+class ModbusReplay(Modbus):
+    '''
+    Serve the responses of a capture (see capture) in place of a device, requests that were not
+    captured raise a ModbusError.
+
+    Args:
+        address (int): The modbus address of the device
+        capture (capture.Capture): the recorded traffic
+    Kwargs:
+        The Modbus kwargs (retry, breaker, low_word_first etc.)
+    '''
+
+    def __init__(self, address, capture, **kwargs):
+        super(ModbusReplay, self).__init__(address, **kwargs)
+        if capture.transport != 'modbus':
+            raise ValueError('"%s" is not a capture of modbus traffic' % capture.path)
+        self.capture = capture
+
+    def close(self):
+        '''
+        Nothing to close.
+        '''
+        pass
+
+    def interact(self, packet):
+        rec = self.capture.exchange(packet)
+        if rec is None:
+            raise ModbusError("Replay error; Sent=%s was not captured" % hexlify(packet))
+        if 'e' in rec:
+            exc = {'timeout':ModbusTimeoutError, 'crc':ModbusCRCError}.get(rec['e'], ModbusError)
+            raise exc(rec['m'])
+        instrumentation.count(len(packet), len(rec['r']))
+        return rec['r']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,391 @@
+﻿'''
+Non-blocking versions of the modbus TCP and RTU clients for the eventloop module.
+
+Every read_*/write_* method returns a Future (from a coroutine) instead of blocking, so a single
+thread may poll many controllers at once::
+
+    loop = get_event_loop()
+    clients = [AsyncModbusTCP(1, host, timeout=1.0) for host in hosts]
+    temps = loop.run_until_complete(gather(*[c.read_holding_float(2782) for c in clients]))
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import collections
+import errno
+import socket
+import time
+from chamberconnectlibrary.modbus import Modbus, ModbusRTU, ModbusTCP, ModbusError
+from chamberconnectlibrary.modbus import ModbusTimeoutError, RegisterDecoder, SPLIT_CODES, hexlify
+from chamberconnectlibrary.eventloop import Future, Return, coroutine, gather, get_event_loop
+from chamberconnectlibrary.eventloop import sleep
+
+class AsyncModbus(Modbus):
+    '''
+    Coroutine versions of the Modbus read/write methods, mixed in ahead of a transport whose
+    interact() returns a Future.
+    '''
+
+    @coroutine
+    def _transact(self, packet, raw=False):
+        data = yield self._guarded(lambda: self._decoded_response(packet))
+        raise Return(data if raw else self._unpack_registers(data))
+
+    @coroutine
+    def _transact_many(self, packets):
+        rval = yield self._guarded(self.interact_many, packets)
+        raise Return(rval)
+
+    @coroutine
+    def _decoded_response(self, packet):
+        '''Send a request, returns the register data of the response'''
+        rval = yield self.interact(packet)
+        raise Return(self._decode_raw(rval, packet))
+
+    @coroutine
+    def _guarded(self, func, *args):
+        '''
+        Wait for func(*args) (which returns a Future) through the circuit breaker and the retry
+        policy, the waits between retries do not block the loop.
+        '''
+        if self.breaker is not None and not self.breaker.allow():
+            exc = ModbusError('The device is offline, not retrying for %.1f seconds' %
+                              self.breaker.retry_after())
+            exc.kind = 'offline'
+            raise exc
+        attempt = 0
+        while True:
+            try:
+                rval = yield func(*args)
+            except ModbusError as exc:
+                wait = self.retry.delay(exc, attempt)
+                if wait is None:
+                    if self.breaker is not None:
+                        self.breaker.failure(exc)
+                    raise
+                attempt += 1
+                yield sleep(wait)
+            else:
+                if self.breaker is not None:
+                    self.breaker.success()
+                raise Return(rval)
+
+    def interact_many(self, packets):
+        return gather(*[self.interact(packet) for packet in packets])
+
+    @coroutine
+    def _read_typed(self, function, register, count, dtype):
+        decoder = RegisterDecoder([{
+            'dtype':dtype,
+            'count':count,
+            'low_word_first':self.low_word_first
+        }])
+        packet = self._make_packet(function, register, count*decoder.words(dtype))
+        raw = yield self._transact(packet, raw=True)
+        raise Return(self._decoded(raw, decoder, dtype != 'string'))
+
+    @coroutine
+    def read_array(self, register, count=1, dtype='uint16', **kwargs):
+        fld = dict(kwargs, dtype=dtype, count=count)
+        fld.setdefault('low_word_first', self.low_word_first)
+        fld.setdefault('precision', None)
+        decoder = RegisterDecoder([fld], self.use_numpy)
+        packet = self._make_packet(4 if kwargs.get('input', False) else 3, register,
+                                   count*decoder.words(dtype))
+        raw = yield self._transact(packet, raw=True)
+        raise Return(self._decoded(raw, decoder))
+
+    def write_holding(self, register, value):
+        packettype = 16 if isinstance(value, collections.Iterable) else 6
+        return self._transact(self._make_packet(packettype, register, value))
+
+    def write_holding_signed(self, register, value):
+        if isinstance(value, collections.Iterable):
+            value = [0xFFFF & val for val in value]
+        else:
+            value = 0xFFFF & value
+        return self.write_holding(register, value)
+
+    def write_holding_float(self, register, value):
+        if isinstance(value, collections.Iterable):
+            packval = []
+            for val in value:
+                packval += self._pack32('f', val)
+        else:
+            packval = self._pack32('f', value)
+        return self.write_holding(register, packval)
+
+    def write_holding_string(self, register, value, length=20, padder=0):
+        mods = [ord(c) for c in value]
+        mods.extend([padder]*length)
+        return self.write_holding(register, mods[0:length])
+
+    @coroutine
+    def read_write_holding(self, write_register, value, read_register, count=1):
+        if self.read_write_supported:
+            wvals = list(value) if isinstance(value, collections.Iterable) else [value]
+            packet = self._make_packet(23, read_register, (count, write_register, wvals))
+            try:
+                rval = yield self._transact(packet)
+                raise Return(rval)
+            except ModbusError as exc:
+                if exc.code != 1:
+                    raise
+                self.read_write_supported = False
+        yield self.write_holding(write_register, value)
+        rval = yield self.read_holding(read_register, count)
+        raise Return(rval)
+
+    @coroutine
+    def read_item(self, **kwargs):
+        items = yield self.read_items([kwargs])
+        raise Return(items[0])
+
+    @coroutine
+    def read_plan(self, plan, items):
+        blocks = list(plan.blocks)
+        responses = yield self._transact_many([block['packet'] for block in blocks])
+        for block, rval in zip(blocks, responses):
+            try:
+                raw = self._decode_raw(rval, block['packet'])
+            except ModbusError as exc:
+                if exc.kind == 'busy':
+                    raw = yield self._transact(block['packet'], True)
+                    self._read_block(block, raw, items)
+                elif exc.code not in SPLIT_CODES or len(block['fields']) == 1:
+                    raise
+                else:
+                    sblocks = plan.split(block)
+                    for sblock in sblocks:
+                        raw = yield self._transact(sblock['packet'], True)
+                        self._read_block(sblock, raw, items)
+                    plan.replace(block, sblocks)
+            else:
+                self._read_block(block, raw, items)
+        raise Return(items)
+
+class AsyncModbusTCP(AsyncModbus, ModbusTCP):
+    '''
+    ModbusTCP client for the event loop, requests from any number of coroutines are pipelined
+    on the one socket (up to window outstanding) and matched to their responses by id.
+
+    The connection itself is made (blocking) when the client is created.
+
+    kwargs:
+        window: int (maximum number of requests in flight on the socket, default=1)
+        timeout: float (seconds allowed for each response to arrive, default=3)
+    '''
+
+    def __init__(self, address, host, port=502, **kwargs):
+        self.loop = get_event_loop()
+        self.queue = collections.deque()
+        self.futures = {}
+        super(AsyncModbusTCP, self).__init__(address, host, port, **kwargs)
+        self.socket.setblocking(False)
+        self.fdesc = self.socket.fileno()
+        self.loop.add_reader(self.fdesc, self._on_readable)
+
+    def close(self):
+        self.loop.remove_reader(self.fdesc)
+        self._fail_all(ModbusError("The connection was closed."))
+        super(AsyncModbusTCP, self).close()
+
+    def interact(self, packet):
+        '''
+        Queue a request, returns a Future for the response (unit id + function + data).
+
+        Cancelling the future abandons the request, a late response is discarded.
+        '''
+        future = Future(self.loop)
+        future.add_done_callback(self._on_done)
+        self.queue.append((packet, future))
+        self._pump()
+        return future
+
+    def _pump(self):
+        '''Send queued requests while there is room in the window'''
+        while self.queue and len(self.pending) < self.window:
+            packet, future = self.queue.popleft()
+            if future.done():
+                continue
+            try:
+                tid = self.submit(packet)
+            except (socket.error, ModbusError) as exc:
+                future.set_exception(ModbusError("Error sending the request: %s" % exc))
+                continue
+            timer = self.loop.call_later(self.timeout, self._on_timeout, tid)
+            self.futures[tid] = (future, timer)
+
+    def _on_done(self, future):
+        '''Release the window slot of a cancelled request'''
+        if not future.cancelled():
+            return
+        for tid, (pfuture, timer) in self.futures.items():
+            if pfuture is future:
+                timer.cancel()
+                del self.futures[tid]
+                self.pending.pop(tid, None)
+        self._pump()
+
+    def _on_timeout(self, tid):
+        future = self.futures.pop(tid, (None, None))[0]
+        self.pending.pop(tid, None)
+        if future is not None and not future.done():
+            exc = ModbusTimeoutError("The controller did not respond to the request.")
+            future.set_exception(exc)
+        self._pump()
+
+    def _on_readable(self):
+        try:
+            self._recv()
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.loop.remove_reader(self.fdesc)
+            self._fail_all(ModbusError("Connection error: %s" % exc))
+            return
+        except ModbusError as exc:
+            self.loop.remove_reader(self.fdesc)
+            self._fail_all(exc)
+            return
+        try:
+            frame = self._next_frame()
+            while frame is not None:
+                tid, body = frame
+                future, timer = self.futures.pop(tid, (None, None))
+                if future is not None:
+                    timer.cancel()
+                    self.pending.pop(tid, None)
+                    if not future.done():
+                        future.set_result(body)
+                frame = self._next_frame()
+        except ModbusError as exc:
+            self._fail_all(exc)
+        self._pump()
+
+    def _fail_all(self, exc):
+        '''Fail every outstanding and queued request'''
+        futures = [future for future, timer in self.futures.values()]
+        futures += [future for packet, future in self.queue]
+        for timer in [timer for future, timer in self.futures.values()]:
+            timer.cancel()
+        self.futures.clear()
+        self.pending.clear()
+        self.queue.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+class AsyncModbusRTU(AsyncModbus, ModbusRTU):
+    '''
+    ModbusRTU client for the event loop, requests are queued and sent one at a time with the
+    same inter-frame timing as ModbusRTU. The serial port is read without blocking.
+
+    kwargs:
+        timeout: float (seconds allowed for each response to arrive, default=3)
+        (and the ModbusRTU kwargs)
+    '''
+
+    def __init__(self, address, port, **kwargs):
+        self.loop = get_event_loop()
+        self.queue = collections.deque()
+        self.active = None
+        super(AsyncModbusRTU, self).__init__(address, port, **kwargs)
+        self.serial.timeout = 0
+
+    def close(self):
+        if self.active is not None:
+            self._finish(exc=ModbusError("The serial port was closed."))
+        while self.queue:
+            future = self.queue.popleft()[1]
+            if not future.done():
+                future.set_exception(ModbusError("The serial port was closed."))
+        super(AsyncModbusRTU, self).close()
+
+    def interact(self, packet):
+        '''
+        Queue a request, returns a Future for the response (without the crc).
+
+        Cancelling a queued request removes it from the queue, a request that has already been
+        sent still has its response read (and discarded) before the next request is sent.
+        '''
+        future = Future(self.loop)
+        self.queue.append((packet, future))
+        self._next()
+        return future
+
+    def _next(self):
+        '''Start the next queued request once the bus is free'''
+        if self.active is not None:
+            return
+        while self.queue and self.queue[0][1].done():
+            self.queue.popleft()
+        if not self.queue:
+            return
+        packet, future = self.queue.popleft()
+        self.active = {'packet':packet, 'future':future, 'frame':None, 'rframe':bytearray()}
+        delay = max(0, self.timing.last + self.timing.interval - time.time())
+        self.active['timer'] = self.loop.call_later(delay, self._send)
+
+    def _send(self):
+        active = self.active
+        if active['future'].done():
+            self.active = None
+            self._next()
+            return
+        try:
+            active['frame'] = self._make_frame(active['packet'])
+            active['expected'] = self._response_length(active['packet'])
+            if self.flush_input:
+                self.serial.reset_input_buffer()
+                self.flush_input = False
+            self.serial.write(active['frame'])
+        except Exception as exc:
+            self._finish(exc=exc)
+            return
+        wait = self.timing.frame_time(len(active['frame'])) + self.timeout
+        active['timer'] = self.loop.call_later(wait, self._on_timeout)
+        self.loop.add_reader(self.serial.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        active = self.active
+        if active is None:
+            return
+        try:
+            active['rframe'].extend(self.serial.read(self.serial.in_waiting or 1))
+        except Exception as exc:
+            self._finish(exc=ModbusError("Serial port error: %s" % exc))
+            return
+        rframe = active['rframe']
+        if len(rframe) < 5:
+            return
+        if len(rframe) >= (5 if rframe[1] & 0x80 else active['expected']):
+            try:
+                self._finish(self._check_response(active['frame'], rframe, active['expected']))
+            except ModbusError as exc:
+                self._finish(exc=exc)
+
+    def _on_timeout(self):
+        rframe = self.active['rframe']
+        if len(rframe) == 0:
+            self._finish(exc=ModbusTimeoutError("The slave device did not respond."))
+        else:
+            ttp = (hexlify(self.active['frame']), hexlify(rframe))
+            self._finish(exc=ModbusTimeoutError("Incomplete response; Sent=%s, Recieved=%s" % ttp))
+
+    def _finish(self, result=None, exc=None):
+        '''Complete the active request and start the next one'''
+        active, self.active = self.active, None
+        active['timer'].cancel()
+        if active['frame'] is not None:
+            self.loop.remove_reader(self.serial.fileno())
+            self.timing.mark()
+        if exc is not None:
+            self.flush_input = True
+        if not active['future'].done():
+            if exc is not None:
+                active['future'].set_exception(exc)
+            else:
+                active['future'].set_result(result)
+        self._next()
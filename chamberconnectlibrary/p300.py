@@ -6,7 +6,7 @@ A direct implimentation of the P300's communication interface.
 '''
 #pylint: disable=W0703
 import re
-from especinteract import EspecSerial, EspecTCP
+from especinteract import EspecSerial, EspecTCP, EspecReplay
 
 def tryfloat(val, default):
     '''
@@ -22,12 +22,18 @@ class P300(object):
     P300 communications basic implimentation
 
     Args:
-        interface (str): The interface type to connect to: "Serial" or "TCP"
+        interface (str): The interface type to connect to: "Serial", "TCP" or "Replay"
     Kwargs:
         serialport (str/int): The serial port to connect to when interface="Serial"
         baudrate (int): The baud rate to connect at when interface="Serial"
         address (int): The RS485 address of the chamber to connect to.
         host (str): The IP address or hostname of the chamber when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=10001)
+        retry (RetryPolicy/bool): retry policy of the transport (default=False)
+        breaker (CircuitBreaker): fail fast while the chamber is offline (default=None)
+        capture (Capture): the recorded traffic to serve when interface="Replay"
+        depth (int): requests pipelined ahead of their responses (default=1)
+        transport: an already made transport to use, the interface is then ignored
     '''
 
     def __init__(self, interface, **kwargs):
@@ -39,16 +45,31 @@ class P300(object):
             'REF9':{'mode':'auto', 'setpoint':0}
         }
         self.ramprgms = 40
-        if interface == 'Serial':
+        if kwargs.get('transport') is not None:
+            self.ctlr = kwargs['transport']
+        elif interface == 'Serial':
             self.ctlr = EspecSerial(
                 port=kwargs.get('serialport'),
                 baud=kwargs.get('baudrate'),
-                address=kwargs.get('address')
+                address=kwargs.get('address'),
+                depth=kwargs.get('depth'),
+                retry=kwargs.get('retry', False),
+                breaker=kwargs.get('breaker')
+            )
+        elif interface == 'Replay':
+            self.ctlr = EspecReplay(
+                capture=kwargs.get('capture'),
+                retry=kwargs.get('retry', False),
+                breaker=kwargs.get('breaker')
             )
         else:
             self.ctlr = EspecTCP(
                 host=kwargs.get('host'),
-                address=kwargs.get('address')
+                port=kwargs.get('port') or 10001,
+                address=kwargs.get('address'),
+                depth=kwargs.get('depth'),
+                retry=kwargs.get('retry', False),
+                breaker=kwargs.get('breaker')
             )
 
     def __del__(self):
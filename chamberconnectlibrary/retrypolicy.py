@@ -0,0 +1,234 @@
+﻿'''
+Retry and circuit breaker policies shared by the modbus and espec transports.
+
+Transport errors carry a kind attribute that selects how they are handled:
+    timeout: the device did not respond (or the response was incomplete)
+    crc: the response was corrupted
+    busy: the device responded that it is busy (modbus exception 5/6)
+    exception: the device rejected the request (retrying will not help)
+    error: any other communication error (including socket and serial port errors)
+    deadline: the caller's time budget ran out (see deadline)
+    offline: refused by an open circuit breaker
+
+Any other exception is not a transport error (kind None), it is neither retried nor counted by
+the circuit breaker.
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import random
+import socket
+import threading
+import time
+import serial
+from chamberconnectlibrary import deadline, instrumentation
+
+#errors that indicate the device (or the link to it) is not working
+LINK_ERRORS = ['timeout', 'crc', 'error']
+
+def error_kind(exc):
+    '''The kind of a transport error (see module docstring), None for any other exception'''
+    if hasattr(exc, 'kind'):
+        return exc.kind
+    if isinstance(exc, (socket.error, serial.SerialException)):
+        return 'error'
+    return None
+
+class RetryPolicy(object):
+    '''
+    How many times to retry a transaction by kind of error and how long to wait in between.
+
+    The wait before retry n (starting at 0) is backoff * factor**n limited to max_backoff, each
+    wait is randomly shortened by up to jitter (a fraction) so that clients that failed together
+    do not retry together. No retry is made if the wait would not leave any of the caller's time
+    budget (see deadline) for it.
+
+    Args:
+        retries (dict): the number of retries for each kind of error (default={}, no retries)
+    Kwargs:
+        backoff (float): seconds to wait before the first retry (default=0.05)
+        factor (float): multiplier of the wait for each further retry (default=2)
+        max_backoff (float): the longest wait between retries (default=2)
+        jitter (float): fraction of each wait that is randomized (default=0.5)
+    '''
+
+    def __init__(self, retries=None, **kwargs):
+        self.retries = dict(retries or {})
+        self.backoff = kwargs.get('backoff', 0.05)
+        self.factor = kwargs.get('factor', 2)
+        self.max_backoff = kwargs.get('max_backoff', 2)
+        self.jitter = kwargs.get('jitter', 0.5)
+
+    @classmethod
+    def make(cls, retry):
+        '''
+        Make a policy from a transport's retry kwarg.
+
+        Args:
+            retry: a RetryPolicy, True (retry link errors once immediately) or False (no retries)
+        Returns:
+            RetryPolicy
+        '''
+        if isinstance(retry, RetryPolicy):
+            return retry
+        if retry:
+            return cls(dict((kind, 1) for kind in LINK_ERRORS), backoff=0)
+        return cls()
+
+    def delay(self, exc, attempt):
+        '''
+        The time to wait before retrying after a failed attempt.
+
+        Args:
+            exc (Exception): the error of the failed attempt
+            attempt (int): the number of retries already made
+        Returns:
+            float. seconds to wait, None if the error should not be retried
+        '''
+        if attempt >= self.retries.get(error_kind(exc), 0):
+            return None
+        wait = min(self.max_backoff, self.backoff * self.factor ** attempt)
+        return wait * (1 - self.jitter * random.random())
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call func(*args, **kwargs) retrying on errors according to the policy.
+
+        Returns:
+            The result of func
+        Raises:
+            The error of the last attempt
+        '''
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                wait = self.delay(exc, attempt)
+                left = deadline.remaining()
+                if wait is None or (left is not None and wait >= left):
+                    raise
+                attempt += 1
+                instrumentation.retried()
+                if wait > 0:
+                    time.sleep(wait)
+
+class CircuitBreaker(object):
+    '''
+    Fail fast while a device is offline.
+
+    After threshold consecutive link errors (timeout/crc/error) the circuit opens and requests
+    are refused without touching the bus for reset_timeout seconds. A single trial request is
+    then let through (half open), if it succeeds the circuit closes, if not it opens again.
+    Responses from the device (including exception responses) close the circuit.
+
+    One breaker is used per device, it may be shared between the transports that are made for
+    that device (ie. one per connection) so that its state is kept across connections.
+
+    Kwargs:
+        threshold (int): consecutive failures that open the circuit (default=3)
+        reset_timeout (float): seconds to refuse requests for once open (default=10)
+    '''
+
+    def __init__(self, **kwargs):
+        self.threshold = kwargs.get('threshold', 3)
+        self.reset_timeout = kwargs.get('reset_timeout', 10)
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+
+    @classmethod
+    def make(cls, breaker):
+        '''
+        Make a breaker from a transport's breaker kwarg.
+
+        Args:
+            breaker: a CircuitBreaker, True (a default CircuitBreaker) or None (no breaker)
+        '''
+        if breaker is True:
+            return cls()
+        return breaker or None
+
+    def allow(self):
+        '''
+        Check if a request may be sent, an open circuit allows one trial request per reset_timeout
+
+        Returns:
+            bool
+        '''
+        with self.lock:
+            if self.state == 'open' and time.time() >= self.opened + self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return self.state == 'closed'
+
+    def retry_after(self):
+        '''Seconds until the next trial request will be allowed'''
+        return max(0, self.opened + self.reset_timeout - time.time())
+
+    def success(self):
+        '''Record a response from the device'''
+        with self.lock:
+            self.state, self.failures = 'closed', 0
+
+    def failure(self, exc):
+        '''
+        Record a failed request, exceptions that are not link errors count as a success except
+        deadline/offline errors and exceptions that are not transport errors which say nothing
+        about the device.
+        '''
+        if error_kind(exc) in ['deadline', 'offline', None]:
+            with self.lock:
+                if self.state == 'half-open':
+                    self.state = 'open'
+            return
+        if error_kind(exc) not in LINK_ERRORS:
+            return self.success()
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state, self.opened = 'open', time.time()
+
+    def reset(self):
+        '''Close the circuit'''
+        self.success()
+
+    def call(self, func, error, *args, **kwargs):
+        '''
+        Call func(*args, **kwargs) through the breaker.
+
+        Args:
+            func (callable): the request
+            error (class): the exception raised when the circuit is open (with kind='offline')
+        Returns:
+            The result of func
+        '''
+        if not self.allow():
+            exc = error('The device is offline, not retrying for %.1f seconds' % self.retry_after())
+            exc.kind = 'offline'
+            raise exc
+        try:
+            rval = func(*args, **kwargs)
+        except Exception as exc:
+            self.failure(exc)
+            raise
+        self.success()
+        return rval
+
+def guarded(retry, breaker, error, func, *args, **kwargs):
+    '''
+    Call func(*args, **kwargs) through a circuit breaker and a retry policy.
+
+    Args:
+        retry (RetryPolicy): the retry policy
+        breaker (CircuitBreaker): the device's breaker (None for no breaker)
+        error (class): the exception raised when the circuit is open or the time budget is spent
+    Returns:
+        The result of func
+    '''
+    deadline.check(error)
+    if breaker is None:
+        return retry.call(func, *args, **kwargs)
+    return breaker.call(retry.call, error, func, *args, **kwargs)
@@ -0,0 +1,128 @@
+﻿'''
+Transaction scheduling for a half duplex bus shared by several units (controllers)
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703
+import collections
+import threading
+import time
+
+class BusRequest(object):
+    '''A single queued transaction'''
+    __slots__ = ['unit', 'payload', 'batch', 'done', 'result', 'error']
+
+    def __init__(self, unit, payload, batch):
+        self.unit, self.payload, self.batch = unit, payload, batch
+        self.done, self.result, self.error = False, None, None
+
+class BusScheduler(object):
+    '''
+    Run transactions from any number of threads on a bus one at a time.
+
+    Requests are queued per unit, the bus is handed out round robin between the units with queued
+    requests so one busy unit cannot starve the others. Units that are not yet ready to be
+    addressed (ie still inside their turnaround time) are passed over for ready units so the bus
+    is not left idle. A batch of requests from one caller is kept in order, if one request of a
+    batch fails the rest of the batch is abandoned.
+
+    There is no worker thread, whichever waiting caller finds the bus free runs the next scheduled
+    transaction (which may be another caller's) then wakes the others.
+
+    Args:
+        transact (callable): transact(unit, payload) performs one transaction, returns the response
+        ready (callable): ready(unit) the time at which unit may next be addressed (default=None)
+    '''
+
+    def __init__(self, transact, ready=None):
+        self.transact = transact
+        self.ready = ready or (lambda unit: 0)
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.rotation = collections.deque()
+        self.busy = False
+
+    def run(self, unit, payloads):
+        '''
+        Queue transactions for a unit and wait for them to complete.
+
+        Args:
+            unit (int): the unit the transactions are for
+            payloads (list): the payload of each transaction
+        Returns:
+            list. The responses in the same order as payloads
+        Raises:
+            The exception from the first transaction that failed
+        '''
+        batch = []
+        batch.extend(BusRequest(unit, payload, batch) for payload in payloads)
+        with self.cond:
+            if unit not in self.queues:
+                self.queues[unit] = collections.deque()
+                self.rotation.append(unit)
+            self.queues[unit].extend(batch)
+            while not all(req.done for req in batch):
+                if self.busy:
+                    self.cond.wait()
+                else:
+                    self._run_next()
+        for req in batch:
+            if req.error is not None:
+                raise req.error
+        return [req.result for req in batch]
+
+    def pending(self):
+        '''The number of queued transactions'''
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def _run_next(self):
+        '''Run the next scheduled request (called with the condition held, bus free)'''
+        req = self._pick()
+        self.busy = True
+        self.cond.release()
+        try:
+            req.result = self.transact(req.unit, req.payload)
+        except Exception as exc:
+            req.error = exc
+        finally:
+            self.cond.acquire()
+            self.busy = False
+            req.done = True
+            if req.error is not None:
+                self._abandon(req)
+            self.cond.notify_all()
+
+    def _pick(self):
+        '''Take the next request, round robin between units preferring units that are ready'''
+        now = time.time()
+        best = None
+        for idx, unit in enumerate(self.rotation):
+            when = self.ready(unit)
+            if when <= now:
+                best = idx
+                break
+            if best is None or when < self.ready(self.rotation[best]):
+                best = idx
+        unit = self.rotation[best]
+        del self.rotation[best]
+        queue = self.queues[unit]
+        req = queue.popleft()
+        if queue:
+            self.rotation.append(unit)
+        else:
+            del self.queues[unit]
+        return req
+
+    def _abandon(self, failed):
+        '''Drop the queued requests of a batch after one of them failed'''
+        queue = self.queues.get(failed.unit)
+        if queue is None:
+            return
+        for req in [req for req in queue if req.batch is failed.batch]:
+            queue.remove(req)
+            req.done, req.error = True, failed.error
+        if not queue:
+            del self.queues[failed.unit]
+            self.rotation.remove(failed.unit)
@@ -0,0 +1,1664 @@
+﻿'''
+Simulated controllers for testing and benchmarking without a chamber.
+
+The Watlow F4T and F4 simulations serve the registers the WatlowF4T and WatlowF4 drivers use
+(loops, cascades, profiles, alarms, events, the part number etc.) over modbus TCP on a local
+port and/or modbus RTU on a pty (POSIX only), the Espec P300/SCP-220 simulation serves the
+text protocol used by p300.P300 over TCP and/or serial on a pty::
+
+    sim = ModbusSimulator(WatlowF4TDevice(loops=2), latency=0.005, baud=38400)
+    host, port = sim.serve_tcp()
+    chamber = WatlowF4T(interface='TCP', host=host, port=port)
+    ...
+    ttyname = sim.serve_rtu()
+    chamber = WatlowF4T(interface='RTU', serialport=ttyname, baudrate=38400)
+    ...
+    sim.close()
+
+    sim = EspecSimulator(EspecChamber(humidity=True, latency=P300_LATENCY))
+    host, port = sim.serve_tcp()
+    chamber = Espec(interface='TCP', host=host, port=port)
+
+Faults are injected at random per request (see ModbusSimulator/EspecSimulator), sim.stats counts
+requests, bytes and faults. Also runnable: python -m chamberconnectlibrary.simulator --help
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+#pylint: disable=W0703,R0902
+import math
+import os
+import random
+import re
+import select
+import socket
+import struct
+import threading
+import time
+from chamberconnectlibrary.modbus import RTUTiming, crc16, MAX_READ_COUNT, MAX_WRITE_COUNT
+
+class SimulatorError(Exception):
+    '''
+    A request the simulated device rejects
+
+    Args:
+        message (str): description of the error
+        code (int/str): the modbus exception code or espec "NA:" error to respond with
+                        (default=2, illegal address)
+    '''
+    def __init__(self, message, code=2):
+        super(SimulatorError, self).__init__(message)
+        self.code = code
+
+def approach(value, target, elapsed, tau):
+    '''Move value towards target as a first order lag with time constant tau'''
+    return target + (value - target) * math.exp(-elapsed / tau) if tau > 0 else target
+
+class ModbusDevice(object):
+    '''
+    A simulated modbus slave holding 16bit registers (holding and input registers are the same).
+
+    Subclasses seed the registers and override read_register/write_register to model behavior,
+    update() is called before each request to advance the simulation.
+
+    Args:
+        address (int): the modbus address of the device (default=1)
+    Kwargs:
+        low_word_first (bool): word order of 32bit values (default=True)
+    '''
+
+    def __init__(self, address=1, **kwargs):
+        self.address = address
+        self.low_word_first = kwargs.get('low_word_first', True)
+        self.registers = {}
+        self.missing = set()
+        self.lock = threading.RLock()
+        self.last_update = time.time()
+
+    def update(self, elapsed):
+        '''
+        Advance the simulation (called before each request)
+
+        Args:
+            elapsed (float): seconds since the last update
+        '''
+        pass
+
+    def read_register(self, register):
+        '''The value of one register'''
+        if register in self.missing:
+            raise SimulatorError('Register %d does not exist' % register)
+        return self.registers.get(register, 0)
+
+    def write_register(self, register, value):
+        '''Set one register'''
+        if register in self.missing:
+            raise SimulatorError('Register %d does not exist' % register)
+        self.registers[register] = value
+
+    def set_float(self, register, value):
+        '''Store a float in two registers'''
+        low, high = struct.unpack('<HH', struct.pack('<f', value))
+        self.registers[register], self.registers[register+1] = \
+            (low, high) if self.low_word_first else (high, low)
+
+    def get_float(self, register):
+        '''Read a float from two registers'''
+        words = (self.registers.get(register, 0), self.registers.get(register+1, 0))
+        if not self.low_word_first:
+            words = words[::-1]
+        return struct.unpack('<f', struct.pack('<HH', *words))[0]
+
+    def set_signed(self, register, value):
+        '''Store a 16bit signed integer'''
+        self.registers[register] = int(value) & 0xFFFF
+
+    def get_signed(self, register):
+        '''Read a 16bit signed integer'''
+        return struct.unpack('>h', struct.pack('>H', self.registers.get(register, 0)))[0]
+
+    def set_string(self, register, value, length, padder=0):
+        '''Store a string one character per register'''
+        chars = [ord(c) for c in value[:length]]
+        for i, val in enumerate(chars + [padder]*(length - len(chars))):
+            self.registers[register+i] = val
+
+    def get_string(self, register, length):
+        '''Read a string stored one character per register'''
+        chars = [self.registers.get(register+i, 0) & 0xFF for i in range(length)]
+        return ''.join(chr(c) for c in chars).rstrip('\x00')
+
+    def read(self, register, count):
+        '''Read count registers, returns a list'''
+        return [self.read_register(register+i) for i in range(count)]
+
+    def write(self, register, values):
+        '''Write consecutive registers (in register order)'''
+        for i, val in enumerate(values):
+            self.write_register(register+i, val)
+
+    def handle(self, pdu):
+        '''
+        Process a request.
+
+        Args:
+            pdu (str): the request (unit id + function code + data)
+        Returns:
+            str. the response (unit id + function code + data)
+        '''
+        adr, fcode = struct.unpack_from('>BB', pdu)
+        with self.lock:
+            now = time.time()
+            self.update(now - self.last_update)
+            self.last_update = now
+            try:
+                return self._dispatch(adr, fcode, pdu)
+            except SimulatorError as exc:
+                return struct.pack('>BBB', adr, fcode | 0x80, exc.code)
+            except (struct.error, IndexError):
+                return struct.pack('>BBB', adr, fcode | 0x80, 3)
+
+    def _dispatch(self, adr, fcode, pdu):
+        '''Perform the request'''
+        if fcode in [3, 4]:
+            register, count = struct.unpack_from('>HH', pdu, 2)
+            if not 1 <= count <= MAX_READ_COUNT:
+                raise SimulatorError('Illegal count', 3)
+            vals = self.read(register, count)
+            return struct.pack('>BBB%dH' % count, adr, fcode, count*2, *vals)
+        elif fcode == 6:
+            register, value = struct.unpack_from('>HH', pdu, 2)
+            self.write(register, [value])
+            return pdu[:6]
+        elif fcode == 16:
+            register, count = struct.unpack_from('>HH', pdu, 2)
+            if not 1 <= count <= MAX_WRITE_COUNT:
+                raise SimulatorError('Illegal count', 3)
+            self.write(register, struct.unpack_from('>%dH' % count, pdu, 7))
+            return pdu[:6]
+        elif fcode == 23:
+            rregister, rcount, wregister, wcount = struct.unpack_from('>HHHH', pdu, 2)
+            self.write(wregister, struct.unpack_from('>%dH' % wcount, pdu, 11))
+            vals = self.read(rregister, rcount)
+            return struct.pack('>BBB%dH' % rcount, adr, fcode, rcount*2, *vals)
+        raise SimulatorError('Illegal function', 1)
+
+class WatlowF4TDevice(ModbusDevice):
+    '''
+    Simulated Watlow F4T (the registers used by watlowf4t.WatlowF4T).
+
+    Process values follow their setpoints as a first order lag. The chamber is run/stopped by
+    the condition event key (the run state is read from module 1 io 1), profiles can be written,
+    read, started, paused and deleted.
+
+    Args:
+        address (int): the modbus address (default=1)
+    Kwargs:
+        loops (int): number of control loops (default=1)
+        cascades (int): number of cascade loops (default=0)
+        profiles (bool): profile support (default=True)
+        alarms (int): number of alarms, 6, 8 or 14 (default=6)
+        limits (list): installed limit controllers (default=[5])
+        cond_event (int): the event (key) that turns the chamber on (default=9)
+        cond_event_toggle (bool): True the key state is the run state, False each press of the
+                                  key toggles the run state (default=False)
+        tau (float): time constant of the process values in seconds (default=30)
+    '''
+    LOOP_CODES = {(1, 0):'1', (2, 0):'2', (3, 0):'3', (4, 0):'4', (0, 0):'5', (0, 1):'6',
+                  (1, 1):'7', (2, 1):'8', (3, 1):'9', (0, 2):'A', (1, 2):'B', (2, 2):'C'}
+    PROFILE_CODES = {(False, 6):'A', (False, 8):'B', (False, 14):'C',
+                     (True, 6):'D', (True, 8):'E', (True, 14):'F'}
+    EVENT_REGISTERS = [16594, 16596, 16598, 16600, 16822, 16824, 16826, 16828,
+                       6844, 6864, 6884, 6904]
+    #the active profile's editing window
+    PROFILE_START, STEP_START, STEP_SIZE, MAX_STEPS = 18606, 19094, 170, 80
+    PROFILE_CONTROL = [18888, 18890, 18920]
+
+    def __init__(self, address=1, **kwargs):
+        super(WatlowF4TDevice, self).__init__(address, **kwargs)
+        self.loops = kwargs.get('loops', 1)
+        self.cascades = kwargs.get('cascades', 0)
+        self.has_profiles = kwargs.get('profiles', True)
+        self.alarms = kwargs.get('alarms', 6)
+        self.limits = kwargs.get('limits', [5])
+        self.cond_event = kwargs.get('cond_event', 9)
+        self.cond_event_toggle = kwargs.get('cond_event_toggle', False)
+        self.run = False
+        self.tau = kwargs.get('tau', 30.0)
+        self.profiles = {}
+        self.active = 1
+        partno = list('F4T1H1AAAAA1AAA')
+        partno[6] = self.PROFILE_CODES[(self.has_profiles, self.alarms)]
+        partno[11] = self.LOOP_CODES[(self.loops, self.cascades)]
+        self.set_string(16, ''.join(partno), 15)
+        for i in range(self.loops):
+            ofs = i*160
+            temp = i == 0
+            self.set_float(2782+ofs, 23.0 if temp else 50.0) #constant setpoint
+            self.set_float(2810+ofs, 23.0 if temp else 50.0) #current setpoint
+            self.set_float(2820+ofs, 23.0 if temp else 50.0) #process value
+            self.set_float(2776+ofs, 180.0 if temp else 98.0) #range max
+            self.set_float(2774+ofs, -70.0 if temp else 10.0) #range min
+            self.registers[2730+ofs] = self.registers[2814+ofs] = 10 #auto
+            self.set_float(2784+ofs, 0.0)
+            self.set_float(2808+ofs, 0.0)
+        for i in range(self.cascades):
+            ofs = i*200
+            for reg in [4042, 4188, 4190, 4180, 4182]:
+                self.set_float(reg+ofs, 23.0)
+            self.set_float(4036+ofs, 180.0)
+            self.set_float(4034+ofs, -70.0)
+            self.set_float(4170+ofs, 5.0)
+            self.set_float(4168+ofs, -5.0)
+            self.set_float(4044+ofs, 0.0)
+            self.set_float(4178+ofs, 0.0)
+            self.registers[4010+ofs] = self.registers[4012+ofs] = 10
+            self.registers[4200+ofs] = 63
+        for i in range(self.loops + self.cascades):
+            #profile pv sources: temperature for the first loop, %RH for the second
+            self.registers[16536+i*2] = 1540 if i != 1 else 1538
+        self.registers[6730] = self.registers[14080] = 15 #celsius
+        for reg in self.EVENT_REGISTERS:
+            self.registers[reg] = 62
+        for i in range(self.alarms):
+            self.registers[1356+100*i] = 61
+        for i in range(6):
+            regs = [11250+60*i, 11288+60*i, 11264+60*i]
+            if i+1 in self.limits:
+                self.registers[regs[0]], self.registers[regs[1]], self.registers[regs[2]] = \
+                    138, 61, 138
+            else:
+                self.missing.update(regs)
+        self.registers[16568] = 61 #profile status: none
+        now = time.localtime()
+        for i, val in enumerate([now.tm_hour, now.tm_min, now.tm_sec, now.tm_mon, now.tm_mday,
+                                 now.tm_year]):
+            self.registers[14664+i*2] = val
+
+    def event(self, number):
+        '''The state of an event (1-12)'''
+        return self.registers.get(self.EVENT_REGISTERS[number-1]) == 63
+
+    def update(self, elapsed):
+        for i in range(self.loops):
+            ofs = i*160
+            target = self.get_float(2782+ofs)
+            self.set_float(2810+ofs, target)
+            pvl = approach(self.get_float(2820+ofs), target, elapsed, self.tau)
+            self.set_float(2820+ofs, pvl)
+            self.set_float(2808+ofs, max(-100.0, min(100.0, (target - pvl) * 10)))
+        for i in range(self.cascades):
+            ofs = i*200
+            target = self.get_float(4042+ofs)
+            self.set_float(4188+ofs, target)
+            self.set_float(4190+ofs, target)
+            air = approach(self.get_float(4182+ofs), target, elapsed, self.tau / 2)
+            self.set_float(4182+ofs, air)
+            self.set_float(4180+ofs, approach(self.get_float(4180+ofs), air, elapsed, self.tau))
+
+    def _in_window(self, register):
+        '''True if the register is in the active profile's editing window'''
+        end = self.STEP_START + self.STEP_SIZE*self.MAX_STEPS
+        return self.PROFILE_START <= register < end and register not in self.PROFILE_CONTROL
+
+    def step_count(self, number):
+        '''The number of steps of a profile (0 if it does not exist)'''
+        prof = self.profiles.get(number)
+        if prof is None:
+            return 0
+        for i in range(self.MAX_STEPS):
+            stype = prof.get(self.STEP_START + i*self.STEP_SIZE, 0)
+            if stype == 0:
+                return i
+            if stype == 27: #end
+                return i + 1
+        return self.MAX_STEPS
+
+    def read_register(self, register):
+        if register == 18920:
+            return self.step_count(self.active)
+        if self._in_window(register):
+            return self.profiles.get(self.active, {}).get(register, 0)
+        if register == 33718: #run input (module 1 io 1)
+            return 63 if self.run else 62
+        return super(WatlowF4TDevice, self).read_register(register)
+
+    def write_register(self, register, value):
+        if register == 18888:
+            if not 1 <= value <= 40:
+                raise SimulatorError('Invalid profile number', 3)
+            self.active = value
+        elif register == 18890:
+            if value == 1375: #add
+                self.profiles[self.active] = {}
+            elif value == 1772: #delete
+                self.profiles.pop(self.active, None)
+                self.set_string(16886+(self.active-1)*40, '', 20)
+        elif self._in_window(register):
+            self.profiles.setdefault(self.active, {})[register] = value
+            if register < self.PROFILE_START + 20: #profile name
+                self.registers[16886 + (self.active-1)*40 + register - self.PROFILE_START] = value
+        elif register == 16562 and value == 1782: #start
+            profile = self.registers.get(16558, 1)
+            if self.step_count(profile) == 0:
+                raise SimulatorError('Profile %d does not exist' % profile, 4)
+            self.registers[16568], self.run = 149, True
+            self.registers[16588], self.registers[16590] = profile, self.registers.get(16560, 1)
+        elif register == 16566 and value in [146, 148]: #pause/terminate
+            self.registers[16568] = 146 if value == 146 else 61
+        elif register == 16564 and value == 147: #resume
+            if self.registers.get(16568) == 146:
+                self.registers[16568] = 149
+        elif register in [6850+i*20 for i in range(4)]: #key press
+            number = 9 + (register - 6850) // 20
+            self.registers[self.EVENT_REGISTERS[number-1]] = 63 if value == 1457 else 62
+            if number == self.cond_event:
+                if self.cond_event_toggle:
+                    self.run = value == 1457
+                elif value == 1457:
+                    self.run = not self.run
+                if not self.run:
+                    self.registers[16568] = 61
+        else:
+            super(WatlowF4TDevice, self).write_register(register, value)
+
+class WatlowF4Device(ModbusDevice):
+    '''
+    Simulated Watlow F4 (the registers used by watlowf4.WatlowF4).
+
+    Values are scaled 16bit integers with one decimal place, profiles are edited through the
+    profile/step/action registers (4000-4002) and the step window (4003-4062).
+
+    Args:
+        address (int): the modbus address (default=1)
+    Kwargs:
+        loops (int): number of control loops, 1 or 2 (default=1)
+        cascades (int): number of cascade loops, 0 or 1 (default=0)
+        tau (float): time constant of the process values in seconds (default=30)
+    '''
+    MAX_PROFILES, MAX_STEPS = 40, 256
+    NO_STEP = 6
+
+    def __init__(self, address=1, **kwargs):
+        super(WatlowF4Device, self).__init__(address, **kwargs)
+        self.loops = kwargs.get('loops', 1)
+        self.cascades = kwargs.get('cascades', 0)
+        self.tau = kwargs.get('tau', 30.0)
+        self.profiles = {}
+        channels = self.loops + self.cascades
+        for reg, vals in [(600, [0, 2, 4]), (606, [1, 1, 1]), (608, [0, 1, 3])]:
+            for i, val in enumerate(vals):
+                self.registers[reg+i*10] = val
+        self.registers[901] = 1 #celsius
+        for i, (spr, pvr, rng) in enumerate([(300, 100, (-700, 1800)), (319, 104, (100, 980))]):
+            if i < channels:
+                self.set_signed(spr, 230 if i == 0 else 500)
+                self.set_signed(pvr, 230 if i == 0 else 500)
+                self.set_signed(602+i*10, rng[0])
+                self.set_signed(603+i*10, rng[1])
+            else:
+                self.missing.add(spr)
+        self.registers[1925] = 1 if self.cascades else 0
+        self.set_signed(108, 230)
+        self.set_signed(1922, 230)
+        self.set_signed(1926, -50)
+        self.set_signed(1927, 50)
+        for i in range(4):
+            self.registers[201+12*i] = 1 #digital inputs (no alarms)
+        now = time.localtime()
+        self.registers.update(dict(zip(range(1916, 1922), [
+            now.tm_hour, now.tm_min, now.tm_sec, now.tm_mon, now.tm_mday, now.tm_year
+        ])))
+        self.registers[4000], self.registers[4001] = 1, 1
+
+    def update(self, elapsed):
+        running = self.registers.get(200) in [2, 3]
+        for i, (spr, pvr) in enumerate([(300, 100), (319, 104)][:self.loops + self.cascades]):
+            target = self.get_signed(spr)
+            if running:
+                self.set_signed(4122+i, target)
+            pvl = approach(self.get_signed(pvr), target, elapsed, self.tau)
+            self.set_signed(pvr, int(round(pvl)))
+            self.set_signed(103+i*8, max(-10000, min(10000, (target - pvl) * 100)))
+        if self.cascades:
+            self.set_signed(1922, self.get_signed(300))
+            pvl = approach(self.get_signed(108), self.get_signed(100), elapsed, self.tau)
+            self.set_signed(108, int(round(pvl)))
+
+    def _step(self):
+        '''The selected step (None if it does not exist)'''
+        steps = self.profiles.get(self.registers.get(4000))
+        idx = self.registers.get(4001, 1) - 1
+        return steps[idx] if steps is not None and 0 <= idx < len(steps) else None
+
+    def read_register(self, register):
+        if register == 1218: #profiles available
+            return self.MAX_PROFILES - len(self.profiles)
+        if register == 1219: #steps available
+            return self.MAX_STEPS - sum(len(steps) for steps in self.profiles.values())
+        if 4003 <= register <= 4062:
+            step = self._step()
+            if step is None:
+                return self.NO_STEP if register == 4003 else 0
+            return step.get(register, 0)
+        return super(WatlowF4Device, self).read_register(register)
+
+    def write_register(self, register, value):
+        if register == 4002:
+            self._action(value)
+        elif 4003 <= register <= 4062:
+            step = self._step()
+            if step is None:
+                raise SimulatorError('Step does not exist', 3)
+            step[register] = value
+        elif register == 1217: #terminate
+            self.registers[200] = 0
+        elif register == 1210 and self.registers.get(200) == 2: #pause
+            self.registers[200] = 3
+        elif register == 1209 and self.registers.get(200) == 3: #resume
+            self.registers[200] = 2
+        elif register == 25: #save to eeprom
+            pass
+        else:
+            super(WatlowF4Device, self).write_register(register, value)
+
+    def _action(self, action):
+        '''Perform a profile action (register 4002)'''
+        number = self.registers.get(4000)
+        if action == 1: #create, the new profile's number is placed in 4000
+            free = [i for i in range(1, self.MAX_PROFILES+1) if i not in self.profiles]
+            if not free:
+                raise SimulatorError('No profiles available', 4)
+            self.profiles[free[0]] = [{4003:5}]
+            self.registers[4000], self.registers[4001] = free[0], 1
+        elif action == 2: #insert a step before the selected step
+            steps = self.profiles.get(number)
+            idx = self.registers.get(4001, 1) - 1
+            if steps is None or not 0 <= idx < len(steps):
+                raise SimulatorError('Step does not exist', 3)
+            steps.insert(idx, {4003:3})
+        elif action == 3: #delete
+            self.profiles.pop(number, None)
+            self.set_string(3500+10*(number-1), '', 10, 32)
+        elif action == 5: #start
+            if self._step() is None:
+                raise SimulatorError('Step does not exist', 3)
+            self.registers[200] = 2
+            self.registers[4100], self.registers[4101] = number, self.registers.get(4001)
+
+#rough response times of a P300 (seconds by command prefix, the longest matching prefix is used)
+P300_LATENCY = {'':0.05, 'PRGM DATA?':0.08, 'PRGM DATA PTC?':0.08, 'PRGM USE?':0.08,
+                'PRGM DATA WRITE':0.15, 'PRGM ERASE':0.3}
+
+class EspecChamber(object):
+    '''
+    Simulated Espec P300/SCP-220 chamber controller (the commands used by p300.P300).
+
+    Process values follow their setpoints as a first order lag while the chamber is operating,
+    programs can be written, read, run (steps advance in real time, counters loop), paused,
+    advanced and erased. Requests the controller would refuse get its "NA:" responses.
+
+    Kwargs:
+        address (int): the RS-485 address (default=None, answer every request)
+        ctlr_type (str): "P300" or "SCP220" (default="P300")
+        humidity (bool): the chamber has humidity control (default=True)
+        ptc (bool): the chamber has product temperature control (default=False)
+        tau (float): time constant of the process values in seconds (default=30)
+        latency (float/dict): response time in seconds of every command, or by command prefix
+                              see P300_LATENCY (default=0)
+    '''
+    AMBIENT = {'temp':23.0, 'humi':50.0}
+    REFRIG = ['REF0', 'REF1', 'REF3', 'REF6', 'REF9']
+    END_MODES = ['OFF', 'STANDBY', 'CONSTANT', 'HOLD', 'RUN']
+
+    def __init__(self, **kwargs):
+        self.address = kwargs.get('address')
+        self.ctlr_type = kwargs.get('ctlr_type', 'P300')
+        self.ramprgms = 40 if self.ctlr_type == 'P300' else 20
+        self.tau = kwargs.get('tau', 30.0)
+        latency = kwargs.get('latency', 0)
+        self.latency = {'':0}
+        self.latency.update(latency if isinstance(latency, dict) else {'':latency})
+        self.temp = {'pv':23.0, 'sp':23.0, 'max':150.0, 'min':-70.0}
+        self.humi = None
+        if kwargs.get('humidity', True):
+            self.humi = {'pv':50.0, 'sp':50.0, 'max':98.0, 'min':5.0}
+        self.ptc = None
+        if kwargs.get('ptc', False):
+            self.ptc = {'enable':False, 'pv':23.0, 'devp':5.0, 'devn':-5.0, 'max':150.0,
+                        'min':-70.0, 'p':1.0, 'filter':0.0, 'i':10.0, 'opt1':0.0, 'opt2':0.0}
+        self.ref = 'REF9'
+        self.relays = set()
+        self.alarms = []
+        self.keyprotect = False
+        self.ipset = ['192.168.0.2', '255.255.255.0', '192.168.0.1']
+        self.mode = 'STANDBY'
+        self.programs = {}
+        self.run = None
+        self.edit = None
+        self.clock = 0
+        self.lock = threading.RLock()
+        self.last_update = time.time()
+
+    def latency_of(self, command):
+        '''The response time of a command'''
+        prefix = max((key for key in self.latency if command.startswith(key)), key=len)
+        return self.latency[prefix]
+
+    def handle(self, command):
+        '''
+        Process a command.
+
+        Args:
+            command (str): the command (without delimeter or address)
+        Returns:
+            str. the response (without delimeter)
+        '''
+        with self.lock:
+            now = time.time()
+            self.update(now - self.last_update)
+            self.last_update = now
+            try:
+                for pattern, method in self.COMMANDS:
+                    parsed = re.match(pattern + '$', command)
+                    if parsed:
+                        return getattr(self, method)(*parsed.groups())
+                raise SimulatorError('Unrecognized command', 'CMD ERR')
+            except SimulatorError as exc:
+                return 'NA:%s' % exc.code
+            except (ValueError, KeyError, IndexError):
+                return 'NA:PARA ERR'
+
+    # --- state --- state --- state --- state --- state --- state --- state --- state --- state ---
+    def update(self, elapsed):
+        '''
+        Advance the simulation (called before each command)
+
+        Args:
+            elapsed (float): seconds since the last update
+        '''
+        run = self.run
+        if run is not None and not run['paused'] and not run['hold']:
+            run['left'] -= elapsed
+            for _ in range(1000): #guard against programs of 0 length steps
+                if run['left'] > 0 or self.run is not run:
+                    break
+                self._next_step()
+        operating = self.mode not in ['OFF', 'STANDBY']
+        temp_sp, humi_sp = self.setpoints()
+        target = temp_sp if operating else self.AMBIENT['temp']
+        self.temp['pv'] = approach(self.temp['pv'], target, elapsed, self.tau)
+        if self.ptc is not None:
+            self.ptc['pv'] = approach(self.ptc['pv'], self.temp['pv'], elapsed, self.tau)
+        if self.humi is not None:
+            target = humi_sp if operating and humi_sp is not None else self.AMBIENT['humi']
+            self.humi['pv'] = approach(self.humi['pv'], target, elapsed, self.tau)
+
+    def setpoints(self):
+        '''The current (temperature, humidity) setpoints, humidity is None when off'''
+        humi = self.humi['sp'] if self.humi is not None else None
+        run = self.run
+        if run is None:
+            return self.temp['sp'], humi
+        step = run['steps'][run['step']-1]
+        done = 1 - max(0.0, run['left']) / step['duration'] if step['duration'] else 1
+        temp = step['temp']
+        if step['tramp']:
+            temp = run['temp'] + (temp - run['temp']) * done
+        if self.humi is not None:
+            humi = step['humi']
+            if humi is not None and step['hramp'] and run['humi'] is not None:
+                humi = run['humi'] + (humi - run['humi']) * done
+        return temp, humi
+
+    def _start(self, number, steps, step=1, remote=False):
+        '''Start running a program (or a remote program) at a step'''
+        temp, humi = self.setpoints()
+        prgm = self.programs.get(number, {})
+        self.run = {'number':number, 'steps':steps, 'step':step, 'paused':False, 'hold':False,
+                    'remote':remote, 'temp':temp, 'humi':humi,
+                    'left':steps[step-1]['duration'],
+                    'count_a':prgm.get('counter_a', (0, 0, 0))[2],
+                    'count_b':prgm.get('counter_b', (0, 0, 0))[2]}
+        self.mode = 'RMT RUN' if remote else 'RUN'
+
+    def _next_step(self):
+        '''Move the running program on to its next step'''
+        run = self.run
+        prgm = self.programs.get(run['number'], {})
+        ca_start, ca_end, ca_cycles = prgm.get('counter_a', (0, 0, 0))
+        cb_start, cb_end, cb_cycles = prgm.get('counter_b', (0, 0, 0))
+        run['temp'], run['humi'] = self.setpoints()
+        if ca_cycles and run['step'] == ca_end and run['count_a'] > 0:
+            run['count_a'] -= 1
+            run['step'] = ca_start
+        elif cb_cycles and run['step'] == cb_end and run['count_b'] > 0:
+            run['count_b'] -= 1
+            run['count_a'] = ca_cycles
+            run['step'] = cb_start
+        elif run['step'] < len(run['steps']):
+            run['step'] += 1
+        else:
+            self._end(prgm.get('end', 'STANDBY'), prgm.get('next', 0))
+            return
+        run['left'] += run['steps'][run['step']-1]['duration']
+
+    def _end(self, mode, next_prgm=0):
+        '''End the running program'''
+        if mode == 'HOLD':
+            self.run['hold'], self.run['left'] = True, 0
+            return
+        temp, humi = self.setpoints()
+        self.run = None
+        if mode == 'RUN' and next_prgm in self.programs:
+            self._start(next_prgm, self.programs[next_prgm]['steps'])
+        else:
+            self.temp['sp'] = temp
+            if self.humi is not None:
+                self.humi['sp'] = humi
+            self.mode = {'CONST':'CONSTANT'}.get(mode, mode)
+
+    def mode_detail(self):
+        '''The MODE?,DETAIL response'''
+        if self.run is None:
+            return self.mode
+        return self.mode + (' END HOLD' if self.run['hold'] else
+                            ' PAUSE' if self.run['paused'] else '')
+
+    def _program(self, area, number):
+        '''A stored program by its area (RAM/ROM) and number'''
+        number = int(number)
+        if area != 'RAM' or number not in self.programs:
+            raise SimulatorError('No such program', 'DATA NOT READY')
+        return self.programs[number]
+
+    def _require(self, option):
+        '''Refuse commands for options the chamber does not have'''
+        if option is None:
+            raise SimulatorError('Option not installed', 'CONT NOT READY-1')
+
+    def _p300_only(self):
+        '''Refuse commands the SCP-220 does not have'''
+        if self.ctlr_type != 'P300':
+            raise SimulatorError('Not supported', 'INVALID REQ')
+
+    def _running(self, remote=False):
+        '''The running program, refuses the command if no program is running'''
+        if self.run is None or self.run['remote'] != remote:
+            raise SimulatorError('No program running', 'CONT NOT READY-2')
+        return self.run
+
+    @staticmethod
+    def _relays(relays):
+        '''Format a list of relay numbers'''
+        return ','.join([str(len(relays))] + [str(i) for i in sorted(relays)])
+
+    @staticmethod
+    def _hhmm(seconds):
+        '''Format a number of seconds as hours:minutes'''
+        minutes = int(math.ceil(max(0, seconds) / 60.0))
+        return '%d:%02d' % (minutes // 60, minutes % 60)
+
+    def _fmt_ptc_deviation(self, value):
+        '''The SCP-220 reports the negative deviation as a magnitude'''
+        return abs(value) if self.ctlr_type != 'P300' else value
+
+    # --- queries --- queries --- queries --- queries --- queries --- queries --- queries ---
+    def q_rom(self, disp):
+        '''ROM?'''
+        return 'P300 V1.30' if self.ctlr_type == 'P300' else 'SCP220 V2.10'
+
+    def q_date(self):
+        '''DATE?'''
+        now = time.localtime(time.time() + self.clock)
+        return '%02d.%02d/%02d' % (now.tm_year % 100, now.tm_mon, now.tm_mday)
+
+    def q_time(self):
+        '''TIME?'''
+        now = time.localtime(time.time() + self.clock)
+        return '%02d:%02d:%02d' % (now.tm_hour, now.tm_min, now.tm_sec)
+
+    def q_srq(self):
+        '''SRQ?/MASK?'''
+        return '0000000'
+
+    def q_timer(self):
+        '''TIMER ON?/TIMER USE?'''
+        return '0'
+
+    def q_alarm(self):
+        '''ALARM?'''
+        return self._relays(self.alarms)
+
+    def q_keyprotect(self):
+        '''KEYPROTECT?'''
+        return 'ON' if self.keyprotect else 'OFF'
+
+    def q_type(self):
+        '''TYPE?'''
+        sensors = ['DRY', 'WET'] if self.humi is not None else ['T']
+        return ','.join(sensors + [self.ctlr_type, '%0.1f' % self.temp['max']])
+
+    def q_mode(self, detail):
+        '''MODE?'''
+        if detail:
+            self._p300_only()
+            return self.mode_detail()
+        return 'RUN' if self.run is not None else self.mode
+
+    def q_mon(self, detail):
+        '''MON?'''
+        humi = '%0.0f' % self.humi['pv'] if self.humi is not None else ''
+        return '%0.1f,%s,%s,%d' % (self.temp['pv'], humi, self.q_mode(detail), len(self.alarms))
+
+    def q_temp(self):
+        '''TEMP?'''
+        return '%0.1f,%0.1f,%0.1f,%0.1f' % (self.temp['pv'], self.setpoints()[0],
+                                            self.temp['max'], self.temp['min'])
+
+    def q_humi(self):
+        '''HUMI?'''
+        self._require(self.humi)
+        humi_sp = self.setpoints()[1]
+        return '%0.0f,%s,%0.0f,%0.0f' % (self.humi['pv'], 'OFF' if humi_sp is None else
+                                         '%0.0f' % humi_sp, self.humi['max'], self.humi['min'])
+
+    def q_set(self):
+        '''SET?'''
+        if self.run is not None:
+            return self.run['steps'][self.run['step']-1]['ref']
+        return self.ref
+
+    def q_ref(self):
+        '''REF?'''
+        stage = self.mode not in ['OFF', 'STANDBY'] and self.q_set() != 'REF0'
+        return 'REF,%s1,OFF2' % ('ON' if stage else 'OFF')
+
+    def q_relay(self):
+        '''RELAY?'''
+        if self.run is not None:
+            return self._relays(self.run['steps'][self.run['step']-1]['relays'])
+        return self._relays(self.relays)
+
+    def q_htr(self):
+        '''%?'''
+        temp_sp, humi_sp = self.setpoints()
+        outputs = [max(0.0, min(100.0, (temp_sp - self.temp['pv']) * 10))]
+        if self.humi is not None:
+            target = humi_sp if humi_sp is not None else self.humi['pv']
+            outputs.append(max(0.0, min(100.0, (target - self.humi['pv']) * 5)))
+        return ','.join([str(len(outputs))] + ['%0.1f' % val for val in outputs])
+
+    def q_constant(self, item):
+        '''CONSTANT SET?,...'''
+        if item == 'TEMP':
+            return '%0.1f,ON' % self.temp['sp']
+        elif item == 'HUMI':
+            self._require(self.humi)
+            humi = self.humi['sp']
+            return '%0.0f,%s' % (humi or 0, 'OFF' if humi is None else 'ON')
+        elif item == 'REF':
+            return {'REF0':'OFF', 'REF1':'20', 'REF3':'50', 'REF6':'100'}.get(self.ref, 'AUTO')
+        elif item == 'RELAY':
+            return self._relays(self.relays)
+        elif item == 'PTC':
+            self._require(self.ptc)
+            return '%s,%0.1f,%0.1f' % ('ON' if self.ptc['enable'] else 'OFF', self.ptc['devp'],
+                                       self._fmt_ptc_deviation(self.ptc['devn']))
+        raise SimulatorError('Unknown parameter', 'PARA ERR')
+
+    def q_prgm_mon(self):
+        '''PRGM MON?'''
+        run = self._running()
+        temp, humi = self.setpoints()
+        fields = [str(run['step']), '%0.1f' % temp]
+        if self.humi is not None:
+            fields.append('OFF' if humi is None else '%0.0f' % humi)
+        return ','.join(fields + [self._hhmm(run['left']), str(run['count_a']),
+                                  str(run['count_b'])])
+
+    def q_prgm_set(self):
+        '''PRGM SET?'''
+        run = self._running()
+        prgm = self.programs.get(run['number'], {})
+        return 'RAM:%d,%s,END(%s)' % (run['number'], prgm.get('name', ''),
+                                      prgm.get('end', 'STANDBY'))
+
+    def q_prgm_use(self, number):
+        '''PRGM USE?,RAM[:N]'''
+        if number is None:
+            return self._relays(self.programs.keys())
+        prgm = self._program('RAM', number)
+        return '%s,%s' % (prgm['name'], time.strftime('%y.%m/%d', time.localtime(prgm['date'])))
+
+    def q_prgm_data(self, ptc, area, number, detail, step):
+        '''PRGM DATA?/PRGM DATA PTC?'''
+        if ptc:
+            self._require(self.ptc)
+        prgm = self._program(area, number)
+        if detail:
+            self._p300_only()
+            fields = ['%0.1f' % prgm['htemp'], '%0.1f' % prgm['ltemp']]
+            if self.humi is not None:
+                fields += ['%0.0f' % prgm['hhumi'], '%0.0f' % prgm['lhumi']]
+            fields.append('TEMP' + prgm['pre_temp'][0])
+            if prgm['pre_temp'][0] == 'SV':
+                fields.append('%0.1f' % prgm['pre_temp'][1])
+            if self.humi is not None:
+                fields.append('HUMI' + prgm['pre_humi'][0])
+                if prgm['pre_humi'][0] == 'SV':
+                    fields.append('%0.0f' % prgm['pre_humi'][1])
+            return ','.join(fields)
+        if step:
+            return self._fmt_step(int(step), prgm['steps'][int(step)-1], ptc)
+        end = prgm['end'] if prgm['end'] != 'RUN' else 'RUN:%d' % prgm['next']
+        return '%d,<%s>,COUNT,A(%d.%d.%d),B(%d.%d.%d),END(%s)' % (
+            (len(prgm['steps']), prgm['name']) + prgm['counter_a'] + prgm['counter_b'] + (end,)
+        )
+
+    def _fmt_step(self, number, step, ptc):
+        '''Format a program step'''
+        fields = [str(number), 'TEMP%0.1f' % step['temp'],
+                  'TEMP RAMP %s' % ('ON' if step['tramp'] else 'OFF')]
+        if ptc:
+            fields.append('PTC %s' % ('ON' if step['ptc'] else 'OFF'))
+        if self.humi is not None:
+            if step['humi'] is None:
+                fields.append('HUMI OFF')
+            else:
+                fields += ['HUMI%0.0f' % step['humi'],
+                           'HUMI RAMP %s' % ('ON' if step['hramp'] else 'OFF')]
+        minutes = step['duration'] // 60
+        fields += ['TIME%d:%02d' % (minutes // 60, minutes % 60),
+                   'GRANTY %s' % ('ON' if step['granty'] else 'OFF'), step['ref']]
+        if step['relays']:
+            fields.append('RELAY ON%s' % '.'.join(str(i) for i in sorted(step['relays'])))
+        fields.append('PAUSE %s' % ('ON' if step['paused'] else 'OFF'))
+        if ptc:
+            fields += ['DEVP%0.1f' % step['devp'],
+                       'DEVN%0.1f' % self._fmt_ptc_deviation(step['devn'])]
+        return ','.join(fields)
+
+    def q_system_set(self, item):
+        '''SYSTEM SET?,...'''
+        return 'PTCON' if self.ptc is not None else 'NONE'
+
+    def q_mon_ptc(self):
+        '''MON PTC?'''
+        self._require(self.ptc)
+        fields = ['%0.1f' % self.ptc['pv'], '%0.1f' % self.temp['pv']]
+        if self.humi is not None:
+            fields.append('%0.0f' % self.humi['pv'])
+        return ','.join(fields + [self.q_mode(None), str(len(self.alarms))])
+
+    def q_temp_ptc(self):
+        '''TEMP PTC?'''
+        self._require(self.ptc)
+        temp = self.setpoints()[0]
+        enable = self.ptc['enable']
+        if self.run is not None:
+            enable = self.run['steps'][self.run['step']-1]['ptc']
+        setpoints = ['%0.1f' % temp, '%0.1f' % temp]
+        return ','.join(['ON' if enable else 'OFF', '%0.1f' % self.ptc['pv'],
+                         '%0.1f' % self.temp['pv']] + setpoints +
+                        ['%0.1f' % self.ptc['devp'],
+                         '%0.1f' % self._fmt_ptc_deviation(self.ptc['devn'])])
+
+    def q_set_ptc(self):
+        '''SET PTC?'''
+        return self.q_constant('PTC')
+
+    def q_ptc(self):
+        '''PTC?'''
+        self._require(self.ptc)
+        return ','.join('%0.1f' % self.ptc[key] for key in ['max', 'min', 'p', 'filter', 'i',
+                                                            'opt1', 'opt2'])
+
+    def q_run_prgm_mon(self):
+        '''RUN PRGM MON?'''
+        run = self._running(True)
+        temp, humi = self.setpoints()
+        fields = ['1', '%0.1f' % temp]
+        if self.humi is not None:
+            fields.append('%0.0f' % (humi or 0))
+        return ','.join(fields + [self._hhmm(run['left']), '0'])
+
+    def q_run_prgm(self):
+        '''RUN PRGM?'''
+        step = self._running(True)['steps'][0]
+        rsp = 'TEMP%0.1f GOTEMP%0.1f' % (step['start_temp'], step['temp'])
+        if step['humi'] is not None:
+            rsp += ' HUMI%0.0f GOHUMI%0.0f' % (step['start_humi'], step['humi'])
+        minutes = step['duration'] // 60
+        rsp += ' TIME%d:%d %s' % (minutes // 60, minutes % 60, step['ref'])
+        if step['relays']:
+            rsp += ' RELAYON,%s' % ','.join(str(i) for i in sorted(step['relays']))
+        return rsp
+
+    def q_ipset(self):
+        '''IPSET?'''
+        self._p300_only()
+        return ','.join(self.ipset)
+
+    # --- writes --- writes --- writes --- writes --- writes --- writes --- writes --- writes ---
+    def w_ok(self, *args):
+        '''Commands that are accepted but not simulated'''
+        return 'OK'
+
+    def w_date(self, year, month, day):
+        '''DATE,yy.mm/dd'''
+        now = time.time() + self.clock
+        cur = time.localtime(now)
+        new = time.mktime((2000 + int(year), int(month), int(day)) + cur[3:6] + (0, 0, -1))
+        self.clock += new - now
+        return 'OK'
+
+    def w_time(self, hour, minute, second):
+        '''TIME,hh:mm:ss'''
+        now = time.time() + self.clock
+        cur = time.localtime(now)
+        new = time.mktime(cur[0:3] + (int(hour), int(minute), int(second), 0, 0, -1))
+        self.clock += new - now
+        return 'OK'
+
+    def w_keyprotect(self, value):
+        '''KEYPROTECT,ON/OFF'''
+        if value.upper() == 'ON' and self.mode == 'OFF':
+            raise SimulatorError('Controller is off', 'CONT NOT READY-4')
+        self.keyprotect = value.upper() == 'ON'
+        return 'OK'
+
+    def w_power(self, value):
+        '''POWER,ON/OFF'''
+        return self.w_mode('CONSTANT' if value.upper() == 'ON' else 'OFF', None)
+
+    @staticmethod
+    def _parse_limits(args, loop, humi=False):
+        '''Parse the S/H/L parameters of TEMP/HUMI'''
+        ret = dict(loop)
+        for arg in args.split():
+            key, val = arg[0], arg[1:]
+            if key == 'S':
+                ret['sp'] = None if humi and val == 'OFF' else float(val)
+            elif key in 'HL':
+                ret['max' if key == 'H' else 'min'] = float(val)
+            else:
+                raise SimulatorError('Bad parameter', 'PARA ERR')
+        if ret['min'] >= ret['max'] or (ret['sp'] is not None and
+                                        not ret['min'] <= ret['sp'] <= ret['max']):
+            raise SimulatorError('Out of range', 'DATA OUT OF RANGE')
+        return ret
+
+    def w_temp(self, args):
+        '''TEMP, S H L'''
+        self.temp = self._parse_limits(args, self.temp)
+        return 'OK'
+
+    def w_humi(self, args):
+        '''HUMI, S H L'''
+        self._require(self.humi)
+        self.humi = self._parse_limits(args, self.humi, True)
+        return 'OK'
+
+    def w_set(self, ref):
+        '''SET,REFn'''
+        if ref not in self.REFRIG:
+            raise SimulatorError('Bad refrigeration mode', 'PARA ERR')
+        self.ref = ref
+        return 'OK'
+
+    def w_relay(self, value, relays):
+        '''RELAY,ON/OFF,n,...'''
+        relays = set(int(i) for i in relays.split(','))
+        if not relays <= set(range(1, 13)):
+            raise SimulatorError('No such relay', 'CONT NOT READY-5')
+        if value == 'ON':
+            self.relays |= relays
+        else:
+            self.relays -= relays
+        return 'OK'
+
+    def w_prgm(self, action, area, number, step, mode):
+        '''PRGM,RUN/PAUSE/CONTINUE/ADVANCE/END'''
+        if action == 'RUN':
+            prgm = self._program(area, number)
+            step = int(step)
+            if not 1 <= step <= len(prgm['steps']):
+                raise SimulatorError('No such step', 'DATA OUT OF RANGE')
+            if self.edit is not None and self.edit['number'] == int(number):
+                raise SimulatorError('Program is being edited', 'CHB NOT READY')
+            self._start(int(number), prgm['steps'], step)
+            return 'OK'
+        run = self._running()
+        if action == 'PAUSE':
+            run['paused'] = True
+        elif action == 'CONTINUE':
+            run['paused'] = False
+        elif action == 'ADVANCE':
+            self._next_step()
+        elif action == 'END':
+            self._end(mode or 'STANDBY')
+        return 'OK'
+
+    def w_mode(self, mode, number):
+        '''MODE,OFF/STANDBY/CONSTANT/RUNn'''
+        if mode == 'RUN':
+            return self.w_prgm('RUN', 'RAM', number, 1, None)
+        self.run = None
+        self.mode = mode
+        return 'OK'
+
+    def _editing(self, number):
+        '''The program being edited, refuses the command if the program is not being edited'''
+        if self.edit is None:
+            raise SimulatorError('Not in edit mode', 'PRGM WRITE ERR-2')
+        if self.edit['number'] != int(number):
+            raise SimulatorError('Another program is being edited', 'PRGM WRITE ERR-7')
+        return self.edit
+
+    def w_prgm_edit(self, number, kind, action):
+        '''PRGM DATA WRITE,PGMn,EDIT/OVER WRITE START/END/CANCEL'''
+        number = int(number)
+        if action == 'START':
+            if self.edit is not None:
+                raise SimulatorError('Already editing', 'PRGM WRITE ERR-4')
+            if not 1 <= number <= self.ramprgms:
+                raise SimulatorError('Read only program', 'PRGM WRITE ERR-1')
+            if self.run is not None and self.run['number'] == number and not self.run['remote']:
+                raise SimulatorError('Program is running', 'PRGM WRITE ERR-10')
+            self.edit = {'number':number, 'name':'', 'end':'STANDBY', 'next':0,
+                         'counter_a':(0, 0, 0), 'counter_b':(0, 0, 0), 'steps':[],
+                         'htemp':self.temp['max'], 'ltemp':self.temp['min'],
+                         'hhumi':98.0, 'lhumi':5.0, 'pre_temp':('OFF', None),
+                         'pre_humi':('OFF', None)}
+            return 'OK'
+        edit = self._editing(number)
+        self.edit = None
+        if action == 'END':
+            for start, end, cycles in [edit['counter_a'], edit['counter_b']]:
+                if cycles and not 1 <= start <= end <= len(edit['steps']):
+                    raise SimulatorError('Bad counter', 'PRGM WRITE ERR-9')
+            if not edit['steps']:
+                raise SimulatorError('No steps', 'PRGM WRITE ERR-13')
+            edit['date'] = time.time() + self.clock
+            self.programs[number] = edit
+        return 'OK'
+
+    def w_prgm_step(self, number, step, args):
+        '''PRGM DATA WRITE,PGMn,STEPi,...'''
+        edit = self._editing(number)
+        step = int(step)
+        if not 1 <= step <= len(edit['steps']) + 1:
+            raise SimulatorError('Steps must be entered in order', 'PRGM WRITE ERR-8')
+        if step > len(edit['steps']):
+            edit['steps'].append({'temp':self.temp['sp'], 'tramp':False, 'ptc':False,
+                                  'devp':5.0, 'devn':-5.0, 'humi':None, 'hramp':False,
+                                  'duration':3600, 'granty':False, 'paused':False, 'ref':'REF9',
+                                  'relays':set()})
+        data = edit['steps'][step-1]
+        for arg in args.split(','):
+            if arg.startswith('TEMP'):
+                data['temp'] = float(arg[4:])
+            elif arg.startswith('TRAMP'):
+                data['tramp'] = arg[5:] == 'ON'
+            elif arg.startswith('PTC'):
+                data['ptc'] = arg[3:] == 'ON'
+            elif arg.startswith('DEVP'):
+                data['devp'] = float(arg[4:])
+            elif arg.startswith('DEVN'):
+                data['devn'] = float(arg[4:])
+                if self.ctlr_type != 'P300':
+                    data['devn'] = -abs(data['devn'])
+            elif arg.startswith('HUMI'):
+                self._require(self.humi)
+                data['humi'] = None if arg[4:] == 'OFF' else float(arg[4:])
+            elif arg.startswith('HRAMP'):
+                if data['humi'] is None and arg[5:] == 'ON':
+                    raise SimulatorError('Humidity is off', 'PRGM WRITE ERR-15')
+                data['hramp'] = arg[5:] == 'ON'
+            elif arg.startswith('TIME'):
+                hours, minutes = arg[4:].split(':')
+                data['duration'] = int(hours)*3600 + int(minutes)*60
+            elif arg.startswith('GRANTY '):
+                data['granty'] = arg[7:] == 'ON'
+            elif arg.startswith('PAUSE '):
+                data['paused'] = arg[6:] == 'ON'
+            elif arg in self.REFRIG:
+                data['ref'] = arg
+            elif arg.startswith('RELAY ON'):
+                data['relays'] |= set(int(i) for i in arg[8:].split('.'))
+            elif arg.startswith('RELAY OFF'):
+                data['relays'] -= set(int(i) for i in arg[9:].split('.'))
+            else:
+                raise SimulatorError('Bad step parameter', 'PRGM WRITE ERR-13')
+        return 'OK'
+
+    def w_prgm_detail(self, number, item, args):
+        '''PRGM DATA WRITE,PGMn,COUNT/NAME/END/HTEMP/LTEMP/PRE .../HHUMI/LHUMI,...'''
+        edit = self._editing(number)
+        if item == 'COUNT':
+            for counter in re.findall(r'([AB])\((\d+)\.(\d+)\.(\d+)\)', args):
+                edit['counter_%s' % counter[0].lower()] = tuple(int(i) for i in counter[1:])
+        elif item == 'NAME':
+            edit['name'] = args[:15]
+        elif item == 'END':
+            mode = args.split(',')
+            if mode[0] not in self.END_MODES:
+                raise SimulatorError('Bad end mode', 'PRGM WRITE ERR-11')
+            edit['end'] = mode[0]
+            if mode[0] == 'RUN':
+                edit['next'] = int(mode[1][3:])
+        elif item in ['HTEMP', 'LTEMP', 'HHUMI', 'LHUMI']:
+            edit[item.lower()] = float(args)
+        elif item == 'PRE MODE':
+            loop, mode = args.split(',')
+            key = 'pre_temp' if loop == 'TEMP' else 'pre_humi'
+            edit[key] = (mode, edit[key][1])
+        elif item in ['PRE TSV', 'PRE HSV']:
+            key = 'pre_temp' if item == 'PRE TSV' else 'pre_humi'
+            edit[key] = (edit[key][0], float(args))
+        return 'OK'
+
+    def w_prgm_erase(self, area, number):
+        '''PRGM ERASE,RAM:n'''
+        self._program(area, number)
+        if self.run is not None and self.run['number'] == int(number):
+            raise SimulatorError('Program is running', 'CHB NOT READY')
+        del self.programs[int(number)]
+        return 'OK'
+
+    def w_run_prgm(self, args):
+        '''RUN PRGM, TEMPx TIMEh:m [GOTEMPx] [HUMIx] [GOHUMIx] [RELAYON,n,...]'''
+        params = dict(re.findall(r'(GOTEMP|TEMP|GOHUMI|HUMI|TIME|RELAYON,|RELAYOFF,)([^ ]+)',
+                                 args))
+        hours, minutes = params['TIME'].split(':')
+        start = float(params['TEMP'])
+        step = {'start_temp':start, 'temp':float(params.get('GOTEMP', start)), 'tramp':True,
+                'ptc':False, 'humi':None, 'start_humi':None, 'hramp':True, 'ref':self.ref,
+                'duration':int(hours)*3600 + int(minutes)*60, 'granty':False, 'paused':False,
+                'relays':set(int(i) for i in params.get('RELAYON,', '').split(',') if i)}
+        if 'HUMI' in params:
+            self._require(self.humi)
+            step['start_humi'] = float(params['HUMI'])
+            step['humi'] = float(params.get('GOHUMI', step['start_humi']))
+        self._start(0, [step], remote=True)
+        self.run['temp'], self.run['humi'] = step['start_temp'], step['start_humi']
+        return 'OK'
+
+    def w_temp_ptc(self, enable, devp, devn):
+        '''TEMP PTC, PTCON/OFF, DEVPx, DEVNx'''
+        self._require(self.ptc)
+        self.ptc['enable'] = enable == 'ON'
+        self.ptc['devp'], self.ptc['devn'] = float(devp), float(devn)
+        if self.ctlr_type != 'P300':
+            self.ptc['devn'] = -abs(self.ptc['devn'])
+        return 'OK'
+
+    def w_ptc(self, args):
+        '''PTC,max,min,p,filter,i,opt1,opt2'''
+        self._require(self.ptc)
+        vals = [float(val) for val in args.split(',')]
+        self.ptc.update(zip(['max', 'min', 'p', 'filter', 'i', 'opt1', 'opt2'], vals))
+        return 'OK'
+
+    def w_ipset(self, args):
+        '''IPSET,address,mask,gateway'''
+        self._p300_only()
+        self.ipset = args.split(',')
+        return 'OK'
+
+    COMMANDS = [
+        (r'ROM\?(,DISP)?', 'q_rom'),
+        (r'DATE\?', 'q_date'),
+        (r'TIME\?', 'q_time'),
+        (r'(?:SRQ|MASK)\?', 'q_srq'),
+        (r'ALARM\?', 'q_alarm'),
+        (r'KEYPROTECT\?', 'q_keyprotect'),
+        (r'TYPE\?', 'q_type'),
+        (r'MODE\?(,DETAIL)?', 'q_mode'),
+        (r'MON\?(,DETAIL)?', 'q_mon'),
+        (r'TEMP\?', 'q_temp'),
+        (r'HUMI\?', 'q_humi'),
+        (r'SET\?', 'q_set'),
+        (r'REF\?', 'q_ref'),
+        (r'RELAY\?', 'q_relay'),
+        (r'%\?', 'q_htr'),
+        (r'CONSTANT SET\?,(\w+)', 'q_constant'),
+        (r'PRGM MON\?', 'q_prgm_mon'),
+        (r'PRGM SET\?', 'q_prgm_set'),
+        (r'PRGM USE\?,RAM(?::(\d+))?', 'q_prgm_use'),
+        (r'PRGM DATA( PTC)?\?,(RAM|ROM):(\d+)(,DETAIL)?(?:,STEP(\d+))?', 'q_prgm_data'),
+        (r'SYSTEM SET\?,(\w+)', 'q_system_set'),
+        (r'MON PTC\?', 'q_mon_ptc'),
+        (r'TEMP PTC\?', 'q_temp_ptc'),
+        (r'SET PTC\?', 'q_set_ptc'),
+        (r'PTC\?', 'q_ptc'),
+        (r'RUN PRGM MON\?', 'q_run_prgm_mon'),
+        (r'RUN PRGM\?', 'q_run_prgm'),
+        (r'IPSET\?', 'q_ipset'),
+        (r'TIMER (?:ON|USE)\?', 'q_timer'),
+        (r'DATE,(\d+)\.(\d+)/(\d+)\..*', 'w_date'),
+        (r'TIME,(\d+):(\d+):(\d+)', 'w_time'),
+        (r'(?:MASK|SRQ|TIMER|TIMER ERASE|TIMER WRITE),.*', 'w_ok'),
+        (r'KEYPROTECT,(ON|OFF|off)', 'w_keyprotect'),
+        (r'POWER,(ON|OFF|off)', 'w_power'),
+        (r'TEMP,(.+)', 'w_temp'),
+        (r'HUMI,(.+)', 'w_humi'),
+        (r'SET,(REF\d)', 'w_set'),
+        (r'RELAY,(ON|OFF),([\d,]+)', 'w_relay'),
+        (r'PRGM,(RUN|PAUSE|CONTINUE|ADVANCE|END)(?:,(RAM|ROM):(\d+),STEP(\d+))?(?:,(\w+))?',
+         'w_prgm'),
+        (r'MODE,(OFF|STANDBY|CONSTANT|RUN)(\d+)?', 'w_mode'),
+        (r'PRGM DATA WRITE,PGM(\d+),(EDIT|OVER WRITE) (START|END|CANCEL)', 'w_prgm_edit'),
+        (r'PRGM DATA WRITE,PGM(\d+),STEP(\d+),(.+)', 'w_prgm_step'),
+        (r'PRGM DATA WRITE,PGM(\d+),(COUNT|NAME|END|HTEMP|LTEMP|HHUMI|LHUMI|PRE MODE|PRE TSV|'
+         r'PRE HSV),(.*)', 'w_prgm_detail'),
+        (r'PRGM ERASE,(RAM|ROM):(\d+)', 'w_prgm_erase'),
+        (r'RUN PRGM,(.+)', 'w_run_prgm'),
+        (r'TEMP PTC, PTC(ON|OFF), DEVP([0-9.-]+), DEVN([0-9.-]+)', 'w_temp_ptc'),
+        (r'PTC,(.+)', 'w_ptc'),
+        (r'IPSET,(.+)', 'w_ipset'),
+    ]
+
+class SimulatorServer(object):
+    '''
+    Serves simulated controllers: threads, sockets, ptys, fault injection and statistics.
+
+    Kwargs:
+        baud (int): emulate the transmission time of serial (pty) traffic at this baud rate, None
+                    for instant transmission (default=None)
+        faults (dict): probability of each fault (see subclasses) per request (default={})
+        seed (int): seed for the fault injection (default=None)
+    '''
+    FAULTS = []
+
+    def __init__(self, **kwargs):
+        self.baud = kwargs.get('baud')
+        self.faults = dict(kwargs.get('faults', {}))
+        self.random = random.Random(kwargs.get('seed'))
+        self.stats = dict((key, 0) for key in ['requests', 'bytes_in', 'bytes_out'] + self.FAULTS)
+        self.lock = threading.Lock()
+        self.running = True
+        self.sockets, self.fds, self.threads = [], [], []
+
+    def close(self):
+        '''Stop serving'''
+        self.running = False
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            sock.close()
+        for thread in self.threads:
+            thread.join(1)
+        for fdesc in self.fds:
+            try:
+                os.close(fdesc)
+            except OSError:
+                pass
+        self.sockets, self.fds, self.threads = [], [], []
+
+    def fault(self, kinds):
+        '''
+        Count a request and pick the fault (if any) to inject into it.
+
+        Args:
+            kinds (list): the faults that can be injected into this request
+        Returns:
+            str. the fault or None
+        '''
+        with self.lock:
+            self.stats['requests'] += 1
+            roll = self.random.random()
+            for kind in kinds:
+                roll -= self.faults.get(kind, 0)
+                if roll < 0:
+                    self.stats[kind] += 1
+                    return kind
+        return None
+
+    def count(self, received, sent):
+        '''Count traffic'''
+        with self.lock:
+            self.stats['bytes_in'] += received
+            self.stats['bytes_out'] += sent
+
+    def transmit(self, length):
+        '''Wait for length bytes to be transmitted on the serial line (see baud)'''
+        if self.baud:
+            time.sleep(length * 10.0 / self.baud)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def serve_tcp(self, port=0, host='127.0.0.1'):
+        '''
+        Start serving on a TCP port (each connection is served by its own thread).
+
+        Args:
+            port (int): the port to listen on, 0 picks a free port (default=0)
+            host (str): the interface to listen on (default='127.0.0.1')
+        Returns:
+            tuple. (host, port)
+        '''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(5)
+        self.sockets.append(server)
+        self._start(self._accept, server)
+        return server.getsockname()
+
+    def _accept(self, server):
+        while self.running:
+            try:
+                conn = server.accept()[0]
+            except Exception:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets.append(conn)
+            self._start(self.serve_connection, conn)
+
+    def serve_connection(self, conn):
+        '''Serve a TCP connection (runs in its own thread)'''
+        raise NotImplementedError
+
+    def serve_pty(self):
+        '''
+        Start serving on a new pty (POSIX only).
+
+        Returns:
+            str. the name of the serial port (tty) for the client to open
+        '''
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        self.fds.extend([master, slave])
+        self._start(self.serve_serial, master)
+        return os.ttyname(slave)
+
+    def serve_serial(self, master):
+        '''Serve the master side of a pty (runs in its own thread)'''
+        raise NotImplementedError
+
+class ModbusSimulator(SimulatorServer):
+    '''
+    Serve simulated devices over modbus TCP and/or RTU (on a pty).
+
+    Args:
+        devices (ModbusDevice/list): the device(s), addressed by their modbus address
+    Kwargs:
+        latency (float): time the device takes to process each request (default=0)
+        baud (int): emulate the transmission time of RTU frames at this baud rate, None for
+                    instant transmission (default=None)
+        faults (dict): probability of each fault per request (default={}):
+                       timeout: no response is sent
+                       crc: the response crc is corrupted (RTU only)
+                       exception: an exception response (exception_code) is sent
+        exception_code (int): the code of injected exception responses (default=6, busy)
+        seed (int): seed for the fault injection (default=None)
+    '''
+    FAULTS = ['timeout', 'crc', 'exception']
+
+    def __init__(self, devices, **kwargs):
+        super(ModbusSimulator, self).__init__(**kwargs)
+        devices = devices if isinstance(devices, (list, tuple)) else [devices]
+        self.devices = dict((dev.address, dev) for dev in devices)
+        self.latency = kwargs.get('latency', 0)
+        self.timing = RTUTiming(baud=self.baud) if self.baud else None
+        self.exception_code = kwargs.get('exception_code', 6)
+
+    def respond(self, pdu, tcp=False):
+        '''
+        Process one request with latency and fault injection.
+
+        Args:
+            pdu (str): the request (unit id + function code + data)
+            tcp (bool): the request came from modbus tcp (unknown units get a gateway exception)
+        Returns:
+            tuple. (response or None for no response, fault or None)
+        '''
+        adr, fcode = struct.unpack_from('>BB', pdu)
+        fault = self.fault(['timeout', 'exception'] if tcp else self.FAULTS)
+        if self.latency:
+            time.sleep(self.latency)
+        device = self.devices.get(adr)
+        if device is None:
+            return (struct.pack('>BBB', adr, fcode | 0x80, 11) if tcp else None), None
+        if fault == 'timeout':
+            return None, fault
+        if fault == 'exception':
+            return struct.pack('>BBB', adr, fcode | 0x80, self.exception_code), fault
+        return device.handle(pdu), fault
+
+    def serve_connection(self, conn):
+        buf = ''
+        while self.running:
+            try:
+                data = conn.recv(4096)
+            except Exception:
+                return
+            if not data:
+                conn.close()
+                return
+            buf += data
+            while len(buf) >= 6:
+                tid, proto, length = struct.unpack_from('>3H', buf)
+                if len(buf) < 6 + length:
+                    break
+                pdu, buf = buf[6:6+length], buf[6+length:]
+                self.count(6 + length, 0)
+                if proto != 0:
+                    continue
+                response = self.respond(pdu, True)[0]
+                if response is not None:
+                    frame = struct.pack('>3H', tid, 0, len(response)) + response
+                    self.count(0, len(frame))
+                    try:
+                        conn.sendall(frame)
+                    except Exception:
+                        return
+
+    def serve_rtu(self):
+        '''
+        Start serving modbus RTU on a new pty (POSIX only).
+
+        Returns:
+            str. the name of the serial port (tty) for the client to open
+        '''
+        return self.serve_pty()
+
+    @staticmethod
+    def _frame_length(buf):
+        '''The length of the request frame at the start of buf, None if more bytes are needed'''
+        fcode = ord(buf[1])
+        if fcode in [3, 4, 6]:
+            return 8
+        elif fcode == 16:
+            return 9 + ord(buf[6]) if len(buf) > 6 else None
+        elif fcode == 23:
+            return 13 + ord(buf[10]) if len(buf) > 10 else None
+        return 0
+
+    def serve_serial(self, master):
+        buf = ''
+        while self.running:
+            try:
+                if not select.select([master], [], [], 0.2)[0]:
+                    buf = '' #a silent interval ends any partial frame
+                    continue
+                buf += os.read(master, 512)
+            except Exception:
+                return
+            while len(buf) >= 2:
+                length = self._frame_length(buf)
+                if length is None or len(buf) < length:
+                    break
+                if length == 0 or crc16(buf, length - 2) != struct.unpack_from('>H', buf,
+                                                                               length - 2)[0]:
+                    buf = '' #garbage or a corrupted frame, resynchronize on the next frame
+                    break
+                frame, buf = buf[:length], buf[length:]
+                self.count(length, 0)
+                if self.timing is not None:
+                    time.sleep(self.timing.frame_time(length))
+                response, fault = self.respond(frame[:-2])
+                if response is None:
+                    continue
+                response += struct.pack('>H', crc16(response))
+                if fault == 'crc':
+                    response = response[:-1] + chr(ord(response[-1]) ^ 0xFF)
+                if self.timing is not None:
+                    time.sleep(self.timing.frame_time(len(response)))
+                self.count(0, len(response))
+                try:
+                    os.write(master, response)
+                except Exception:
+                    return
+
+class EspecSimulator(SimulatorServer):
+    '''
+    Serve simulated Espec chambers over TCP (a serial to ethernet adapter) and/or serial (a pty).
+
+    Over serial, requests prefixed with an address ("1,MON?") go to the chamber with that address
+    (chambers sharing the port as on an RS-485 bus) or else a chamber without an address,
+    unaddressed requests go to the first chamber.
+    Over TCP every request goes to the first chamber (the adapter does not forward addresses)
+    unless forward_addresses is set.
+
+    Args:
+        chambers (EspecChamber/list): the chamber(s)
+    Kwargs:
+        baud (int): emulate the transmission time of serial traffic at this baud rate, None for
+                    instant transmission (default=None)
+        faults (dict): probability of each fault per request (default={}):
+                       timeout: no response is sent
+                       exception: the chamber responds "NA:CHB NOT READY"
+        seed (int): seed for the fault injection (default=None)
+        delimeter (str): the line delimeter (default='\\r\\n')
+        forward_addresses (bool): the TCP adapter forwards addresses as a serial port does, ie.
+                                  it is the bridge to an RS-485 line (default=False)
+    '''
+    FAULTS = ['timeout', 'exception']
+
+    def __init__(self, chambers, **kwargs):
+        super(EspecSimulator, self).__init__(**kwargs)
+        self.chambers = chambers if isinstance(chambers, (list, tuple)) else [chambers]
+        self.delimeter = kwargs.get('delimeter', '\r\n')
+        self.forward_addresses = kwargs.get('forward_addresses', False)
+
+    def respond(self, request, tcp=False):
+        '''
+        Process one request line with latency and fault injection.
+
+        Args:
+            request (str): the request (without delimeter, including any address prefix)
+            tcp (bool): the request came over TCP (addresses are ignored)
+        Returns:
+            str. the response (without delimeter) or None for no response
+        '''
+        parsed = re.match(r'(\d+),(.*)$', request)
+        chamber = self.chambers[0]
+        if parsed:
+            request = parsed.group(2)
+            if not tcp or self.forward_addresses:
+                adr = int(parsed.group(1))
+                matches = [ch for ch in self.chambers if ch.address == adr]
+                matches += [ch for ch in self.chambers if ch.address is None]
+                if not matches:
+                    return None
+                chamber = matches[0]
+        fault = self.fault(self.FAULTS)
+        time.sleep(chamber.latency_of(request))
+        if fault == 'timeout':
+            return None
+        if fault == 'exception':
+            return 'NA:CHB NOT READY'
+        return chamber.handle(request)
+
+    def serve_connection(self, conn):
+        buf = ''
+        while self.running:
+            try:
+                data = conn.recv(4096)
+            except Exception:
+                return
+            if not data:
+                conn.close()
+                return
+            buf += data
+            while self.delimeter in buf:
+                line, buf = buf.split(self.delimeter, 1)
+                self.count(len(line) + len(self.delimeter), 0)
+                response = self.respond(line, True)
+                if response is not None:
+                    response += self.delimeter
+                    self.count(0, len(response))
+                    try:
+                        conn.sendall(response)
+                    except Exception:
+                        return
+
+    def serve_serial(self, master):
+        buf = ''
+        while self.running:
+            try:
+                if not select.select([master], [], [], 0.2)[0]:
+                    continue
+                data = os.read(master, 512)
+            except Exception:
+                return
+            self.transmit(len(data))
+            buf += data
+            while self.delimeter in buf:
+                line, buf = buf.split(self.delimeter, 1)
+                self.count(len(line) + len(self.delimeter), 0)
+                response = self.respond(line)
+                if response is not None:
+                    response += self.delimeter
+                    self.transmit(len(response))
+                    self.count(0, len(response))
+                    try:
+                        os.write(master, response)
+                    except Exception:
+                        return
+
+if __name__ == '__main__':
+    import argparse
+    PARSER = argparse.ArgumentParser(description='Serve a simulated chamber controller')
+    PARSER.add_argument('device', choices=['F4T', 'F4', 'P300', 'SCP220'])
+    PARSER.add_argument('--tcp', type=int, help='tcp port to listen on')
+    PARSER.add_argument('--serial', action='store_true', help='serve RTU/serial on a pty')
+    PARSER.add_argument('--loops', type=int, default=1)
+    PARSER.add_argument('--cascades', type=int, default=0)
+    PARSER.add_argument('--latency', type=float, help='response time (default=realistic)')
+    PARSER.add_argument('--baud', type=int)
+    PARSER.add_argument('--timeouts', type=float, default=0, help='timeout fault probability')
+    PARSER.add_argument('--crc', type=float, default=0, help='crc fault probability')
+    PARSER.add_argument('--exceptions', type=float, default=0, help='exception probability')
+    ARGS = PARSER.parse_args()
+    FAULTS = {'timeout':ARGS.timeouts, 'crc':ARGS.crc, 'exception':ARGS.exceptions}
+    if ARGS.device in ['F4T', 'F4']:
+        DEVICE = (WatlowF4TDevice if ARGS.device == 'F4T' else WatlowF4Device)(
+            loops=ARGS.loops, cascades=ARGS.cascades
+        )
+        SIM = ModbusSimulator(DEVICE, latency=ARGS.latency or 0, baud=ARGS.baud, faults=FAULTS)
+    else:
+        DEVICE = EspecChamber(ctlr_type=ARGS.device, humidity=ARGS.loops > 1,
+                              ptc=ARGS.cascades > 0, latency=(
+                                  P300_LATENCY if ARGS.latency is None else ARGS.latency))
+        SIM = EspecSimulator(DEVICE, baud=ARGS.baud, faults=FAULTS)
+    if ARGS.tcp is not None:
+        print 'tcp on %s:%d' % SIM.serve_tcp(ARGS.tcp, '0.0.0.0') # pylint: disable=E1601
+    if ARGS.serial:
+        print 'serial on %s' % SIM.serve_pty() # pylint: disable=E1601
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        SIM.close()
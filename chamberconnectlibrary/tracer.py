@@ -0,0 +1,179 @@
+﻿'''
+Trace the calls made to a controller and the bus transactions made by each call, for viewing the
+timing of the calls and the gaps between their transactions (ie. chrome://tracing or Perfetto)::
+
+    ctlr = WatlowF4T(interface='TCP', host='10.0.0.5', trace='poller.trace.json')
+
+Each call is a span (with a nested span for the time spent waiting for the controller's lock)
+and each transaction is a span nested in the call that made it, timed from its request being
+sent to its response being read (see capture.record). Transaction spans carry the frame lengths
+sent and received, the unit address and function code (modbus) or the command (espec). A batch
+of requests that can only be timed as a whole (ie. by a unit on a shared bus) is one "batch"
+span listing its requests. Traces are written in the Chrome trace event format, or as JSON lines
+(one span per line) when the file name ends in ".jsonl". The file is finished when the tracer is
+closed or, failing that, when the interpreter exits.
+
+:copyright: (C) Espec North America, INC.
+:license: MIT, see LICENSE for more details.
+'''
+import atexit
+import json
+import os
+import struct
+import threading
+from chamberconnectlibrary import instrumentation
+from chamberconnectlibrary.modbus import ModbusRTU, ModbusTCP, ModbusUnit
+from chamberconnectlibrary.especinteract import EspecTransport
+
+class Tracer(object):
+    '''
+    Write spans to a trace file, one tracer may be shared by several controllers.
+
+    Args:
+        path (str): the trace file
+    Kwargs:
+        format (str): "chrome" or "jsonl" (default=by the file name, see module docstring)
+    '''
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.format = kwargs.get('format', 'jsonl' if path.endswith('.jsonl') else 'chrome')
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self.pid = os.getpid()
+        self.events = 0
+        if self.format == 'chrome':
+            self.file.write('[')
+        #a controller's close() only ends its connection (made again for every call when it is
+        #not persistent) and the tracer may be shared, so the file is finished at exit
+        atexit.register(self.close)
+
+    @classmethod
+    def make(cls, trace):
+        '''
+        Make a tracer from a controller's trace kwarg.
+
+        Args:
+            trace: a Tracer, a file name or None (do not trace)
+        '''
+        if trace is None or isinstance(trace, Tracer):
+            return trace
+        return cls(trace)
+
+    def span(self, name, category, start, duration, thread, args):
+        '''
+        Write one span.
+
+        Args:
+            name (str): the name of the span
+            category (str): "call", "lock" or "transaction"
+            start (float): the time.time() the span started
+            duration (float): the length of the span in seconds
+            thread (int): the id of the thread that made the span
+            args (dict): the details of the span
+        '''
+        if self.format == 'chrome':
+            event = {'name':name, 'cat':category, 'ph':'X', 'ts':round(start * 1e6, 1),
+                     'dur':round(duration * 1e6, 1), 'pid':self.pid, 'tid':thread, 'args':args}
+        else:
+            event = dict(args, name=name, type=category, start=start, duration=duration,
+                         thread=thread)
+        line = json.dumps(event, sort_keys=True, separators=(',', ':'))
+        with self.lock:
+            if self.file is None:
+                return
+            if self.format == 'chrome':
+                line = (',\n' if self.events else '\n') + line
+            else:
+                line += '\n'
+            self.file.write(line)
+            self.file.flush()
+            self.events += 1
+
+    def call(self, record):
+        '''Write the spans of a finished call (see instrumentation.Instrumentation)'''
+        args = dict((key, record[key]) for key in instrumentation.FIELDS[3:])
+        if record['error'] is not None:
+            args['error'] = str(record['error'])
+        self.span(record['method'], 'call', record['start'], record['wall'], record['thread'],
+                  args)
+        if record['lock_wait']:
+            self.span('lock', 'lock', record['start'], record['lock_wait'], record['thread'], {})
+
+    def writer(self, transport):
+        '''
+        The writer of a transport's transaction spans, for capture.record
+
+        Args:
+            transport: the Modbus client or espec transport
+        '''
+        return TransactionWriter(self, transport)
+
+    def close(self):
+        '''Finish and close the trace file'''
+        with self.lock:
+            if self.file is not None:
+                if self.format == 'chrome':
+                    self.file.write('\n]\n')
+                self.file.close()
+                self.file = None
+
+class TransactionWriter(object):
+    '''
+    Write the transactions of one transport as spans (see Tracer.writer), takes the place of a
+    capture.CaptureWriter.
+    '''
+
+    def __init__(self, tracer, transport):
+        self.tracer = tracer
+        if isinstance(transport, ModbusTCP):
+            self.overhead = (6, 6) #MBAP header (less the unit id)
+        elif isinstance(transport, (ModbusRTU, ModbusUnit)):
+            self.overhead = (2, 2) #crc
+        elif isinstance(transport, EspecTransport):
+            #the delimeter and the address prefix (if it is sent)
+            self.overhead = (len(transport._request('')), 0) #pylint: disable=W0212
+        else:
+            self.overhead = (0, 0)
+
+    def write(self, transport, request, start, duration, response=None, error=None):
+        '''Write one transaction (see capture.CaptureWriter.write)'''
+        args = {'sent':len(request) + self.overhead[0]}
+        if response is not None:
+            args['received'] = len(response) + self.overhead[1]
+        if error is not None:
+            args['error'] = str(error)
+        call = instrumentation.current()
+        if call is not None:
+            args['call'] = call['method']
+        if transport == 'modbus':
+            request = bytes(request)
+            args['unit'], args['function'] = struct.unpack_from('>BB', request)
+            if len(request) >= 4:
+                args['register'] = struct.unpack_from('>H', request, 2)[0]
+            name = 'modbus %d' % args['function']
+        else:
+            args['command'] = name = request
+        self.tracer.span(name, 'transaction', start, duration, threading.current_thread().ident,
+                         args)
+
+    def write_batch(self, transport, requests, start, duration, responses=None, error=None):
+        '''Write a batch timed as a whole as one span (see capture.CaptureWriter.write_batch)'''
+        args = {'count':len(requests),
+                'sent':sum(len(request) + self.overhead[0] for request in requests)}
+        if responses is not None:
+            args['received'] = sum(len(response) + self.overhead[1] for response in responses)
+        if error is not None:
+            args['error'] = str(error)
+        call = instrumentation.current()
+        if call is not None:
+            args['call'] = call['method']
+        if transport == 'modbus':
+            args['requests'] = [
+                dict(zip(['unit', 'function', 'register'], struct.unpack_from('>BBH', request)))
+                for request in (bytes(request) for request in requests)
+            ]
+        else:
+            args['requests'] = list(requests)
+        self.tracer.span('%s batch' % transport, 'transaction', start, duration,
+                         threading.current_thread().ident, args)
@@ -8,7 +8,7 @@ Upper level interface for the Watlow F4 controller
 import datetime
 import re
 import time
-from chamberconnectlibrary.modbus import ModbusError, ModbusRTU, ModbusTCP
+from chamberconnectlibrary.modbus import ModbusError, ModbusRTU, ModbusTCP, ModbusReplay
 from chamberconnectlibrary.controllerinterface import ControllerInterface, exclusive
 from chamberconnectlibrary.controllerinterface import ControllerInterfaceError
 
@@ -20,10 +20,13 @@ class WatlowF4(ControllerInterface):
         interface (str): The connection method::
             "TCP" -- modbusTCP (default)
             "RTU" -- modbusRTU
+            "Replay" -- Replay a capture file (see capture kwarg)
         adr (int): The modbus address of the controller (default=1)
         host (str): The hostname (IP address) of the Watlow F4T when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=502)
         serialport (str): The serial port to use when interface="RTU"
         baudrate (int): The serial port's baud rate to use when interface="RTU"
+        bus (ModbusRTUBus): A shared RS-485 bus to use (instead of serialport) when interface="RTU"
         loops (int): The number of control loops the controller has (default=1, max=4)
         cascades (int): The number of cascade control loops the controller has (default=0, max=3)
         cond_event (int): The event # used to the controller on/off (default=0(disabled))
@@ -35,6 +38,17 @@ class WatlowF4(ControllerInterface):
         alarms (int): The number of alarms that the controller has (default=6)
         profiles (bool): If True the controller supports profiles(programs) (default=False)
         lock (RLock): The locking method to use when accessing the controller (default=RLock())
+        persistent (bool): Keep the connection open between calls (default=False)
+        idle_timeout (float): Close a persistent connection after seconds unused (default=60)
+        keepalive (float): Seconds between keepalives when persistent and idle (default=None)
+        retry (RetryPolicy/bool): Retries by kind of error, see retrypolicy (default=False)
+        breaker (CircuitBreaker/bool): Fail fast while the controller is offline (default=None)
+        budget (float): Default time budget in seconds for each call, None=unlimited (default=None)
+        record (str/CaptureWriter): Record the traffic to this capture file, see capture
+        capture (str/Capture): The capture file to replay when interface="Replay"
+        replay_speed (float): Replay speed, 1=as recorded, 0=no delays (default=1)
+        instrument (bool/callable): Per method call statistics, see stats() (default=None)
+        trace (str/Tracer): Trace the calls and transactions to this file, see tracer
     '''
 
     def __init__(self, **kwargs):
@@ -257,7 +271,8 @@ class WatlowF4(ControllerInterface):
                 self.client.write_holding(4001, [i+1, 2])
             else:
                 self.client.write_holding(4001, i+1)
-            self.__edit_prgm_step(step)
+            with self.client.write_batch():
+                self.__edit_prgm_step(step)
         return num
 
     def __edit_prgm(self, num, value):
@@ -270,15 +285,36 @@ class WatlowF4(ControllerInterface):
         '''
         connect to the controller using the paramters provided on class initialization
         '''
-        if self.interface == "RTU":
+        if self.interface == "RTU" and self.bus is not None:
+            self.client = self.bus.client(
+                self.adr,
+                profile='watlow_f4',
+                retry=self.retry,
+                breaker=self.breaker
+            )
+        elif self.interface == "RTU":
             self.client = ModbusRTU(
                 address=self.adr,
                 port=self.serialport,
                 baud=self.baudrate,
-                timeout=10.0
+                timeout=10.0,
+                profile='watlow_f4',
+                retry=self.retry,
+                breaker=self.breaker
             )
+        elif self.interface == "Replay":
+            self.client = ModbusReplay(self.adr, self.capture, retry=self.retry,
+                                       breaker=self.breaker)
         else:
-            self.client = ModbusTCP(self.adr, self.host, timeout=10.0)
+            self.client = ModbusTCP(
+                self.adr,
+                self.host,
+                self.port or 502,
+                timeout=10.0,
+                retry=self.retry,
+                breaker=self.breaker
+            )
+        self.observe(self.client)
 
     def close(self):
         '''
@@ -295,7 +331,7 @@ class WatlowF4(ControllerInterface):
         '''
         connect directly to the controller
         '''
-        return self.client.interact(command)
+        return str(self.client.interact(command))
 
     @exclusive
     def get_datetime(self):
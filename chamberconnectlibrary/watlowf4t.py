@@ -8,7 +8,7 @@ Upper level interface for the Watlow F4T controller
 import time
 import datetime
 import struct
-from chamberconnectlibrary.modbus import ModbusError, ModbusRTU, ModbusTCP
+from chamberconnectlibrary.modbus import ModbusError, ModbusRTU, ModbusTCP, ModbusReplay
 from chamberconnectlibrary.controllerinterface import ControllerInterface, exclusive
 from chamberconnectlibrary.controllerinterface import ControllerInterfaceError
 
@@ -20,10 +20,14 @@ class WatlowF4T(ControllerInterface):
         interface (str): The connection method::
             "TCP" -- modbusTCP (default)
             "RTU" -- modbusRTU
+            "Replay" -- Replay a capture file (see capture kwarg)
         adr (int): The modbus address of the controller (default=1)
         host (str): The hostname (IP address) of the Watlow F4T when interface="TCP"
+        port (int): The TCP port when interface="TCP" (default=502)
         serialport (str): The serial port to use when interface="RTU"
         baudrate (int): The serial port's baud rate to use when interface="RTU"
+        bus (ModbusRTUBus): A shared RS-485 bus to use (instead of serialport) when interface="RTU"
+        window (int): Max requests in flight when interface="TCP", 1 disables pipelining (default=1)
         loops (int): The number of control loops the controller has (default=1, max=4)
         cascades (int): The number of cascade control loops the controller has (default=0, max=3)
         cond_event (int): The event # used to the controller on/off (default=0(disabled))
@@ -42,11 +46,23 @@ class WatlowF4T(ControllerInterface):
         alarms (int): The number of alarms that the controller has (default=6)
         profiles (bool): If True the controller supports profiles(programs) (default=False)
         lock (RLock): The locking method to use when accessing the controller (default=RLock())
+        persistent (bool): Keep the connection open between calls (default=False)
+        idle_timeout (float): Close a persistent connection after seconds unused (default=60)
+        keepalive (float): Seconds between keepalives when persistent and idle (default=None)
+        retry (RetryPolicy/bool): Retries by kind of error, see retrypolicy (default=False)
+        breaker (CircuitBreaker/bool): Fail fast while the controller is offline (default=None)
+        budget (float): Default time budget in seconds for each call, None=unlimited (default=None)
+        record (str/CaptureWriter): Record the traffic to this capture file, see capture
+        capture (str/Capture): The capture file to replay when interface="Replay"
+        replay_speed (float): Replay speed, 1=as recorded, 0=no delays (default=1)
+        instrument (bool/callable): Per method call statistics, see stats() (default=None)
+        trace (str/Tracer): Trace the calls and transactions to this file, see tracer
     '''
 
     def __init__(self, **kwargs):
         self.iwatlow_val_dict, self.client, self.loops, self.cascades = None, None, None, None
         self.init_common(**kwargs)
+        self.window = kwargs.get('window', 1)
         self.cond_event = kwargs.get('cond_event', 9)
         self.cond_event_toggle = kwargs.get('cond_event_toggle', False)
 
@@ -172,10 +188,35 @@ class WatlowF4T(ControllerInterface):
         '''
         connect to the controller using the paramters provided on class initialization
         '''
-        if self.interface == "RTU":
-            self.client = ModbusRTU(address=self.adr, port=self.serialport, baud=self.baudrate)
+        if self.interface == "RTU" and self.bus is not None:
+            self.client = self.bus.client(
+                self.adr,
+                profile='watlow_f4t',
+                retry=self.retry,
+                breaker=self.breaker
+            )
+        elif self.interface == "RTU":
+            self.client = ModbusRTU(
+                address=self.adr,
+                port=self.serialport,
+                baud=self.baudrate,
+                profile='watlow_f4t',
+                retry=self.retry,
+                breaker=self.breaker
+            )
+        elif self.interface == "Replay":
+            self.client = ModbusReplay(self.adr, self.capture, retry=self.retry,
+                                       breaker=self.breaker)
         else:
-            self.client = ModbusTCP(self.adr, self.host)
+            self.client = ModbusTCP(
+                self.adr,
+                self.host,
+                self.port or 502,
+                window=self.window,
+                retry=self.retry,
+                breaker=self.breaker
+            )
+        self.observe(self.client)
 
     def close(self):
         '''
@@ -197,7 +238,7 @@ class WatlowF4T(ControllerInterface):
         Returns:
             str. The raw modbus response from the controller.
         '''
-        return self.client.interact(command)
+        return str(self.client.interact(command))
 
     @exclusive
     def get_datetime(self):
@@ -213,12 +254,13 @@ class WatlowF4T(ControllerInterface):
 
     @exclusive
     def set_datetime(self, value):
-        self.client.write_holding(14664, [value.hour])
-        self.client.write_holding(14666, [value.minute])
-        self.client.write_holding(14668, [value.second])
-        self.client.write_holding(14670, [value.month])
-        self.client.write_holding(14672, [value.day])
-        self.client.write_holding(14674, [value.year])
+        with self.client.write_batch(max_gap=1, fill=0):
+            self.client.write_holding(14664, [value.hour])
+            self.client.write_holding(14666, [value.minute])
+            self.client.write_holding(14668, [value.second])
+            self.client.write_holding(14670, [value.month])
+            self.client.write_holding(14672, [value.day])
+            self.client.write_holding(14674, [value.year])
 
     @exclusive
     def get_refrig(self):
@@ -549,15 +591,20 @@ class WatlowF4T(ControllerInterface):
     def get_alarm_status(self):
         aalms = []
         ialms = []
+        # read every alarm and limit state together so they can share a single exchange
+        regs = [1356+100*i for i in range(0, self.alarms)]
+        for i in self.limits:
+            regs += [11250+(i-1)*60, 11288+(i-1)*60, 11264+60*(i-1)]
+        vals = [itm['value'] for itm in self.client.read_items([{'register':r} for r in regs])]
         for i in range(0, self.alarms):
-            if self.client.read_holding(1356+100*i, 1)[0] in [88, 61, 12]:
+            if vals.pop(0) in [88, 61, 12]:
                 ialms.append(i+1)
             else:
                 aalms.append(i+1)
         for i in self.limits:
-            state = self.watlow_val_dict[self.client.read_holding(11250+(i-1)*60, 1)[0]] == 'error'
-            cerror = self.watlow_val_dict[self.client.read_holding(11288+(i-1)*60, 1)[0]] != 'none'
-            status = self.watlow_val_dict[self.client.read_holding(11264+60*(i-1), 1)[0]] == 'fail'
+            state = self.watlow_val_dict[vals.pop(0)] == 'error'
+            cerror = self.watlow_val_dict[vals.pop(0)] != 'none'
+            status = self.watlow_val_dict[vals.pop(0)] == 'fail'
             if state or cerror or status:
                 aalms.append(20+i)
             else:
@@ -650,8 +697,7 @@ class WatlowF4T(ControllerInterface):
 
     @exclusive
     def get_prgm_steps(self, N):
-        self.client.write_holding(18888, N)
-        return self.client.read_holding(18920, 1)[0]
+        return self.client.read_write_holding(18888, N, 18920)[0]
 
     def set_prgm_name(self, N, value):
         raise NotImplementedError
@@ -674,8 +720,8 @@ class WatlowF4T(ControllerInterface):
         self.__range_check(N, 1, 40)
         if not self.profiles:
             raise ControllerInterfaceError("This watlow does not impliment profiles")
-        self.client.write_holding(18888, N) #set active profile
-        step_count = self.client.read_holding(18920, 1)[0] #get the number of steps in the profile
+        #set active profile and get the number of steps in the profile
+        step_count = self.client.read_write_holding(18888, N, 18920)[0]
         if not step_count > 0:
             raise ControllerInterfaceError("Profile %d does not exist." % N)
         prgm_dict = {'name':self.client.read_holding_string(18606, 20),
@@ -777,6 +823,8 @@ class WatlowF4T(ControllerInterface):
     def set_prgm(self, N, prgm):
         def event_number(event_number, event_value):
             '''Set event from events/gs register block'''
+            if isinstance(event_value, bool):
+                event_value = 'on' if event_value else 'off'
             if event_number < 5:
                 self.client.write_holding(19146+offset+(event_number-1)*2,
                                           self.inv_watlow_val_dict(event_value))
@@ -785,65 +833,69 @@ class WatlowF4T(ControllerInterface):
                                           self.inv_watlow_val_dict(event_value))
         self.client.write_holding(18888, N) #set active profile
         self.client.write_holding(18890, 1375) #Set mode Add program
-        self.client.write_holding_string(18606, prgm['name'])#set program name
-        self.client.write_holding(19038, 106 if prgm['log'] else 59) #set log mode
-        for i, val in enumerate(prgm['gs_dev']): #set guarenteed soak deviations
-            self.client.write_holding_float(19086+i*2, val['value'])
-        for stnm, stp in enumerate(prgm['steps']):
-            offset = stnm*170
-            #step type
-            self.client.write_holding(19094+offset, self.inv_watlow_val_dict(stp['type']))
-            for val in stp['events']:
-                event_number(val['number'], val['value'])
-            if stp['type'] == 'jump':
-                self.client.write_holding(19102+offset, stp['jstep']) #jump step target
-                self.client.write_holding(19104+offset, stp['jcount']) #jump count
-            if stp['type'] == 'wait':
-                for cwt in stp['waits']:
-                     # wait condition
-                    self.client.write_holding(19122+offset+(cwt['number']-1)*4,
-                                              self.inv_watlow_val_dict(cwt['condition']))
-                     # wait value
-                    self.client.write_holding_float(19124+offset+(cwt['number']-1)*4, cwt['value'])
-            if stp['type'] in ['soak', 'instant', 'ramptime', 'ramprate', 'end']:
-                for i, clp in enumerate(stp['loops']):
-                    cmap = self.loop_map[i]
-                    if stp['type'] == 'ramprate': #write ramp rate
-                        self.client.write_holding_float(19106+offset+i*2, clp['rate'])
-                    if stp['type'] in ['ramprate', 'ramptime', 'instant']: #write target value
-                        self.client.write_holding_float(19114+offset+i*2, clp['target'])
-                    if stp['type'] == 'end': #write end mode
-                        self.client.write_holding(19170+offset+i*2,
-                                                  self.inv_watlow_val_dict(clp['mode']))
-                    if stp['type'] != 'end': # guarenteed soak
-                        self.client.write_holding(19138+offset+i*2,
-                                                  63 if clp['gsoak'] else 62)
-                        if cmap['type'] == 'loop':
-                            lpevt = self.loop_event[cmap['num']-1]
-                        else:
-                            lpevt = self.cascade_event[cmap['num']-1]
-                        if lpevt > 0:
-                            event_number(lpevt, 'on' if clp['enable'] else 'off')
-                        if cmap['type'] == 'cascade' and self.cascade_ctl_event[cmap['num']-1] > 0:
-                            event_number(self.cascade_ctl_event[cmap['num']-1],
-                                         'on' if clp['cascade'] else 'off')
-            else:
-                for evt in self.loop_event + self.cascade_event + self.cascade_ctl_event:
-                    if evt > 0:
-                        event_number(evt, 'nc')
-            if stp['type'] in ['soak', 'instant', 'ramptime']:
-                self.client.write_holding(19100+offset, stp['duration']['seconds'])
-                self.client.write_holding(19098+offset, stp['duration']['minutes'])
-                self.client.write_holding(19096+offset, stp['duration']['hours'])
-            #set condition event to on unless its an end step with both loops off.
-            if self.cond_event > 0 and self.cond_event <= 8:
-                run = True
-                if 'loops' in stp and 'mode' in stp['loops'][0]:
-                    run = False
-                    for mod in stp['loops']:
-                        if mod['mode'] != 'off':
-                            run = True
-                event_number(self.loop_event[i], 'on' if run else 'off')
+        #each step's parameters are sent in register order, adjacent registers in one request
+        with self.client.write_batch():
+            self.client.write_holding_string(18606, prgm['name'])#set program name
+            self.client.write_holding(19038, 106 if prgm['log'] else 59) #set log mode
+            for i, val in enumerate(prgm['gs_dev']): #set guarenteed soak deviations
+                self.client.write_holding_float(19086+i*2, val['value'])
+            for stnm, stp in enumerate(prgm['steps']):
+                offset = stnm*170
+                #step type
+                self.client.write_holding(19094+offset, self.inv_watlow_val_dict(stp['type']))
+                for val in stp['events']:
+                    event_number(val['number'], val['value'])
+                if stp['type'] == 'jump':
+                    self.client.write_holding(19102+offset, stp['jstep']) #jump step target
+                    self.client.write_holding(19104+offset, stp['jcount']) #jump count
+                if stp['type'] == 'wait':
+                    for cwt in stp['waits']:
+                         # wait condition
+                        self.client.write_holding(19122+offset+(cwt['number']-1)*4,
+                                                  self.inv_watlow_val_dict(cwt['condition']))
+                         # wait value
+                        self.client.write_holding_float(19124+offset+(cwt['number']-1)*4,
+                                                        cwt['value'])
+                if stp['type'] in ['soak', 'instant', 'ramptime', 'ramprate', 'end']:
+                    for i, clp in enumerate(stp['loops']):
+                        cmap = self.loop_map[i]
+                        if stp['type'] == 'ramprate': #write ramp rate
+                            self.client.write_holding_float(19106+offset+i*2, clp['rate'])
+                        if stp['type'] in ['ramprate', 'ramptime', 'instant']: #write target value
+                            self.client.write_holding_float(19114+offset+i*2, clp['target'])
+                        if stp['type'] == 'end': #write end mode
+                            self.client.write_holding(19170+offset+i*2,
+                                                      self.inv_watlow_val_dict(clp['mode']))
+                        if stp['type'] != 'end': # guarenteed soak
+                            self.client.write_holding(19138+offset+i*2,
+                                                      63 if clp['gsoak'] else 62)
+                            if cmap['type'] == 'loop':
+                                lpevt = self.loop_event[cmap['num']-1]
+                            else:
+                                lpevt = self.cascade_event[cmap['num']-1]
+                            if lpevt > 0:
+                                event_number(lpevt, 'on' if clp['enable'] else 'off')
+                            ctlevt = self.cascade_ctl_event[cmap['num']-1]
+                            if cmap['type'] == 'cascade' and ctlevt > 0:
+                                event_number(ctlevt, 'on' if clp['cascade'] else 'off')
+                else:
+                    for evt in self.loop_event + self.cascade_event + self.cascade_ctl_event:
+                        if evt > 0:
+                            event_number(evt, 'nc')
+                if stp['type'] in ['soak', 'instant', 'ramptime']:
+                    self.client.write_holding(19100+offset, stp['duration']['seconds'])
+                    self.client.write_holding(19098+offset, stp['duration']['minutes'])
+                    self.client.write_holding(19096+offset, stp['duration']['hours'])
+                #set condition event to on unless its an end step with both loops off.
+                if self.cond_event > 0 and self.cond_event <= 8:
+                    run = True
+                    if 'loops' in stp and 'mode' in stp['loops'][0]:
+                        run = False
+                        for mod in stp['loops']:
+                            if mod['mode'] != 'off':
+                                run = True
+                    event_number(self.loop_event[i], 'on' if run else 'off')
+                self.client.barrier()
 
     @exclusive
     def prgm_delete(self, N):
@@ -21,5 +21,5 @@ setup(
     zip_safe=False,
     keywords='Espec P300 SCP220 F4T F4',
     include_package_data=True,
-    scripts=['bin/chamberconnectlibrary-test.py']
+    scripts=['bin/chamberconnectlibrary-test.py', 'bin/chamberconnectlibrary-benchmark.py']
 )